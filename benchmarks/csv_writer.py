@@ -0,0 +1,67 @@
+"""
+Benchmark csv writing of flow tables.
+
+Compares DataFrame.to_csv against cli.files.write_csv, with and without
+compression, on a synthetic flows table, and reports throughput in MB/s of
+uncompressed csv.
+
+Usage:
+
+    python benchmarks/csv_writer.py [nrows]
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+import numpy     as np
+import pandas    as pd
+
+from cli.files import write_csv
+
+
+def synthetic_flows(nrows, seed = 0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'origin'      : rng.integers(0, 500, nrows).astype(str),
+        'destination' : rng.integers(0, 500, nrows).astype(str),
+        'period'      : pd.Timestamp('2019-01-01') + \
+                        pd.to_timedelta(rng.integers(0, 8640, nrows) * 300,
+                                        's'),
+        'flow'        : rng.poisson(3, nrows),
+        'rate'        : rng.random(nrows)
+    })
+
+
+def timeit(label, f, path, mb):
+    start = time.perf_counter()
+    f(path)
+    elapsed = time.perf_counter() - start
+    print("{:<24} {:>8.2f} s {:>10,.1f} MB/s {:>10,.1f} MB on disk"\
+            .format(label, elapsed, mb / elapsed, os.stat(path).st_size / 1e6))
+
+
+if __name__ == '__main__':
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+
+    flows = synthetic_flows(nrows)
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'flows.csv')
+
+        start = time.perf_counter()
+        flows.to_csv(path, index = False)
+        elapsed = time.perf_counter() - start
+        mb = os.stat(path).st_size / 1e6
+
+        print("{:<24} {:>8.2f} s {:>10,.1f} MB/s {:>10,.1f} MB on disk"\
+                .format("DataFrame.to_csv", elapsed, mb / elapsed, mb))
+
+        timeit("write_csv", lambda p: write_csv(flows, p), path, mb)
+        timeit("write_csv --precision 3",
+               lambda p: write_csv(flows, p, precision = 3), path, mb)
+        timeit("write_csv gzip", lambda p: write_csv(flows, p),
+               path + '.gz', mb)
+        timeit("write_csv zstd", lambda p: write_csv(flows, p),
+               path + '.zst', mb)
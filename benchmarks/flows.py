@@ -0,0 +1,64 @@
+"""
+Benchmark the flow engines of `anpr compute flows`.
+
+Times anprx's discretise_time + get_flows against the numpy engine on
+synthetic trip steps, at several period lengths.
+
+Usage:
+
+    python benchmarks/flows.py [nsteps] [ncameras]
+"""
+
+import sys
+import time
+
+import numpy     as np
+import pandas    as pd
+
+from anprx.flows import discretise_time
+from anprx.flows import get_flows
+
+from cli.compute.engine import compute_flows
+
+
+FREQS = ['1T', '5T', '15T', '1H']
+
+
+def synthetic_trips(nsteps, ncameras, seed = 0):
+    rng = np.random.default_rng(seed)
+    cameras = np.array(['c{}'.format(i) for i in range(ncameras)])
+    start = pd.Timestamp('2019-01-01') + \
+            pd.to_timedelta(rng.integers(0, 7 * 86400, nsteps), 's')
+    duration = pd.to_timedelta(rng.gamma(2, 150, nsteps).astype(int), 's')
+    return pd.DataFrame({
+        'origin'        : rng.choice(cameras, nsteps),
+        'destination'   : rng.choice(cameras, nsteps),
+        't_origin'      : start,
+        't_destination' : start + duration
+    })
+
+
+def timeit(f):
+    start = time.perf_counter()
+    result = f()
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    nsteps = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    ncameras = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    trips = synthetic_trips(nsteps, ncameras)
+
+    print("{:<6} {:>12} {:>12} {:>10}".format(
+        "freq", "anprx (s)", "numpy (s)", "speedup"))
+
+    for freq in FREQS:
+        before, _ = timeit(lambda: get_flows(discretise_time(
+            trips, freq = freq, apply_pthreshold = True)))
+
+        after, _ = timeit(lambda: compute_flows(
+            trips, freq = freq, apply_pthreshold = True).to_frame())
+
+        print("{:<6} {:>12.2f} {:>12.2f} {:>9.1f}x"\
+                .format(freq, before, after, before / after))
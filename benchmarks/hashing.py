@@ -0,0 +1,66 @@
+"""
+Benchmark plate anonymisation in `anpr wrangle raw-anpr`.
+
+Compares hashing every plate with hashlib against hashing only the unique
+plates of a batch, and reports plates hashed per second.
+
+Usage:
+
+    python benchmarks/hashing.py [nrows] [nvehicles]
+"""
+
+import sys
+import time
+import hashlib
+
+import numpy     as np
+import pandas    as pd
+
+from cli.wrangle.data import anonymise_plates
+
+
+def synthetic_plates(nrows, nvehicles, seed = 0):
+    rng = np.random.default_rng(seed)
+    letters = np.array(list('ABCDEFGHJKLMNOPRSTUVWXYZ'))
+    fleet = pd.Series([
+        ''.join(rng.choice(letters, 2)) + '{:02d}'.format(i % 100) +
+        ''.join(rng.choice(letters, 3))
+        for i in range(nvehicles)
+    ])
+    # Some vehicles are observed much more often than others
+    weights = rng.pareto(1.5, nvehicles) + 1
+    return fleet.sample(nrows, replace = True, weights = weights,
+                        random_state = seed).reset_index(drop = True)
+
+
+def timeit(label, f, nrows):
+    start = time.perf_counter()
+    result = f()
+    elapsed = time.perf_counter() - start
+    print("{:<12} {:>8.2f} s {:>14,.0f} plates/s"\
+            .format(label, elapsed, nrows / elapsed))
+    return result
+
+
+if __name__ == '__main__':
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    nvehicles = int(sys.argv[2]) if len(sys.argv) > 2 else 500000
+
+    salt = b'benchmark'
+
+    print("Generating {:,} synthetic plates of {:,} vehicles..."\
+            .format(nrows, nvehicles))
+    plates = synthetic_plates(nrows, nvehicles)
+
+    before = timeit(
+        "per plate",
+        lambda: plates.map(lambda x: hashlib.blake2b(
+            x.encode(), digest_size = 10, salt = salt).hexdigest()),
+        nrows)
+
+    after = timeit(
+        "unique",
+        lambda: anonymise_plates(plates, digest_size = 10, digest_salt = salt),
+        nrows)
+
+    assert before.equals(after)
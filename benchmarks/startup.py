@@ -0,0 +1,78 @@
+"""
+Benchmark the startup time of the `anpr` CLI.
+
+Times `anpr --help` and `--help` of every group and subcommand, each in a
+fresh python process, and reports the median wall time of several runs along
+with the heavy modules that each of them imported.
+
+Usage:
+
+    python benchmarks/startup.py [runs]
+"""
+
+import sys
+import time
+import subprocess
+import statistics
+
+from cli.anpr import cli
+
+
+HEAVY_MODULES = ['anprx', 'osmnx', 'networkx', 'geopandas', 'fiona', 'pyarrow']
+
+RUN = ("import sys; sys.argv[0] = 'anpr'; from cli.anpr import cli\n"
+       "try:\n"
+       "    cli(standalone_mode = False)\n"
+       "finally:\n"
+       "    print('\\nIMPORTED', ','.join(m for m in {!r} if m in sys.modules))")
+
+
+def commands():
+    """Arguments of --help for the main group, each group and subcommand."""
+    yield []
+
+    for group_name in cli.list_commands(None):
+        group = cli.get_command(None, group_name)
+        if group is None:
+            continue
+
+        yield [group_name]
+
+        for name in group.list_commands(None):
+            yield [group_name, name]
+
+
+def run(args, runs):
+    times = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, '-c', RUN.format(HEAVY_MODULES)] + args + ['--help'],
+            stdout = subprocess.PIPE,
+            stderr = subprocess.DEVNULL,
+            universal_newlines = True
+        )
+        times.append(time.perf_counter() - start)
+
+    if output.returncode != 0:
+        return statistics.median(times), 'failed'
+
+    imported = output.stdout.rsplit('IMPORTED', 1)[-1].strip()
+
+    return statistics.median(times), imported
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        subprocess.run([sys.executable, '-c', 'pass'])
+    print("{:<32} {:>8.3f} s".format(
+        'python (baseline)', (time.perf_counter() - start) / runs))
+
+    for args in commands():
+        median, imported = run(args, runs)
+        print("{:<32} {:>8.3f} s   {}".format(
+            ' '.join(['anpr'] + args + ['--help']), median, imported or '-'))
@@ -0,0 +1,59 @@
+"""
+Benchmark timestamp parsing in `anpr wrangle raw-anpr`.
+
+Compares the per-row strptime parser against the vectorised parser on a
+synthetic csv column of timestamps, and reports rows parsed per second.
+
+Usage:
+
+    python benchmarks/timestamps.py [nrows]
+"""
+
+import sys
+import time
+from datetime import datetime
+
+import numpy     as np
+import pandas    as pd
+
+from cli.wrangle.data import parse_timestamps
+
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def synthetic_timestamps(nrows, seed = 0):
+    rng = np.random.default_rng(seed)
+    start = np.datetime64('2019-01-01T00:00:00')
+    offsets = rng.integers(0, 30 * 24 * 3600 * 1000, size = nrows)
+    timestamps = pd.Series(start + offsets.astype('timedelta64[ms]'))
+    return timestamps.dt.strftime(DATE_FORMAT)
+
+
+def timeit(label, f, nrows):
+    start = time.perf_counter()
+    result = f()
+    elapsed = time.perf_counter() - start
+    print("{:<12} {:>8.2f} s {:>14,.0f} rows/s"\
+            .format(label, elapsed, nrows / elapsed))
+    return result
+
+
+if __name__ == '__main__':
+    nrows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+
+    print("Generating {:,} synthetic timestamps...".format(nrows))
+    timestamps = synthetic_timestamps(nrows)
+
+    before = timeit(
+        "strptime",
+        lambda: pd.to_datetime(timestamps.map(
+            lambda x: datetime.strptime(x, DATE_FORMAT))),
+        nrows)
+
+    after = timeit(
+        "vectorised",
+        lambda: parse_timestamps(timestamps, DATE_FORMAT),
+        nrows)
+
+    assert before.equals(after)
@@ -1,16 +1,13 @@
 """anpr-cli: A CLI for pre-processing and analysing batches of ANPR data."""
 
+import os
+import sys
+import ast
 import click
-import anprx
+import importlib
+import importlib.util
 
-from .wrangle import cameras        as cameras
-from .wrangle import network        as network
-from .wrangle import data           as data
-from .compute import flows          as flows
-from .compute import trips          as trips
-from .compute import displacement   as displacement
-from .convert import network        as convert_network
-from .convert import any            as convert_any
+from .         import profiling
 
 
 # Custom class so that we can change the order of subcommands as diplayed
@@ -22,18 +19,114 @@ class PipelineCLI(click.Group):
         return ['wrangle', 'convert', 'compute', 'explore']
 
 
-class WranglePipeline(click.Group):
-    def list_commands(self, ctx):
-        """A CLI for wrangling and analysing batches of ANPR data."""
-        # original value --> return sorted(self.commands)
-        return ['cameras', 'network', 'merge', 'camera-pairs', 'nodes',
-                'expert-pairs', 'raw-anpr', 'amenities']
+class LazyGroup(click.Group):
+    """
+    Group whose subcommands are only imported when they are invoked.
+
+    Subcommand modules import heavy dependencies (anprx, osmnx, geopandas,
+    fiona), so importing all of them makes every call of the CLI slow.
+    lazy_subcommands maps the name of each subcommand to the module and
+    attribute that define it, in the order they are listed in the help.
+    The help of the group reads their short help from the source of their
+    modules instead of importing them. anprx is loaded and configured when a
+    subcommand is invoked, except those in without_anprx, which never use
+    it.
+    """
+
+    def __init__(
+        self,
+        *args,
+        lazy_subcommands = None,
+        without_anprx = (),
+        **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands or {}
+        self.without_anprx = set(without_anprx)
 
-class ComputePipeline(click.Group):
     def list_commands(self, ctx):
-        """A CLI for transforming and aggregating wrangled ANPR data."""
-        # original value --> return sorted(self.commands)
-        return ['avspeed', 'trips', 'displacement', 'flows']
+        return list(self.lazy_subcommands) + \
+               sorted(set(self.commands) - set(self.lazy_subcommands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.lazy_subcommands:
+            return super().get_command(ctx, cmd_name)
+
+        module, attribute = self.lazy_subcommands[cmd_name].rsplit('.', 1)
+
+        return getattr(importlib.import_module(module, __package__),
+                       attribute)
+
+    def resolve_command(self, ctx, args):
+        cmd_name, command, args = super().resolve_command(ctx, args)
+
+        # Some commands only import anprx once they run, so it's configured
+        # here rather than when it's first imported
+        configure_anprx(ctx, load = cmd_name not in self.without_anprx)
+
+        return cmd_name, command, args
+
+    def format_commands(self, ctx, formatter):
+        names = self.list_commands(ctx)
+        if len(names) == 0:
+            return
+
+        limit = formatter.width - 6 - max(len(name) for name in names)
+
+        rows = []
+        for name in names:
+            if name in self.lazy_subcommands:
+                rows.append((name, self.lazy_short_help(name, limit)))
+                continue
+
+            command = self.get_command(ctx, name)
+            if command is not None and not command.hidden:
+                rows.append((name, command.get_short_help_str(limit)))
+
+        with formatter.section('Commands'):
+            formatter.write_dl(rows)
+
+    def lazy_short_help(self, cmd_name, limit):
+        """
+        Short help of a lazy subcommand, from the docstring of the function
+        that defines it, which is parsed from the source of its module.
+        """
+        module, attribute = self.lazy_subcommands[cmd_name].rsplit('.', 1)
+        spec = importlib.util.find_spec(module, __package__)
+
+        with open(spec.origin, 'rb') as f:
+            tree = ast.parse(f.read())
+
+        for node in tree.body:
+            if isinstance(node, ast.FunctionDef) and node.name == attribute:
+                help = (ast.get_docstring(node) or '').split('\f')[0]
+                return click.utils.make_default_short_help(help, limit)
+
+        return ''
+
+
+def configure_anprx(ctx, load = False):
+    """
+    Configure anprx with the options of the main group.
+
+    anprx is only imported by the commands that use it, so it's configured
+    when the first of these is invoked rather than at startup. Unless load
+    is set, anprx is only configured if it's already been imported.
+    """
+    options = None if ctx is None else ctx.find_root().obj
+
+    if options is None or options.get('anprx_configured') or \
+       (not load and 'anprx' not in sys.modules):
+        return
+
+    import anprx.utils
+
+    anprx.utils.config(
+        app_folder = options['app_folder'],
+        log_to_console = not options['quiet'],
+        cache_http = True
+    )
+    options['anprx_configured'] = True
 
 # Main group - entry point
 @click.option("--quiet", "-q",
@@ -47,44 +140,78 @@ class ComputePipeline(click.Group):
               show_default = True,
               help = "Path to work directory (logs, images, files)"
 )
+@click.option("--profile",
+              is_flag = True,
+              default = False,
+              help = ("Record wall time, cpu time and peak memory of each "
+                      "phase of the command (read, transform, anprx, write) "
+                      "to a json file in app_folder/profiles.")
+)
+@click.option("--profile-stats",
+              is_flag = True,
+              default = False,
+              help = ("Also run cProfile and write its stats next to the json "
+                      "file, for inspection with pstats or snakeviz.")
+)
 @click.group(cls=PipelineCLI)
-def cli(quiet, app_folder):
-    anprx.utils.config(
-        app_folder = app_folder,
-        log_to_console = not quiet,
-        cache_http = True
-    )
+@click.pass_context
+def cli(ctx, quiet, app_folder, profile, profile_stats):
+    ctx.obj = {'app_folder' : app_folder, 'quiet' : quiet}
+
+    configure_anprx(ctx)
+
+    if profile or profile_stats:
+        profiler = profiling.enable(cprofile = profile_stats)
+
+        def write_profile():
+            path = profiler.write(os.path.join(app_folder, 'profiles'))
+            if not quiet:
+                click.echo("Wrote profile to {}".format(path), err = True)
+
+        ctx.call_on_close(write_profile)
 
 # Data wrangling operations
-@cli.group(cls=WranglePipeline)
+@cli.group(
+    cls = LazyGroup,
+    lazy_subcommands = {
+        'cameras'      : '.wrangle.cameras.cameras',
+        'network'      : '.wrangle.network.network',
+        'merge'        : '.wrangle.network.merge',
+        'camera-pairs' : '.wrangle.network.camera_pairs',
+        'nodes'        : '.wrangle.cameras.nodes',
+        'expert-pairs' : '.wrangle.cameras.expert_pairs',
+        'raw-anpr'     : '.wrangle.data.raw_anpr',
+        'amenities'    : '.wrangle.network.amenities'
+    }
+)
 def wrangle():
     """Pre-process and wrangle raw data."""
     pass
 
 # Summarise operations, e.g.: compute flows
-@cli.group(cls=ComputePipeline)
+@cli.group(
+    cls = LazyGroup,
+    lazy_subcommands = {
+        'avspeed'      : '.compute.trips.avspeed',
+        'trips'        : '.compute.trips.trips',
+        'displacement' : '.compute.displacement.displacement',
+        'flows'        : '.compute.flows.flows'
+    }
+)
 def compute():
     """Identify trips in wrangled data and summarise it into traffic flows."""
     pass
 
 # Convert between file types
-@cli.group()
+@cli.group(
+    cls = LazyGroup,
+    lazy_subcommands = {
+        'network'      : '.convert.network.network',
+        'graph'        : '.convert.network.graph',
+        'pkl'          : '.convert.any.pkl'
+    },
+    without_anprx = ['pkl']
+)
 def convert():
     """Convert between different file types."""
     pass
-
-
-wrangle.add_command(cameras.cameras)
-wrangle.add_command(cameras.nodes)
-wrangle.add_command(cameras.expert_pairs)
-wrangle.add_command(network.network)
-wrangle.add_command(network.merge)
-wrangle.add_command(network.camera_pairs)
-wrangle.add_command(network.amenities)
-wrangle.add_command(data.raw_anpr)
-compute.add_command(trips.trips)
-compute.add_command(trips.avspeed)
-compute.add_command(flows.flows)
-compute.add_command(displacement.displacement)
-convert.add_command(convert_network.network)
-convert.add_command(convert_any.pkl)
@@ -2,7 +2,29 @@ import click
 
 from anprx.trips import all_ods_displacement
 
+from ..files     import formats
+from ..files     import compressions
+from ..files     import read_frame
+from ..files     import frame_size
+from ..files     import write_frame
+from ..files     import replace_frame
+from ..files     import infer_format
+from ..datasets  import is_dataset
+from ..ids       import id_attrs
+from ..ids       import with_id_attrs
+from ..profiling import phase
+from ..filters   import filter_options
+from ..filters   import parse_cameras
+from ..filters   import parse_pairs
+from ..filters   import camera_filters
+from ..filters   import is_filtered
+
+from anprx.utils import log
+
 import os
+import time
+import multiprocessing as mp
+import logging   as lg
 import numpy     as np
 import pandas    as pd
 import geopandas as gpd
@@ -36,29 +58,228 @@ import geopandas as gpd
     show_default = True,
     help = "Parallelise calculation."
 )
+@click.option(
+    '--workers',
+    default = None,
+    type = click.IntRange(min = 1),
+    required = False,
+    help = ("Number of processes used to compute displacements. "
+            "Defaults to the number of cpus, or 1 with --not-parallel.")
+)
+@click.option(
+    '--chunk-size',
+    default = 100,
+    type = click.IntRange(min = 1),
+    show_default = True,
+    required = False,
+    help = "Number of origin-destination pairs sent to a worker at a time."
+)
+@click.option(
+    '--format',
+    type = click.Choice(formats),
+    default = None,
+    required = False,
+    help = ("Format of output file. "
+            "Inferred from the output file extension by default. Without "
+            "--output, the input file keeps its format.")
+)
+@click.option(
+    '--compression',
+    type = click.Choice(compressions),
+    default = 'snappy',
+    show_default = True,
+    required = False,
+    help = "Compression codec used when writing parquet files."
+)
+@filter_options
 @click.command()
 def displacement(
     input_pkl,
     buffer_size,
     parallel,
-    output
+    workers,
+    chunk_size,
+    output,
+    format,
+    compression,
+    start,
+    end,
+    cameras,
+    pairs
 ):
     """
     Calculate vehicle displacements.
+
+    Displacements are computed independently for each origin-destination
+    pair, in chunks of --chunk-size pairs, over a pool of --workers processes.
+    Each worker receives the trips once, at startup.
+
+    Without --output, the displacement column is added to the input file,
+    which is replaced only once the output has been written in full.
+
+    Trip steps outside of --start and --end, or that don't match --cameras
+    and --pairs, are filtered as they are read, which for parquet and
+    feather files skips row groups that can't match. Filters require
+    --output.
+
+    INPUT_PKL can also be a dataset of trips (see compute trips --dataset),
+    of which only the partitions that match the filters are read, in
+    parallel. Datasets require --output.
     """
+    if is_filtered(start, end, cameras, pairs) and not output:
+        raise click.BadParameter(
+            "--start, --end, --cameras and --pairs require --output, so "
+            "that the input file isn't replaced with part of it",
+            param_hint = '--output')
 
-    click.echo(("Reading input pkl file of size {:,.2f} MB.")\
-            .format(os.stat(input_pkl).st_size/1e6))
+    if is_dataset(input_pkl) and not output:
+        raise click.BadParameter(
+            "Datasets of trips can only be read with --output",
+            param_hint = '--output')
 
+    if format is not None and not output and \
+       format != infer_format(input_pkl):
+        raise click.BadParameter(
+            "The input file is replaced in its own format, use --output "
+            "to write a {} file".format(format),
+            param_hint = '--format')
 
-    df = pd.read_pickle(input_pkl)
+    if workers is None:
+        workers = mp.cpu_count() if parallel else 1
 
-    df = all_ods_displacement(df, buffer_size, parallel)
+    click.echo(("Reading input file of size {:,.2f} MB.")\
+            .format(frame_size(input_pkl)/1e6))
 
-    if output:
-        df.to_pickle(output)
-    else:
-        # write to same input to save space
-        df.to_pickle(input_pkl)
+
+    with phase('read'):
+        df = read_frame(input_pkl,
+                        time_column = ('t_origin', 't_destination'),
+                        start = start,
+                        end = end,
+                        filters = camera_filters(parse_cameras(cameras),
+                                                 parse_pairs(pairs),
+                                                 ('origin', 'destination')))
+
+    with phase('anprx'):
+        attrs = id_attrs(df)
+        df = with_id_attrs(
+            parallel_displacement(df, buffer_size, workers, chunk_size),
+            attrs)
+
+    with phase('write'):
+        if output:
+            write_frame(df, output, format, compression)
+        else:
+            # write to same input to save space
+            replace_frame(df, input_pkl, infer_format(input_pkl),
+                          compression)
 
     return 0
+
+
+def parallel_displacement(trips, buffer_size, workers = 1, chunk_size = 100):
+    """
+    Compute the displacement of trips over a process pool.
+
+    Displacement only depends on the trips of the same origin-destination
+    pair, so trips are sorted by pair and each chunk of chunk_size pairs is
+    processed on its own (with a single worker, all pairs are processed at
+    once). Trips with a missing origin or destination have no displacement,
+    with any number of workers. The rows are returned in their
+    original order.
+    """
+    trips = trips.reset_index(drop = True)
+
+    has_od = (trips['origin'].notna() & trips['destination'].notna()).values
+    with_od = trips[has_od]
+
+    od = with_od.groupby(['origin', 'destination'], sort = False).ngroup()
+    order = np.argsort(od.values, kind = 'mergesort')
+    with_od = with_od.iloc[order]
+
+    # Row offsets of every chunk of chunk_size pairs, or of a single chunk
+    # of all pairs without workers
+    first_rows = np.flatnonzero(np.diff(od.values[order], prepend = -1))
+    bounds = np.append(first_rows[::chunk_size] if workers > 1 \
+                       else first_rows[:1], len(with_od))
+    tasks = list(zip(bounds[:-1], bounds[1:]))
+
+    log(("Computing displacement of {:,} trips in {:,} origin-destination "
+         "pairs, in {:,} chunks using {} workers.")\
+            .format(len(with_od), len(first_rows), len(tasks), workers),
+        level = lg.INFO)
+
+    start_time = time.time()
+    results = []
+
+    if workers == 1:
+        init_displacement_worker(with_od, buffer_size)
+        results = [displacement_chunk(task) for task in tasks]
+    else:
+        with mp.Pool(
+            processes = min(workers, max(len(tasks), 1)),
+            initializer = init_displacement_worker,
+            initargs = (with_od, buffer_size)
+        ) as pool:
+            with click.progressbar(
+                pool.imap_unordered(displacement_chunk, tasks),
+                length = len(tasks),
+                label = "Displacement"
+            ) as chunks:
+                for chunk in chunks:
+                    results.append(chunk)
+
+    elapsed = time.time() - start_time
+
+    log(("Computed displacement of {:,} trips in {:,.2f} seconds "
+         "({:,.0f} trips/s).")\
+            .format(len(with_od), elapsed, len(with_od) / max(elapsed, 1e-9)),
+        level = lg.INFO)
+
+    without_od = trips[~has_od]
+    without_od = without_od.assign(**{_row : without_od.index.values})
+
+    return pd.concat(results + [without_od], sort = False)\
+        .sort_values(_row, kind = 'mergesort')\
+        .drop(columns = _row)\
+        .reset_index(drop = True)
+
+
+_row = '__row'
+
+_displacement_worker = {}
+
+
+def init_displacement_worker(trips, buffer_size):
+    _displacement_worker.update(trips = trips, buffer_size = buffer_size)
+
+
+def displacement_chunk(bounds):
+    """
+    Displacement of the trips in a chunk of rows, with their original row
+    number in the _row column.
+
+    The row number is added as a column and kept in the index. If anprx drops
+    the column, the index is used instead, as long as it still holds every row
+    of the chunk once.
+    """
+    start, end = bounds
+    trips = _displacement_worker['trips'].iloc[start:end]
+
+    trips = trips.assign(**{_row : trips.index.values})
+
+    displaced = all_ods_displacement(
+        trips,
+        _displacement_worker['buffer_size'],
+        False
+    )
+
+    if _row not in displaced.columns:
+        if len(displaced) != len(trips) or \
+           not displaced.index.sort_values().equals(trips.index.sort_values()):
+            raise ValueError(
+                "anprx's displacement lost the row numbers of the trips")
+
+        displaced[_row] = displaced.index.values
+
+    return displaced.reset_index(drop = True)
@@ -0,0 +1,479 @@
+"""
+Vectorised engine for discretising trip steps in time and counting flows.
+
+Trip steps are never expanded into one row per period they overlap. Instead,
+each step contributes two events to a difference array: +1 in the first
+period it counts towards and -1 after the last one. Flows are then the
+cumulative sum of these events, stored sparsely (in coordinate format) as
+the non-zero (pair, period, flow) triples. Memory is therefore proportional
+to the number of trip steps plus the number of non-zero flows.
+"""
+
+import os
+import json
+import numpy     as np
+import pandas    as pd
+
+from pandas.tseries.frequencies import to_offset
+
+from ..files     import read_frame
+from ..files     import write_frame
+
+
+def freq_nanos(freq):
+    """
+    Length in nanoseconds of a fixed frequency string (e.g. '5min', '1h').
+
+    Raises a ValueError that tells apart frequencies that can't be parsed,
+    those of variable length (e.g. weeks anchored on a day, or months) and
+    those that aren't positive.
+    """
+    try:
+        offset = to_offset(freq)
+    except ValueError as e:
+        raise ValueError("Frequency '{}' can't be parsed: {}".format(freq, e))
+
+    try:
+        nanos = offset.nanos
+    except ValueError:
+        raise ValueError(("Frequency '{}' does not have a fixed length "
+                          "(e.g. months), which the numpy engine requires.")\
+                            .format(freq))
+
+    if nanos <= 0:
+        raise ValueError("Frequency '{}' must be positive".format(freq))
+
+    return nanos
+
+
+class SparseFlows:
+    """
+    Flows between camera pairs in coordinate format.
+
+    pairs is a dataframe of (origin, destination) camera pairs, whose
+    position is the pair code. pair, period and flow are equal length arrays
+    with the pair code, the period number (time since the epoch divided by
+    the period length) and the flow of each non-zero combination.
+
+    Flows are always stored unexpanded. expanded records that they were
+    asked for with every combination, including zero flows (see compute
+    flows --expand), which to_frame then returns lazily, with expand.
+    """
+
+    def __init__(self, pairs, freq, pair, period, flow, expanded = False):
+        self.pairs  = pairs.reset_index(drop = True)
+        self.freq   = freq
+        self.pair   = pair
+        self.period = period
+        self.flow   = flow
+
+        self.expanded = expanded
+
+        self.sorted_by_period = False
+
+    @property
+    def nanos(self):
+        return freq_nanos(self.freq)
+
+    def periods(self, start = None, end = None):
+        """
+        Every period between the first and last non-zero flow.
+
+        If given, only periods from the one containing start up to (and
+        excluding) the one containing end are returned.
+        """
+        if len(self.period) == 0:
+            return np.array([], dtype = np.int64)
+
+        first = self.period.min() if start is None else \
+                self.to_period(start)
+        last = self.period.max() + 1 if end is None else \
+               self.to_period(end)
+
+        return np.arange(first, last)
+
+    def to_period(self, timestamp):
+        return pd.Timestamp(timestamp).value // self.nanos
+
+    def to_timestamps(self, period):
+        return pd.to_datetime(np.asarray(period, dtype = np.int64) * self.nanos)
+
+    def to_frame(self, expand = None):
+        """
+        Flows as a dataframe (origin, destination, period, flow).
+
+        Only non-zero flows are returned, unless expand (which defaults to
+        expanded) is set.
+        """
+        if self.expanded if expand is None else expand:
+            return self.expand()
+
+        return pd.DataFrame({
+            'origin'      : self.pairs['origin'].values[self.pair],
+            'destination' : self.pairs['destination'].values[self.pair],
+            'period'      : self.to_timestamps(self.period),
+            'flow'        : self.flow
+        })
+
+    def dense(self, start = None, end = None):
+        """
+        Flows as a dense (pairs x periods) array.
+
+        Use start and end to only densify a slice of time (see periods).
+        """
+        periods = self.periods(start, end)
+        flows = np.zeros((len(self.pairs), len(periods)), dtype = np.int64)
+
+        if len(periods) > 0:
+            pair, period, flow = self.pair, self.period, self.flow
+
+            if self.sorted_by_period:
+                # Only load the flows within the slice
+                lo, hi = np.searchsorted(period, [periods[0], periods[-1] + 1])
+                pair, period, flow = pair[lo:hi], period[lo:hi], flow[lo:hi]
+            else:
+                inside = (period >= periods[0]) & (period <= periods[-1])
+                pair, period, flow = pair[inside], period[inside], flow[inside]
+
+            flows[pair, period - periods[0]] = flow
+
+        return flows
+
+    def sort_by_period(self):
+        """Sort flows by period, so that slices of time can be found quickly."""
+        order = np.lexsort((self.pair, self.period))
+
+        flows = SparseFlows(self.pairs, self.freq, self.pair[order],
+                            self.period[order], self.flow[order],
+                            self.expanded)
+        flows.sorted_by_period = True
+
+        return flows
+
+    def write(self, path):
+        """
+        Write flows to a directory, as the pairs dimension table (a parquet
+        file) plus one .npy file per coordinate array.
+        """
+        os.makedirs(path, exist_ok = True)
+
+        write_frame(self.pairs, os.path.join(path, 'pairs.parquet'),
+                    'parquet')
+
+        flows = self.sort_by_period()
+        np.save(os.path.join(path, 'pair.npy'), flows.pair)
+        np.save(os.path.join(path, 'period.npy'), flows.period)
+        np.save(os.path.join(path, 'flow.npy'), flows.flow)
+
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'freq' : self.freq, 'expanded' : self.expanded}, f)
+
+    @classmethod
+    def read(cls, path, mmap = True):
+        """
+        Read flows written by SparseFlows.write.
+
+        The coordinate arrays are memory-mapped, so that dense slices of time
+        only load the flows they need.
+        """
+        mmap_mode = 'r' if mmap else None
+
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        flows = cls(
+            read_frame(os.path.join(path, 'pairs.parquet')),
+            meta['freq'],
+            np.load(os.path.join(path, 'pair.npy'), mmap_mode = mmap_mode),
+            np.load(os.path.join(path, 'period.npy'), mmap_mode = mmap_mode),
+            np.load(os.path.join(path, 'flow.npy'), mmap_mode = mmap_mode),
+            meta.get('expanded', False)
+        )
+        flows.sorted_by_period = True
+
+        return flows
+
+    def expand(self):
+        """
+        Flows as a dataframe with every (origin, destination, period)
+        combination, including zero flows.
+        """
+        periods = self.periods()
+        npairs, nperiods = len(self.pairs), len(periods)
+
+        return pd.DataFrame({
+            'origin'      : np.repeat(self.pairs['origin'].values, nperiods),
+            'destination' : np.repeat(self.pairs['destination'].values,
+                                      nperiods),
+            'period'      : np.tile(self.to_timestamps(periods), npairs),
+            'flow'        : self.dense().ravel()
+        })
+
+
+def step_periods(
+    t_start,
+    t_end,
+    nanos,
+    apply_pthreshold = False,
+    pthreshold = 0.02,
+    same_period = False
+):
+    """
+    First and last period that each trip step counts towards.
+
+    Steps count towards every period their travel interval [start, end)
+    overlaps. With same_period, steps only count towards the period in which
+    they start. With apply_pthreshold, a step only counts towards a period if
+    it overlaps at least pthreshold of its length. Steps that count towards
+    no period have first > last.
+    """
+    start = t_start.astype(np.int64)
+    end = np.maximum(t_end.astype(np.int64), start)
+
+    first = start // nanos
+
+    if same_period:
+        return first, first.copy()
+
+    # Intervals are half open, a step ending exactly at the start of a period
+    # doesn't overlap it
+    last = np.maximum(end - 1, start) // nanos
+
+    if not apply_pthreshold:
+        return first, last
+
+    min_overlap = pthreshold * nanos
+    duration = end - start
+
+    single = first == last
+    first_overlap = np.where(single, duration, (first + 1) * nanos - start)
+    last_overlap = np.where(single, duration, end - last * nanos)
+
+    first = first + (first_overlap < min_overlap)
+    last = last - (last_overlap < min_overlap)
+
+    return first, last
+
+
+def count_flows(pair, first, last):
+    """
+    Count flows per (pair, period), given the first and last period of steps.
+
+    Returns the pair, period and flow arrays of the non-zero combinations,
+    sorted by pair and period.
+    """
+    keep = first <= last
+    pair, first, last = pair[keep], first[keep], last[keep]
+
+    if len(pair) == 0:
+        empty = np.array([], dtype = np.int64)
+        return empty, empty.copy(), empty.copy()
+
+    offset = first.min()
+    width = last.max() - offset + 2
+
+    # Difference array, keyed by (pair, period)
+    keys = np.concatenate([pair * width + (first - offset),
+                           pair * width + (last + 1 - offset)])
+    deltas = np.concatenate([np.ones(len(pair), dtype = np.int64),
+                             -np.ones(len(pair), dtype = np.int64)])
+
+    order = np.argsort(keys, kind = 'mergesort')
+    keys, deltas = keys[order], deltas[order]
+
+    is_new = np.ones(len(keys), dtype = bool)
+    is_new[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(is_new)
+
+    keys = keys[starts]
+    deltas = np.add.reduceat(deltas, starts)
+
+    # Events of each pair add up to zero, so a single cumulative sum over
+    # all pairs never carries flows from one pair into the next
+    flows = np.cumsum(deltas)
+
+    # Each event key starts a run of periods with the same flow, that ends
+    # at the next event key
+    run_start = keys[:-1]
+    run_length = keys[1:] - keys[:-1]
+    run_flow = flows[:-1]
+
+    nonzero = run_flow > 0
+    run_start = run_start[nonzero]
+    run_length = run_length[nonzero]
+    run_flow = run_flow[nonzero]
+
+    run_offsets = np.cumsum(run_length) - run_length
+    within_run = np.arange(run_length.sum()) - np.repeat(run_offsets,
+                                                         run_length)
+
+    cell = np.repeat(run_start, run_length) + within_run
+
+    return (cell // width,
+            cell % width + offset,
+            np.repeat(run_flow, run_length))
+
+
+class TripSteps:
+    """
+    Trip steps reduced to what's needed to count flows.
+
+    pairs is a dataframe of (origin, destination) camera pairs, whose
+    position is the pair code. pair, start and end are equal length arrays
+    with the pair code and the start and end time (in nanoseconds since the
+    epoch) of each step.
+    """
+
+    columns = ['origin', 'destination', 't_origin', 't_destination']
+    """Columns of trips needed to count flows."""
+
+    def __init__(self, pairs, pair, start, end):
+        self.pairs = pairs
+        self.pair  = pair
+        self.start = start
+        self.end   = end
+
+    @classmethod
+    def from_trips(cls, trips, remove_na = False):
+        """
+        Trips must have the columns origin, destination, t_origin and
+        t_destination. Steps with a missing origin or destination (the first
+        and last steps of each trip) happen at a single point in time, and are
+        dropped if remove_na is set.
+        """
+        grouped = trips.groupby(['origin', 'destination'],
+                                sort = True, dropna = remove_na)
+
+        codes = grouped.ngroup()
+        pairs = grouped.size().index.to_frame(index = False)
+
+        has_pair = codes.notna().values & (codes.values >= 0)
+        steps = trips[has_pair]
+        pair = codes.values[has_pair].astype(np.int64)
+
+        # Steps without an origin or destination only have one timestamp
+        t_start = steps['t_origin'].fillna(steps['t_destination'])
+        t_end = steps['t_destination'].fillna(steps['t_origin'])
+
+        has_time = t_start.notna().values
+
+        return cls(
+            pairs,
+            pair[has_time],
+            t_start.values[has_time].astype('datetime64[ns]').astype(np.int64),
+            t_end.values[has_time].astype('datetime64[ns]').astype(np.int64)
+        )
+
+    def flows(
+        self,
+        freq = "5T",
+        apply_pthreshold = False,
+        pthreshold = 0.02,
+        same_period = False
+    ):
+        """Count flows in periods of length freq."""
+        first, last = step_periods(
+            self.start,
+            self.end,
+            freq_nanos(freq),
+            apply_pthreshold = apply_pthreshold,
+            pthreshold = pthreshold,
+            same_period = same_period
+        )
+
+        pair, period, flow = count_flows(self.pair, first, last)
+
+        return SparseFlows(self.pairs, freq, pair, period, flow)
+
+
+def compute_flows(
+    trips,
+    freq = "5T",
+    apply_pthreshold = False,
+    pthreshold = 0.02,
+    same_period = False,
+    remove_na = False
+):
+    """
+    Compute flows between camera pairs from trip steps.
+
+    See TripSteps.from_trips for the columns trips must have.
+    """
+    # Fail early on invalid frequencies
+    freq_nanos(freq)
+
+    return TripSteps.from_trips(trips, remove_na = remove_na).flows(
+        freq,
+        apply_pthreshold = apply_pthreshold,
+        pthreshold = pthreshold,
+        same_period = same_period
+    )
+
+
+def rollup(flows, freq):
+    """
+    Sum flows into periods of length freq, a multiple of the current one.
+
+    This is only equivalent to counting flows from scratch when each step
+    counts towards a single period (same_period).
+    """
+    ratio, remainder = divmod(freq_nanos(freq), flows.nanos)
+
+    if remainder != 0 or ratio < 1:
+        raise ValueError("Can't roll up flows of frequency '{}' into '{}'"\
+                            .format(flows.freq, freq))
+
+    # Periods are aligned with the epoch, so coarser periods are obtained by
+    # integer division of finer ones
+    period = flows.period // ratio
+    width = (period.max() + 1) if len(period) > 0 else 1
+
+    cell, inverse = np.unique(flows.pair * width + period,
+                              return_inverse = True)
+    flow = np.bincount(inverse.ravel(), weights = flows.flow)\
+             .astype(np.int64)
+
+    return SparseFlows(flows.pairs, freq, cell // width, cell % width, flow)
+
+
+def multi_resolution_flows(
+    trips,
+    freqs,
+    apply_pthreshold = False,
+    pthreshold = 0.02,
+    same_period = False,
+    remove_na = False
+):
+    """
+    Compute flows at several resolutions in a single pass.
+
+    Trip steps are prepared once, and flows are yielded as (freq, SparseFlows)
+    pairs from the finest resolution to the coarsest, as soon as each one is
+    computed. With same_period, flows at each resolution are rolled up from
+    the finest one computed so far of which it's a multiple. Otherwise,
+    steps may count towards several periods, so flows are counted again from
+    the prepared steps for each resolution.
+    """
+    steps = TripSteps.from_trips(trips, remove_na = remove_na)
+
+    kwargs = dict(
+        apply_pthreshold = apply_pthreshold,
+        pthreshold = pthreshold,
+        same_period = same_period
+    )
+
+    computed = []
+
+    for freq in sorted(freqs, key = freq_nanos):
+        base = None
+        if same_period:
+            base = next((flows for flows in computed
+                         if freq_nanos(freq) % flows.nanos == 0), None)
+
+        if base is not None:
+            flows = rollup(base, freq)
+        else:
+            flows = steps.flows(freq, **kwargs)
+            computed.append(flows)
+
+        yield freq, flows
@@ -5,12 +5,35 @@ from anprx.flows import get_flows
 from anprx.flows import expand_flows
 from anprx.utils import log
 
+from ..files     import compressions
+from ..files     import read_frame
+from ..files     import frame_size
+from ..files     import write_frame
+from ..files     import write_csv
+from ..ids       import id_attrs
+from ..ids       import with_id_attrs
+from ..ids       import decode_ids
+from ..profiling import phase
+from ..filters   import filter_options
+from ..filters   import parse_cameras
+from ..filters   import parse_pairs
+from ..filters   import camera_filters
+
+from .engine     import multi_resolution_flows
+from .engine     import freq_nanos
+from .engine     import TripSteps
+from .engine     import SparseFlows
+
 import os
 import numpy     as np
 import pandas    as pd
 import geopandas as gpd
 import logging   as lg
 
+
+step_times = ('t_origin', 't_destination')
+
+
 @click.argument(
     'output',
     type=str
@@ -21,11 +44,38 @@ import logging   as lg
 )
 @click.option(
     '--output-format',
-    type=click.Choice(['csv','pkl']),
+    type=click.Choice(['csv','pkl','parquet','sparse']),
     default = 'pkl',
     show_default = True,
     required = False,
-    help = ("Format of output file.")
+    help = ("Format of output file. The sparse format (numpy engine only) "
+            "writes a directory with only the non-zero flows and the table "
+            "of camera pairs, from which zero flows are implied, with or "
+            "without --expand.")
+)
+@click.option(
+    '--compression',
+    type = click.Choice(compressions),
+    default = 'snappy',
+    show_default = True,
+    required = False,
+    help = "Compression codec used when writing parquet files."
+)
+@click.option(
+    '--single-precision',
+    is_flag = True,
+    default = False,
+    show_default = True,
+    help = ("Write floating point columns of csv files in single precision "
+            "(float32).")
+)
+@click.option(
+    '--precision',
+    default = None,
+    type = click.IntRange(min = 0),
+    required = False,
+    help = ("Round floating point columns of csv files to this many decimal "
+            "places.")
 )
 @click.option(
     '--freq',
@@ -34,7 +84,9 @@ import logging   as lg
     required = False,
     show_default = True,
     help = ("Frequency string determining the length of each time period. "
-            "Refer to pandas' timeseries user guide for valid strings.")
+            "Refer to pandas' timeseries user guide for valid strings. "
+            "Multiple comma separated frequencies (e.g. 5T,15T,1H,1D) "
+            "compute flows at each resolution in a single run.")
 )
 @click.option(
     '--drop-na',
@@ -79,41 +131,245 @@ import logging   as lg
     help = ("Assume that trip steps start and end in the same time interval"
             "(valid for longer discretisation periods: e.g. hour, day, week).")
 )
+@click.option(
+    '--engine',
+    type = click.Choice(['anprx', 'numpy']),
+    default = 'anprx',
+    show_default = True,
+    required = False,
+    help = ("Engine used to discretise trip steps and count flows. The numpy "
+            "engine never materialises one row per step and period, and "
+            "requires a fixed length --freq (not e.g. months).")
+)
+@filter_options
 @click.command()
 def flows(
     input_trips_pkl,
     output,
     output_format,
+    compression,
+    single_precision,
+    precision,
     freq,
     drop_na,
     expand,
     apply_pthreshold,
     pthreshold,
-    same_period):
-    """Compute flows between camera pairs from wrangled data."""
+    same_period,
+    engine,
+    start,
+    end,
+    cameras,
+    pairs):
+    """
+    Compute flows between camera pairs from wrangled data.
+
+    If multiple frequencies are given, one output is written per frequency,
+    with the frequency appended to the output name: e.g. flows_5T.csv and
+    flows_1H.csv for --freq 5T,1H and OUTPUT flows.csv. Trips are read once,
+    and each output is written as soon as its flows are computed. With
+    --same-period, flows at each resolution are rolled up from the finest
+    resolution it's a multiple of. Otherwise, trip steps can count towards
+    several periods, and summing finer periods would count them more than
+    once, so flows are counted again for each resolution (with the numpy
+    engine, from trip steps prepared once).
+
+    Csv files are compressed on the fly if OUTPUT ends with .gz or .zst.
+
+    Flows are the final output of the pipeline, so encoded camera ids (see
+    wrangle raw-anpr --encode-ids) are decoded before writing them. With the
+    numpy engine, only the table of camera pairs needs to be decoded.
+
+    The sparse output format stores flows without expanding them into every
+    (origin, destination, period) combination, even with --expand, which is
+    then recorded in the output so that flows are expanded when they're
+    loaded. Dense slices can be loaded from it in python:
+
+    \b
+        from cli.compute.engine import SparseFlows
+        flows = SparseFlows.read('flows_5T')
+        array = flows.dense(start = '2019-01-07', end = '2019-01-14')
+        df = flows.to_frame()
+
+    INPUT_TRIPS_PKL can also be a dataset of trips (see compute trips
+    --dataset), of which only the partitions that can match --start, --end,
+    --cameras and --pairs are read, in parallel.
 
-    log(("Reading input pkl file with wrangled trip data of size {:,.2f} MB.")\
-            .format(os.stat(input_trips_pkl).st_size/1e6),
+    The numpy engine only reads the columns of trips needed to count flows,
+    while the anprx engine reads them all. Parquet and feather trip files
+    read much faster than pickles: only the selected columns are decoded,
+    and steps outside of --start and --end, or that don't match --cameras
+    and --pairs, are filtered as they are read. Flows in the periods at
+    either end of the time range may then only count part of the steps that
+    span them.
+
+    \b
+        anpr compute flows --engine numpy --freq 15T \\
+            --start 2019-01-07 --end 2019-01-14 --cameras 1,2,3 \\
+            data/trips_NPDATA.parquet data/flows_corridor.pkl
+    """
+    freqs = [f.strip() for f in freq.split(',') if f.strip()]
+
+    if output_format == 'sparse' and engine != 'numpy':
+        raise click.BadParameter(
+            "The sparse output format requires --engine numpy",
+            param_hint = '--output-format')
+
+    if engine == 'numpy':
+        try:
+            for f in freqs:
+                freq_nanos(f)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint = '--freq')
+
+    log(("Reading input file with wrangled trip data of size {:,.2f} MB.")\
+            .format(frame_size(input_trips_pkl)/1e6),
         level = lg.INFO)
 
-    trips = pd.read_pickle(input_trips_pkl)
+    with phase('read'):
+        trips = read_frame(
+            input_trips_pkl,
+            columns = TripSteps.columns if engine == 'numpy' else None,
+            time_column = step_times,
+            start = start,
+            end = end,
+            filters = camera_filters(parse_cameras(cameras),
+                                     parse_pairs(pairs),
+                                     ('origin', 'destination'))
+        )
+
+    attrs = id_attrs(trips)
+
+    def write(f, flows):
+        path = output if len(freqs) == 1 else output_for_freq(output, f)
+
+        with phase('write'):
+            if output_format == "csv":
+                write_csv(flows, path,
+                          single_precision = single_precision,
+                          precision = precision)
+            elif output_format == "sparse":
+                flows.write(path)
+            else:
+                write_frame(flows, path, output_format, compression)
 
-    dtrips = discretise_time(
-        trips,
-        freq = freq,
-        apply_pthreshold = apply_pthreshold,
-        pthreshold = pthreshold,
-        same_period = same_period
-    )
+    if engine == 'numpy':
+        resolutions = multi_resolution_flows(
+            trips,
+            freqs,
+            apply_pthreshold = apply_pthreshold,
+            pthreshold = pthreshold,
+            same_period = same_period,
+            remove_na = drop_na
+        )
 
-    flows = get_flows(dtrips, remove_na = drop_na)
+        while True:
+            with phase('transform'):
+                f, sf = next(resolutions, (None, None))
 
-    if expand:
-        flows = expand_flows(flows)
+                if sf is None:
+                    break
 
-    if output_format == "csv":
-        flows.to_csv(output, index = False)
-    elif output_format == "pkl":
-        flows.to_pickle(output)
+                # Coarser resolutions may still be rolled up from sf
+                sf = SparseFlows(decode_ids(with_id_attrs(sf.pairs, attrs)),
+                                 sf.freq, sf.pair, sf.period, sf.flow,
+                                 expanded = expand)
+
+                flows = sf if output_format == 'sparse' else sf.to_frame()
+
+            write(f, flows)
+    else:
+        for f, flows in anprx_flows(
+            trips,
+            freqs,
+            apply_pthreshold = apply_pthreshold,
+            pthreshold = pthreshold,
+            same_period = same_period,
+            drop_na = drop_na
+        ):
+            with phase('anprx'):
+                if expand:
+                    flows = expand_flows(flows)
+
+                flows = decode_ids(with_id_attrs(flows, attrs))
+
+            write(f, flows)
 
     return 0
+
+
+def anprx_flows(
+    trips,
+    freqs,
+    apply_pthreshold = False,
+    pthreshold = 0.02,
+    same_period = False,
+    drop_na = False
+):
+    """
+    Compute flows at several resolutions with anprx.
+
+    Flows are yielded as (freq, flows) pairs from the finest resolution to
+    the coarsest, as soon as each one is computed. With same_period, flows
+    at each resolution of fixed length are rolled up (see rollup_flows) from
+    the finest one computed so far of which it's a multiple. Otherwise,
+    trips are discretised again for each resolution.
+    """
+    def nanos(f):
+        try:
+            return freq_nanos(f)
+        except ValueError:
+            return None
+
+    # Resolutions of variable length (e.g. months) come last
+    freqs = sorted(freqs, key = lambda f: (nanos(f) is None, nanos(f) or 0))
+    computed = []
+
+    for f in freqs:
+        with phase('anprx'):
+            base = None
+            if same_period and nanos(f) is not None:
+                base = next((
+                    (base_freq, flows) for base_freq, flows in computed
+                    if nanos(f) % nanos(base_freq) == 0), None)
+
+            if base is not None:
+                flows = rollup_flows(base[1], f)
+            else:
+                dtrips = discretise_time(
+                    trips,
+                    freq = f,
+                    apply_pthreshold = apply_pthreshold,
+                    pthreshold = pthreshold,
+                    same_period = same_period
+                )
+
+                flows = get_flows(dtrips, remove_na = drop_na)
+                del dtrips
+
+                if same_period and nanos(f) is not None:
+                    computed.append((f, flows))
+
+        yield f, flows
+
+
+def rollup_flows(flows, freq):
+    """
+    Sum the flows of anprx into periods of length freq, a multiple of theirs.
+
+    Only the origin, destination, period and flow columns are kept. As in
+    engine.rollup, this is only equivalent to computing flows from scratch
+    with same_period.
+    """
+    period = pd.to_datetime(flows['period']).dt.floor(freq)
+
+    return flows.groupby(['origin', 'destination', period],
+                         sort = True, dropna = False)['flow']\
+                .sum()\
+                .reset_index()
+
+
+def output_for_freq(output, freq):
+    """Append the frequency to the name of the output file."""
+    stem, extension = os.path.splitext(output)
+    return '{}_{}{}'.format(stem, freq, extension)
@@ -5,7 +5,36 @@ from anprx.trips import calculate_avspeed
 from anprx.trips import trip_identification
 from anprx.utils import log
 
+from ..files     import formats
+from ..files     import compressions
+from ..files     import read_frame
+from ..files     import frame_size
+from ..files     import write_frame
+from ..files     import replace_frame
+from ..files     import iter_frames
+from ..files     import FrameWriter
+from ..files     import filter_mask
+from ..pairs     import read_camera_pairs
+from ..ids       import id_attrs
+from ..ids       import with_id_attrs
+from ..ids       import encode_ids
+from ..ids       import is_encoded
+from ..ids       import recode_ids
+from ..ids       import encode_filters
+from ..ids       import id_strings
+from ..profiling import phase
+from ..datasets  import DatasetWriter
+from ..datasets  import trip_steps
+from ..datasets  import check_manifest
+from ..filters   import filter_options
+from ..filters   import parse_cameras
+from ..filters   import parse_pairs
+from ..filters   import camera_filters
+
 import os
+import shutil
+import tempfile
+import multiprocessing as mp
 import numpy     as np
 import pandas    as pd
 import geopandas as gpd
@@ -50,6 +79,105 @@ import logging   as lg
     help = ("Observations that register a speed over this value are labelled "
             "as 'unfeasible' and removed.")
 )
+@click.option(
+    '--format',
+    type = click.Choice(formats),
+    default = None,
+    required = False,
+    help = ("Format of output file. "
+            "Inferred from the output file extension by default.")
+)
+@click.option(
+    '--compression',
+    type = click.Choice(compressions),
+    default = 'snappy',
+    show_default = True,
+    required = False,
+    help = "Compression codec used when writing parquet files."
+)
+@click.option(
+    '--workers',
+    default = 1,
+    type = click.IntRange(min = 1),
+    show_default = True,
+    required = False,
+    help = ("Number of processes used for trip identification. Vehicles are "
+            "partitioned across processes by hash.")
+)
+@click.option(
+    '--state',
+    default = None,
+    type = click.Path(dir_okay = False),
+    required = False,
+    help = ("State file with the last observation and trip of each vehicle. "
+            "If given, trips that were still open at the end of the previous "
+            "batch are continued, and the file is updated for the next batch.")
+)
+@click.option(
+    '--max-trip-gap',
+    default = None,
+    type = str,
+    required = False,
+    help = ("With --state, vehicles last observed longer than this (e.g. "
+            "12h) before the end of a batch close their trip, and aren't "
+            "carried over to the next batch. Defaults to the time it takes "
+            "to travel the longest camera pair at --speed-threshold.")
+)
+@click.option(
+    '--buckets',
+    default = None,
+    type = click.IntRange(min = 1),
+    required = False,
+    help = ("Identify trips out-of-core: observations are first split into "
+            "this many buckets on disk, by hash of the vehicle id, and trips "
+            "are then identified one bucket at a time (one per worker). "
+            "Memory use is bounded by the size of a bucket rather than of "
+            "the whole input.")
+)
+@click.option(
+    '--chunk-size',
+    default = 1000000,
+    type = click.IntRange(min = 1),
+    show_default = True,
+    required = False,
+    help = "Rows of wrangled anpr data read at a time with --buckets."
+)
+@click.option(
+    '--tmp-dir',
+    default = None,
+    type = click.Path(file_okay = False, exists = True),
+    required = False,
+    help = ("Folder for the buckets of --buckets, which take about as much "
+            "space as the input uncompressed. Defaults to the system's "
+            "temporary folder.")
+)
+@click.option(
+    '--dataset',
+    is_flag = True,
+    default = False,
+    show_default = True,
+    help = ("Write OUTPUT_PKL as a dataset directory of trip steps, "
+            "partitioned by the date they start, with a manifest of the rows "
+            "and time range of each file. Parquet (default) or feather only.")
+)
+@click.option(
+    '--camera-buckets',
+    default = None,
+    type = click.IntRange(min = 1),
+    required = False,
+    help = ("With --dataset, also partition trip steps by a hash of their "
+            "origin camera into this many buckets.")
+)
+@click.option(
+    '--batch-name',
+    default = None,
+    type = str,
+    required = False,
+    help = ("With --dataset, name of the files written by this batch. "
+            "Writing a batch of the same name again replaces it. Defaults "
+            "to the name of INPUT_ANPR_PKL.")
+)
+@filter_options
 @click.command()
 def trips(
     output_pkl,
@@ -57,33 +185,808 @@ def trips(
     input_anpr_pkl,
     speed_threshold,
     duplicate_threshold,
-    max_speed
+    max_speed,
+    format,
+    compression,
+    workers,
+    state,
+    max_trip_gap,
+    buckets,
+    chunk_size,
+    tmp_dir,
+    start,
+    end,
+    cameras,
+    pairs,
+    dataset,
+    camera_buckets,
+    batch_name
 ):
     """
     Identify trips for a batch of wrangled anpr data.
+
+    Consecutive batches (e.g. one per day) can be processed incrementally with
+    the --state option. The last observation of each vehicle is carried over
+    to the next batch, so that trips spanning both batches are continued with
+    the same trip id rather than split in two. The last step of a trip that's
+    still open at the end of a batch has no destination yet, so it's held
+    back and written by the batch that continues the trip, or closes it (see
+    --max-trip-gap). Each step is written once.
+
+    Camera pairs are read from either a geospatial file or a pair index
+    (see wrangle camera-pairs --index), which loads much faster.
+
+    \b
+        anpr compute trips --state data/trips.state \\
+            data/wrangled_day1.pkl data/camera-pairs.geojson data/trips_day1.pkl
+        anpr compute trips --state data/trips.state \\
+            data/wrangled_day2.pkl data/camera-pairs.geojson data/trips_day2.pkl
+
+    Inputs that don't fit in memory can be processed out-of-core with
+    --buckets. The input is streamed in chunks, so it's best read from a
+    parquet or feather file, and the trips of each bucket are appended to
+    the output as soon as they are identified. Trips are then grouped by
+    bucket rather than sorted by vehicle.
+
+    \b
+        anpr compute trips --buckets 64 --workers 4 \\
+            data/wrangled_year.parquet data/camera-pairs.pairs \\
+            data/trips_year.parquet
+
+    With --start and --end, only the observations of that time range are
+    read, and trips are identified from those alone: e.g. the trips of a
+    week. With --cameras or --pairs, trips are still identified from all
+    observations, so that they don't change, and only the trip steps from or
+    to those cameras, or between those pairs, are written: e.g. the steps
+    along a corridor of cameras.
+
+    INPUT_ANPR_PKL can also be a dataset of wrangled anpr data (see wrangle
+    raw-anpr --dataset), of which only the partitions that match the filters
+    are read. With --dataset, trips are written to a dataset too, in which
+    each batch (e.g. one per day) replaces the trips of previous runs of the
+    same --batch-name:
+
+    \b
+        anpr compute trips --dataset --state data/trips.state \\
+            --start 2019-01-07 --end 2019-01-08 --batch-name 20190107 \\
+            data/wrangled data/camera-pairs.pairs data/trips
     """
-    log(("Reading input pkl file with wrangled anpr data of size {:,.2f} MB.")\
-            .format(os.stat(input_anpr_pkl).st_size/1e6),
-        level = lg.INFO)
+    if dataset and format == 'pkl':
+        raise click.BadParameter(
+            "Datasets can only be written as parquet or feather files",
+            param_hint = '--format')
 
-    anpr = pd.read_pickle(input_anpr_pkl)
+    if camera_buckets is not None and not dataset:
+        raise click.BadParameter(
+            "--camera-buckets requires --dataset",
+            param_hint = '--camera-buckets')
 
-    camera_pairs = gpd.GeoDataFrame.from_file(input_pairs_geojson)
+    output = dict(path = output_pkl, format = format,
+                  compression = compression, dataset = None)
 
-    click.echo("Running trip identification. This may take a while...")
+    if dataset:
+        partitioning = dict(
+            format = format or 'parquet',
+            camera_buckets = camera_buckets,
+            **trip_steps
+        )
 
-    trips = trip_identification(
-        anpr, camera_pairs,
+        try:
+            check_manifest(output_pkl, **partitioning)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+
+        output['dataset'] = dict(
+            name = batch_name or os.path.splitext(os.path.basename(
+                       os.path.normpath(input_anpr_pkl)))[0],
+            **partitioning
+        )
+
+    if max_trip_gap is not None:
+        try:
+            max_trip_gap = pd.Timedelta(max_trip_gap)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint = '--max-trip-gap')
+
+    kwargs = dict(
         speed_threshold = speed_threshold,
         duplicate_threshold = duplicate_threshold,
         maximum_av_speed = max_speed
     )
 
-    trips.to_pickle(output_pkl)
+    query = dict(
+        time_column = 'timestamp',
+        start = start,
+        end = end
+    )
+
+    steps = camera_filters(parse_cameras(cameras), parse_pairs(pairs),
+                           columns = ('origin', 'destination'))
+
+    if buckets is not None:
+        return out_of_core_trips(
+            output, input_pairs_geojson, input_anpr_pkl,
+            buckets, workers, state, chunk_size, tmp_dir,
+            kwargs, query, steps, max_trip_gap)
+
+    log(("Reading input file with wrangled anpr data of size {:,.2f} MB.")\
+            .format(frame_size(input_anpr_pkl)/1e6),
+        level = lg.INFO)
+
+    with phase('read'):
+        anpr = read_frame(input_anpr_pkl, **query)
+
+        previous_state = None
+        if state is not None and os.path.isfile(state):
+            previous_state = read_frame(state)
+
+        camera_pairs = read_camera_pairs(
+            input_pairs_geojson,
+            cameras = observed_cameras(anpr, previous_state))
+
+    if is_encoded(anpr):
+        with phase('transform'):
+            anpr, camera_pairs, previous_state = \
+                encode_like(anpr, camera_pairs, previous_state)
+
+    click.echo("Running trip identification. This may take a while...")
+
+    output_trips, new_state = identify_batch(
+        anpr, camera_pairs, previous_state, state is not None, max_trip_gap,
+        workers, kwargs)
+
+    with phase('write'):
+        output_trips = filter_steps(output_trips, steps)
+
+        if output['dataset'] is None:
+            write_frame(output_trips, output_pkl, format, compression)
+        else:
+            with open_writer(**output) as writer:
+                writer.write(output_trips)
+
+        if state is not None:
+            replace_frame(new_state, state)
+
+    return 0
+
+
+def identify_batch(
+    anpr,
+    camera_pairs,
+    state,
+    with_state,
+    max_trip_gap,
+    workers,
+    kwargs
+):
+    """
+    Identify the trips of a batch of observations, continuing those of the
+    state of the previous batch, if given.
+
+    Returns the trip steps to write (see batch_steps) and, if with_state,
+    the state for the next batch, whose trips were closed with expire_state
+    (see trips --max-trip-gap). Both have the id attrs of anpr.
+    """
+    attrs = id_attrs(anpr)
+
+    if state is not None:
+        with phase('transform'):
+            anpr = carry_over(anpr, state)
+
+    with phase('anprx'):
+        trips = parallel_trip_identification(
+            anpr, camera_pairs,
+            workers = workers,
+            **kwargs
+        )
+
+    if state is not None:
+        with phase('transform'):
+            trips = continue_trips(trips, state)
+
+    new_state = None
+    if with_state:
+        with phase('transform'):
+            new_state = expire_state(
+                update_state(state, anpr, trips),
+                max_trip_gap or trip_gap(camera_pairs,
+                                         kwargs['speed_threshold']),
+                end = anpr['timestamp'].max())
+
+            trips = batch_steps(trips, state, new_state)
+            new_state = with_id_attrs(new_state, attrs)
+
+    return with_id_attrs(trips, attrs), new_state
+
+
+def out_of_core_trips(
+    output,
+    input_pairs,
+    input_anpr,
+    buckets,
+    workers,
+    state,
+    chunk_size,
+    tmp_dir,
+    kwargs,
+    query,
+    steps = None,
+    max_trip_gap = None
+):
+    """
+    Identify trips one bucket of vehicles at a time (see trips --buckets).
+
+    output holds the arguments of open_writer, query the filters of the
+    rows of input_anpr (see read_frame), and steps the filters of the trip
+    steps that are written (see filter_steps). max_trip_gap is that of
+    expire_state, derived from the camera pairs by default.
+    """
+    with phase('read'):
+        previous_state = None
+        if state is not None and os.path.isfile(state):
+            previous_state = read_frame(state)
+
+        camera_pairs = read_camera_pairs(input_pairs)
+
+    folder = tempfile.mkdtemp(prefix = 'anpr-trips-', dir = tmp_dir)
+
+    try:
+        log("Splitting wrangled anpr data into {} buckets in {}."\
+                .format(buckets, folder),
+            level = lg.INFO)
+
+        with phase('transform'):
+            paths, camera_pairs, previous_state, attrs, end = bucket_anpr(
+                input_anpr, folder, buckets, camera_pairs, previous_state,
+                chunk_size, query)
+
+        max_trip_gap = max_trip_gap or \
+                       trip_gap(camera_pairs, kwargs['speed_threshold'])
+
+        states = [None] * buckets
+        if previous_state is not None:
+            partition = vehicle_buckets(previous_state['vehicle'], buckets)
+            states = [previous_state[partition == i] for i in range(buckets)]
+
+        new_states = []
+        closed_steps = []
+        tasks = []
+        for path, bucket_state in zip(paths, states):
+            if path is not None:
+                tasks.append((path, bucket_state, state is not None,
+                              max_trip_gap, end))
+            elif bucket_state is not None:
+                # Vehicles that weren't observed keep their previous state,
+                # unless their trip is closed, which ends it
+                new_state = expire_state(bucket_state, max_trip_gap, end)
+                new_states.append(new_state)
+                closed_steps.append(
+                    batch_steps(None, bucket_state, new_state))
+
+        click.echo("Running trip identification on {} buckets. "
+                   "This may take a while...".format(len(tasks)))
+
+        with phase('anprx'), \
+             open_writer(**output) as writer:
+
+            if workers == 1 or len(tasks) <= 1:
+                init_trips_worker(camera_pairs, kwargs)
+                results = map(identify_bucket, tasks)
+                pool = None
+            else:
+                pool = mp.Pool(
+                    processes = min(workers, len(tasks)),
+                    initializer = init_trips_worker,
+                    initargs = (camera_pairs, kwargs)
+                )
+                results = pool.imap(identify_bucket, tasks)
+
+            columns = None
+
+            try:
+                with click.progressbar(results, length = len(tasks),
+                                       label = 'Buckets') as bar:
+                    for trips, bucket_state in bar:
+                        trips = filter_steps(with_id_attrs(trips, attrs),
+                                             steps)
+                        if len(trips) > 0:
+                            writer.write(trips)
+                            columns = list(trips.columns)
+                        if bucket_state is not None:
+                            new_states.append(bucket_state)
+            finally:
+                if pool is not None:
+                    pool.terminate()
+
+            # Last steps of the trips of vehicles that weren't observed
+            closed_steps = [trips for trips in closed_steps if len(trips) > 0]
+            if len(closed_steps) > 0:
+                trips = filter_steps(with_id_attrs(
+                    pd.concat(closed_steps, ignore_index = True), attrs),
+                    steps)
+                if len(trips) > 0:
+                    if columns is not None:
+                        trips = trips.reindex(columns = columns)
+                    writer.write(trips)
+                    columns = list(trips.columns)
+
+            # No vehicle has any trip: still write an (empty) output
+            if columns is None:
+                writer.write(with_id_attrs(pd.DataFrame(), attrs))
+
+        if state is not None:
+            with phase('write'):
+                new_state = pd.concat(new_states, ignore_index = True)
+                replace_frame(with_id_attrs(new_state, attrs), state)
+    finally:
+        shutil.rmtree(folder, ignore_errors = True)
 
     return 0
 
 
+def filter_steps(trips, filters):
+    """
+    Trip steps that match filters on origin and destination (see
+    files.read_frame), or all of them if filters is None.
+    """
+    if filters is None:
+        return trips
+
+    attrs = id_attrs(trips)
+    mask = filter_mask(trips, None, filters = encode_filters(filters, attrs))
+
+    return with_id_attrs(trips[mask].reset_index(drop = True), attrs)
+
+
+def open_writer(path, format = None, compression = None, dataset = None):
+    """
+    Writer of the trips of a batch, to a file or, if dataset is given (the
+    arguments of DatasetWriter), to a dataset.
+    """
+    if dataset is None:
+        return FrameWriter(path, format, compression)
+
+    return DatasetWriter(path, compression = compression, **dataset)
+
+
+def vehicle_buckets(vehicles, buckets):
+    """Bucket of each vehicle, the same for any batch or chunk."""
+    return pd.util.hash_pandas_object(vehicles, index = False).values % buckets
+
+
+def bucket_anpr(
+    path,
+    folder,
+    buckets,
+    camera_pairs,
+    state,
+    chunk_size,
+    query = None
+):
+    """
+    Split wrangled anpr data into feather files of vehicle buckets.
+
+    The input is read chunk_size rows at a time and the rows of each bucket
+    are appended to its file, so each bucket keeps the order of the input.
+    Encoded ids are re-encoded along with camera pairs and the state, as in
+    encode_like, and all buckets share the same dictionaries.
+
+    Returns the path of each bucket (None if empty), the camera pairs, the
+    state, the id attrs of the buckets, and the time of the last observation
+    (None if there are none).
+    """
+    writers = [None] * buckets
+    attrs = {}
+    dictionaries = None
+    end = None
+
+    try:
+        for chunk in iter_frames(path, chunksize = chunk_size,
+                                 **(query or {})):
+            if is_encoded(chunk):
+                if dictionaries is None:
+                    dictionaries = chunk.attrs.get('dictionaries', {})
+                    target = None if state is None \
+                             else state.attrs.get('dictionaries', {})
+
+                    chunk, camera_pairs, state = \
+                        encode_like(chunk, camera_pairs, state)
+
+                elif target is not None and dictionaries != target:
+                    chunk = recode_ids(chunk, target)
+
+                attrs = id_attrs(chunk)
+
+            last = chunk['timestamp'].max()
+            end = last if end is None or last > end else end
+
+            partition = vehicle_buckets(chunk['vehicle'], buckets)
+
+            for i in np.unique(partition):
+                if writers[i] is None:
+                    writers[i] = FrameWriter(
+                        os.path.join(folder, 'bucket_{:05d}.feather'.format(i)),
+                        'feather')
+
+                writers[i].write(chunk[partition == i])
+    except BaseException:
+        for writer in writers:
+            if writer is not None:
+                writer.abort()
+        raise
+
+    for writer in writers:
+        if writer is not None:
+            writer.close()
+
+    paths = [None if writer is None else writer.path for writer in writers]
+
+    return paths, camera_pairs, state, attrs, end
+
+
+def identify_bucket(task):
+    """
+    Identify the trips of a bucket of vehicles, and their state if needed
+    (see identify_batch).
+
+    Buckets are deleted once read, to free disk space as early as possible.
+    """
+    path, state, with_state, max_trip_gap, end = task
+
+    # Buckets keep the order of the input, which is only sorted by time
+    # within each file of a dataset partitioned by camera
+    anpr = read_frame(path).sort_values('timestamp', kind = 'mergesort')\
+                           .reset_index(drop = True)
+    os.remove(path)
+
+    if state is not None:
+        anpr = carry_over(anpr, state)
+
+    trips = trip_identification(
+        anpr,
+        _trips_worker['camera_pairs'],
+        **_trips_worker['kwargs']
+    )
+
+    if state is not None:
+        trips = continue_trips(trips, state)
+
+    new_state = None
+    if with_state:
+        new_state = expire_state(update_state(state, anpr, trips),
+                                 max_trip_gap, end)
+        trips = batch_steps(trips, state, new_state)
+
+    return trips, new_state
+
+
+def observed_cameras(*frames):
+    """
+    Ids of the cameras of frames of observations (None frames are skipped).
+
+    The ids of encoded frames are those of their dictionary, which may have
+    more cameras than were observed.
+    """
+    cameras = set()
+
+    for df in frames:
+        if df is None:
+            continue
+        if is_encoded(df):
+            cameras.update(df.attrs['dictionaries'].get('camera', []))
+        else:
+            cameras.update(id_strings(df['camera']).dropna())
+
+    return sorted(cameras)
+
+
+def encode_like(anpr, camera_pairs, state = None):
+    """
+    Encode camera pairs with the id dictionaries of anpr.
+
+    Pairs of cameras that aren't in the dictionary, and so were never
+    observed, are dropped. The state of the previous batch may have been
+    encoded with different dictionaries, in which case both are re-encoded
+    with the same ones.
+    """
+    if state is not None:
+        if not is_encoded(state):
+            raise click.ClickException(
+                "Ids of the state file and the wrangled anpr data must be "
+                "both encoded, or both not encoded (see raw-anpr "
+                "--encode-ids)")
+
+        dictionaries = state.attrs.get('dictionaries', {})
+        if anpr.attrs.get('dictionaries', {}) != dictionaries:
+            anpr = recode_ids(anpr, dictionaries)
+            state = recode_ids(state, anpr.attrs['dictionaries'])
+
+    cameras = anpr.attrs['dictionaries'].get('camera', [])
+    known = camera_pairs['origin'].astype(str).isin(cameras) & \
+            camera_pairs['destination'].astype(str).isin(cameras)
+
+    camera_pairs = encode_ids(
+        camera_pairs[known],
+        {'camera' : cameras},
+        columns = ['origin', 'destination'])
+
+    return anpr, camera_pairs, state
+
+
+def parallel_trip_identification(anpr, camera_pairs, workers = 1, **kwargs):
+    """
+    Run trip identification over a process pool.
+
+    Trips are independent between vehicles, so observations are partitioned
+    into ranges of vehicles with about the same number of observations, and
+    each partition is processed on its own. Each worker receives
+    camera_pairs once, at startup.
+
+    trip_identification groups trips by vehicle, in sorted order, so the
+    partial results are concatenated in the order of the ranges, which gives
+    the same rows in the same order as a single call. If the partial results
+    have a default index, the result has one too, otherwise their index is
+    kept as is.
+    """
+    if workers == 1:
+        return trip_identification(anpr, camera_pairs, **kwargs)
+
+    codes, vehicles = pd.factorize(anpr['vehicle'], sort = True)
+    counts = np.bincount(codes[codes >= 0], minlength = len(vehicles))
+
+    # Partition of each vehicle, by the observations of the vehicles before it
+    vehicle_partition = (np.cumsum(counts) - counts) * workers // \
+                        max(counts.sum(), 1)
+    # Missing vehicles (code -1) go to the last partition
+    partition = np.append(vehicle_partition, workers - 1)[codes]
+
+    partitions = [anpr[partition == i] for i in range(workers)]
+    partitions = [p for p in partitions if len(p) > 0]
+
+    log("Identifying trips in {} partitions of {:,} vehicles using {} workers."\
+            .format(len(partitions), len(vehicles), workers),
+        level = lg.INFO)
+
+    with mp.Pool(
+        processes = min(workers, len(partitions)),
+        initializer = init_trips_worker,
+        initargs = (camera_pairs, kwargs)
+    ) as pool:
+        results = pool.map(identify_partition, partitions)
+
+    default_index = all(isinstance(r.index, pd.RangeIndex) and
+                        r.index.start == 0 and r.index.step == 1
+                        for r in results)
+
+    return pd.concat(results, ignore_index = default_index)
+
+
+def carry_over(anpr, state):
+    """
+    Prepend the last observation of each vehicle in the previous batch.
+
+    Only vehicles that are observed again in this batch, and whose trip is
+    still open (see expire_state), are carried over.
+    """
+    carried = state[state['vehicle'].isin(anpr['vehicle']) &
+                    state['timestamp'].notna()]
+
+    log("Continuing trips of {:,} vehicles from the previous batch."\
+            .format(len(carried)),
+        level = lg.INFO)
+
+    # Columns of closed trips have missing values, and so may be floats
+    carried = carried[anpr.columns].astype(anpr.dtypes.to_dict())
+
+    return pd.concat([carried, anpr], ignore_index = True)\
+        .sort_values('timestamp', kind = 'mergesort')\
+        .reset_index(drop = True)
+
+
+def continue_trips(trips, state):
+    """
+    Renumber the trips of vehicles carried over from the previous batch.
+
+    The first trip of a carried over vehicle starts at its last observation in
+    the previous batch, which is the open trip of that vehicle. Its first step
+    (with no origin) was already emitted in the previous batch and is dropped.
+    Its next step, from the carried over observation, takes the place of the
+    last step of the open trip, which was held back (see batch_steps): it
+    goes on to the next camera if the trip continues, or has no destination
+    if it doesn't. Trip ids and steps are then shifted to follow on from the
+    previous batch.
+
+    Vehicles whose trip was closed (see expire_state) weren't carried over,
+    and their trips are only renumbered to follow their last trip.
+    """
+    is_open = state['timestamp'].notna()
+    last = state[is_open].set_index('vehicle')[['trip', 'trip_step']]
+    closed = state[~is_open].set_index('vehicle')['trip']
+
+    is_carried = trips['vehicle'].isin(last.index)
+    carried = trips[is_carried].copy()
+
+    first_trip = carried.groupby('vehicle')['trip'].transform('min')
+    in_first_trip = carried['trip'] == first_trip
+
+    first_step = carried['trip_step'].where(in_first_trip)\
+                                     .groupby(carried['vehicle'])\
+                                     .transform('min')
+
+    drop = in_first_trip & (carried['trip_step'] == first_step)
+
+    last_trip = carried['vehicle'].map(last['trip'])
+    last_step = carried['vehicle'].map(last['trip_step'])
+
+    carried['trip_step'] = carried['trip_step']\
+        .where(~in_first_trip,
+               carried['trip_step'] - (first_step + 1) + last_step)
+    carried['trip'] = carried['trip'] - first_trip + last_trip
+
+    carried = carried[~drop]
+
+    is_closed = trips['vehicle'].isin(closed.index)
+    reopened = trips[is_closed].copy()
+
+    first_trip = reopened.groupby('vehicle')['trip'].transform('min')
+    reopened['trip'] = reopened['trip'] - first_trip + \
+                       reopened['vehicle'].map(closed).astype(np.int64) + 1
+
+    # Keep the original order of rows
+    return pd.concat([trips[~is_carried & ~is_closed], carried, reopened])\
+        .sort_index(kind = 'mergesort')\
+        .astype(trips.dtypes.to_dict())\
+        .reset_index(drop = True)
+
+
+def update_state(state, anpr, trips):
+    """
+    Record the last observation and trip of each vehicle.
+
+    The last observation of a vehicle is that of its last trip step, rather
+    than its last row in anpr, so that observations anprx discarded (e.g.
+    duplicates) are never carried over. Vehicles that weren't observed in
+    this batch keep their previous state, so that their trip ids keep
+    increasing in later batches.
+    """
+    last = trips.sort_values(['trip', 'trip_step'], kind = 'mergesort')\
+                .drop_duplicates('vehicle', keep = 'last')
+
+    # The last step of a trip has no destination
+    keys = ['vehicle', 'camera', 'timestamp']
+    last_obs = pd.DataFrame({
+        'vehicle'   : last['vehicle'].values,
+        'camera'    : last['destination'].fillna(last['origin']).values,
+        'timestamp' : last['t_destination'].fillna(last['t_origin']).values
+    }).astype(anpr[keys].dtypes.to_dict())
+
+    # Other columns of the observation
+    new_state = last_obs\
+        .merge(anpr.drop_duplicates(keys, keep = 'last'),
+               on = keys, how = 'left')\
+        [list(anpr.columns)]\
+        .assign(trip = last['trip'].values,
+                trip_step = last['trip_step'].values)
+
+    if state is not None:
+        state = state[~state['vehicle'].isin(new_state['vehicle'])]
+        new_state = pd.concat([state, new_state], ignore_index = True)
+
+    return new_state
+
+
+def expire_state(state, max_gap, end = None):
+    """
+    Close the trips of vehicles last observed more than max_gap before end,
+    the end of the batch, which defaults to the last observation in state.
+
+    Their last observation is cleared, so that it's no longer carried over
+    to later batches, but their trip ids are kept, so that their next trips
+    still follow on from them (see continue_trips).
+    """
+    if max_gap is None or len(state) == 0:
+        return state
+
+    if end is None:
+        end = state['timestamp'].max()
+
+    expired = state['timestamp'] < end - max_gap
+    observation = [column for column in state.columns
+                   if column not in ['vehicle', 'trip', 'trip_step']]
+
+    log("Closing the trips of {:,} vehicles last observed more than {} ago."\
+            .format(expired.sum(), max_gap),
+        level = lg.INFO)
+
+    state = state.copy()
+    for column in observation:
+        state[column] = state[column].where(~expired)
+
+    return state
+
+
+def batch_steps(trips, state, new_state):
+    """
+    Trip steps of a batch to write, given the states before and after it.
+
+    The last step of a trip has no destination. That of a trip that's still
+    open in new_state is held back, rather than written again when the trip
+    continues in the next batch (see continue_trips). Once the trip of a
+    vehicle that wasn't observed again is closed (see expire_state), its
+    last step is written with the batch that closes it, built from the
+    state. trips can be None if no vehicle was observed.
+    """
+    keys = ['vehicle', 'trip', 'trip_step']
+    is_open = new_state['timestamp'].notna()
+
+    if trips is not None:
+        held = trips['destination'].isna().values & \
+               pd.MultiIndex.from_frame(trips[keys])\
+                 .isin(pd.MultiIndex.from_frame(new_state.loc[is_open, keys]))
+        trips = trips[~held]
+
+    if state is None:
+        return trips.reset_index(drop = True)
+
+    was_open = state[state['timestamp'].notna()]
+    is_closed = was_open['vehicle'].isin(new_state.loc[~is_open, 'vehicle'])
+    if trips is not None:
+        is_closed &= ~was_open['vehicle'].isin(trips['vehicle'])
+    closed = was_open[is_closed]
+
+    def missing(column):
+        return column.iloc[:0].reindex(range(len(closed)))
+
+    last_steps = pd.DataFrame({
+        'vehicle'       : closed['vehicle'].values,
+        'origin'        : closed['camera'].values,
+        'destination'   : missing(closed['camera']),
+        't_origin'      : closed['timestamp'].values,
+        't_destination' : missing(closed['timestamp']),
+        'trip'          : closed['trip'].values,
+        'trip_step'     : closed['trip_step'].values
+    })
+
+    if trips is None:
+        return last_steps
+
+    return pd.concat([trips, last_steps.reindex(columns = trips.columns)],
+                     ignore_index = True)
+
+
+def trip_gap(camera_pairs, speed_threshold):
+    """
+    Longest time between two observations of the same trip, or None if
+    unknown.
+
+    Trips are split when vehicles travel between cameras slower than
+    speed_threshold (in km/h), so no trip can continue after the time it
+    takes to travel the longest camera pair (in meters) at that speed.
+    """
+    valid = camera_pairs[camera_pairs['valid'].astype(bool)]
+    distance = valid['distance'].max()
+
+    if pd.isnull(distance) or speed_threshold <= 0:
+        return None
+
+    return pd.Timedelta(hours = distance / 1000 / speed_threshold)
+
+
+_trips_worker = {}
+
+
+def init_trips_worker(camera_pairs, kwargs):
+    _trips_worker.update(camera_pairs = camera_pairs, kwargs = kwargs)
+
+
+def identify_partition(anpr):
+    return trip_identification(
+        anpr,
+        _trips_worker['camera_pairs'],
+        **_trips_worker['kwargs']
+    )
+
+
 @click.argument(
     'output-pkl',
     type=str
@@ -96,28 +999,74 @@ def trips(
     'input-anpr-pkl',
     type=str
 )
+@click.option(
+    '--format',
+    type = click.Choice(formats),
+    default = None,
+    required = False,
+    help = ("Format of output file. "
+            "Inferred from the output file extension by default.")
+)
+@click.option(
+    '--compression',
+    type = click.Choice(compressions),
+    default = 'snappy',
+    show_default = True,
+    required = False,
+    help = "Compression codec used when writing parquet files."
+)
+@filter_options
 @click.command()
 def avspeed(
     output_pkl,
     input_pairs_geojson,
-    input_anpr_pkl
+    input_anpr_pkl,
+    format,
+    compression,
+    start,
+    end,
+    cameras,
+    pairs
 ):
     """
     Transform wrangled anpr data and compute vehicle
     avspeed using shortest path distance.
+
+    Camera pairs are read from either a geospatial file or a pair index
+    (see wrangle camera-pairs --index). Observations can be filtered by time
+    as they are read with --start and --end. With --cameras and --pairs, only
+    the steps from or to those cameras, or between those pairs, are written.
     """
-    log(("Reading input pkl file with wrangled anpr data of size {:,.2f} MB.")\
-            .format(os.stat(input_anpr_pkl).st_size/1e6),
+    log(("Reading input file with wrangled anpr data of size {:,.2f} MB.")\
+            .format(frame_size(input_anpr_pkl)/1e6),
         level = lg.INFO)
 
-    anpr = pd.read_pickle(input_anpr_pkl)
+    with phase('read'):
+        anpr = read_frame(
+            input_anpr_pkl,
+            time_column = 'timestamp',
+            start = start,
+            end = end
+        )
+
+        camera_pairs = read_camera_pairs(input_pairs_geojson,
+                                         cameras = observed_cameras(anpr))
+
+    if is_encoded(anpr):
+        with phase('transform'):
+            anpr, camera_pairs, _ = encode_like(anpr, camera_pairs)
 
-    camera_pairs = gpd.GeoDataFrame.from_file(input_pairs_geojson)
+    with phase('anprx'):
+        t_anpr = transform_anpr(anpr)
 
-    t_anpr = transform_anpr(anpr)
+        t_anpr = calculate_avspeed(t_anpr, camera_pairs)
 
-    t_anpr = calculate_avspeed(t_anpr, camera_pairs)
+    with phase('write'):
+        t_anpr = filter_steps(
+            with_id_attrs(t_anpr, id_attrs(anpr)),
+            camera_filters(parse_cameras(cameras), parse_pairs(pairs),
+                           columns = ('origin', 'destination')))
 
-    t_anpr.to_pickle(output_pkl)
+        write_frame(t_anpr, output_pkl, format, compression)
 
     return 0
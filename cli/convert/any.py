@@ -2,13 +2,30 @@ import os
 import click
 import pandas         as pd
 
+from ..files     import iter_frames
+from ..files     import FrameWriter
+from ..files     import frame_header
+from ..files     import file_root
+from ..files     import compressions
+from ..files     import csv_compressions
+from ..files     import csv_compression_extensions
+from ..files     import feather_compressions
+from ..profiling import phase
+
+format_to_extension = {
+    'csv'     : '.csv',
+    'pkl'     : '.pkl',
+    'parquet' : '.parquet',
+    'feather' : '.feather'
+}
+
 @click.argument(
     'input-pkl',
     type = str
 )
 @click.option(
     '--to',
-    type=click.Choice(['csv']),
+    type=click.Choice(['csv', 'pkl', 'parquet', 'feather']),
     default = "csv"
 )
 @click.option(
@@ -18,26 +35,176 @@ import pandas         as pd
     help = ("Set custom name for output file. "
             "Defaults to same as input file.")
 )
+@click.option(
+    '--compression',
+    type = click.Choice(compressions),
+    default = 'none',
+    show_default = True,
+    help = ("Compress the output file. Csv files support gzip and zstd "
+            "(zstd is much faster than gzip, for similar file sizes), "
+            "feather files lz4 and zstd. Pickles can't be compressed.")
+)
+@click.option(
+    '--single-precision',
+    is_flag = True,
+    default = False,
+    show_default = True,
+    help = "Write floating point columns of csv files in single precision."
+)
+@click.option(
+    '--precision',
+    default = None,
+    type = click.IntRange(min = 0),
+    required = False,
+    help = "Round floating point columns of csv files to this many decimals."
+)
+@click.option(
+    '--columns',
+    type = str,
+    default = None,
+    required = False,
+    help = "Comma separated names of the columns to keep."
+)
+@click.option(
+    '--time-column',
+    type = str,
+    default = None,
+    required = False,
+    help = "Column used to filter rows by --start and --end."
+)
+@click.option(
+    '--start',
+    type = str,
+    default = None,
+    required = False,
+    help = "Only keep rows at or after this time (e.g. 2019-01-07)."
+)
+@click.option(
+    '--end',
+    type = str,
+    default = None,
+    required = False,
+    help = "Only keep rows before this time (e.g. 2019-01-14)."
+)
+@click.option(
+    '--chunksize',
+    default = 1000000,
+    type = click.IntRange(min = 1),
+    show_default = True,
+    help = "Number of rows converted at a time."
+)
 
 @click.command()
 def pkl(
     input_pkl,
     to,
-    out_name
+    out_name,
+    compression,
+    single_precision,
+    precision,
+    columns,
+    time_column,
+    start,
+    end,
+    chunksize
 ):
     """
-    Convert trip pickle files to other formats.
+    Convert trip files between pickle, csv, parquet and feather.
+
+    The input format is inferred from its extension. Parquet, feather and csv
+    inputs are converted one chunk at a time, so that memory use is bounded by
+    the chunk size (pickles are always read whole, and written whole).
+    Columns can be selected and rows filtered by a time range during the
+    conversion, which for parquet and feather inputs skips row groups outside
+    of it:
+
+    \b
+        anpr convert pkl --to csv --compression zstd \\
+            --columns vehicle,origin,destination,t_origin,t_destination \\
+            --time-column t_origin --start 2019-01-07 --end 2019-01-14 \\
+            data/trips_NPDATA.parquet
     """
 
-    # Read networkx graph as pkl
-    df = pd.read_pickle(input_pkl)
+    if (start or end) and time_column is None:
+        raise click.BadParameter(
+            "--start and --end require --time-column",
+            param_hint = '--time-column')
+
+    if to == 'csv' and compression not in csv_compressions:
+        raise click.BadParameter(
+            "Csv files can only be compressed with {}"\
+                .format(', '.join(csv_compressions)),
+            param_hint = '--compression')
+
+    if to == 'feather' and \
+       compression not in ['none'] + feather_compressions:
+        raise click.BadParameter(
+            "Feather files can only be compressed with {}"\
+                .format(', '.join(feather_compressions)),
+            param_hint = '--compression')
+
+    if to == 'pkl' and compression != 'none':
+        raise click.BadParameter(
+            "Pickles can't be compressed, convert them to parquet instead",
+            param_hint = '--compression')
+
+    selected = None
+    if columns is not None:
+        selected = columns = columns.split(',')
+        # The time column is needed to filter rows
+        if time_column is not None and time_column not in columns:
+            columns = columns + [time_column]
 
     # Write output
     if out_name is None:
-        out_name = os.path.splitext(input_pkl)[0]
+        out_name = file_root(input_pkl)
+
+    output = '{}{}'.format(out_name, format_to_extension[to])
+    if to == 'csv':
+        output += csv_compression_extensions.get(compression, '')
+
+    if os.path.abspath(output) == os.path.abspath(input_pkl):
+        raise click.BadParameter(
+            "Output file would overwrite the input file, use --out-name",
+            param_hint = '--out-name')
+
+    chunks = iter_frames(
+        input_pkl,
+        columns = columns,
+        time_column = time_column,
+        start = start,
+        end = end,
+        chunksize = chunksize
+    )
+
+    with FrameWriter(
+        output,
+        format = to,
+        compression = compression,
+        single_precision = single_precision,
+        precision = precision,
+        buffer_rows = chunksize
+    ) as writer:
+        written = False
+
+        while True:
+            with phase('read'):
+                chunk = next(chunks, None)
+
+            if chunk is None:
+                break
+
+            if selected is not None:
+                chunk = chunk[selected]
+
+            with phase('write'):
+                writer.write(chunk)
 
-    output = '{}.{}'.format(out_name, to)
+            written = True
 
-    df.to_csv(output, index = False)
+        # No rows matched, but the columns of the input are still written
+        if not written:
+            header = frame_header(input_pkl, columns)
+            writer.write(header if selected is None else header[selected])
 
     return 0
@@ -1,48 +1,31 @@
 import os
 import click
-import fiona
-import networkx         as nx
-import geopandas        as gpd
-
-from   anprx.cameras    import gdfs_from_network
-
-
-supported_out_formats = \
-    [k for k, v in fiona.supported_drivers.items() if 'w' in v]
-"""
-{'AeronavFAA': 'r',
- 'ARCGEN': 'r',
- 'BNA': 'raw',
- 'DXF': 'raw',
- 'CSV': 'raw',
- 'OpenFileGDB': 'r',
- 'ESRIJSON': 'r',
- 'ESRI Shapefile': 'raw',
- 'GeoJSON': 'rw',
- 'GeoJSONSeq': 'rw',
- 'GPKG': 'rw',
- 'GML': 'raw',
- 'GPX': 'raw',
- 'GPSTrackMaker': 'raw',
- 'Idrisi': 'r',
- 'MapInfo File': 'raw',
- 'DGN': 'raw',
- 'S57': 'r',
- 'SEGY': 'r',
- 'SUA': 'r',
- 'TopoJSON': 'r'}
-"""
-
-supported_out_format_extensions = \
-    ['.bna', '.dxf', '.csv', '', '.geojson', '.geojsonseq',
-     '.gpkg', '.gml', '.gpx', '.gtm', '.mapinfo']
-
-format_to_extension = dict(zip(supported_out_formats,
-                               supported_out_format_extensions))
+
+from ..profiling import phase
+
+
+# Drivers that fiona can write, and the extension of their files.
+# Heavy dependencies (fiona, geopandas, anprx) are imported by each command,
+# so that listing the commands of convert doesn't import them.
+format_to_extension = {
+    'BNA'            : '.bna',
+    'DXF'            : '.dxf',
+    'CSV'            : '.csv',
+    'ESRI Shapefile' : '',
+    'GeoJSON'        : '.geojson',
+    'GeoJSONSeq'     : '.geojsonseq',
+    'GPKG'           : '.gpkg',
+    'GML'            : '.gml',
+    'GPX'            : '.gpx',
+    'GPSTrackMaker'  : '.gtm',
+    'MapInfo File'   : '.mapinfo'
+}
+
+supported_out_formats = list(format_to_extension)
 
 @click.argument(
     'input-pkl',
-    type = click.File('rb')
+    type = click.Path(exists = True)
 )
 @click.option(
     '--out-format',
@@ -64,12 +47,25 @@ def network(
     """
     Obtain the road network graph from OpenStreetMap.
     """
+    import fiona
+
+    from anprx.cameras import gdfs_from_network
+
+    from ..graphs      import read_graph
 
-    # Read networkx graph as pkl
-    G = nx.read_gpickle(input_pkl)
+    if 'w' not in fiona.supported_drivers.get(out_format, ''):
+        raise click.BadParameter(
+            "Driver '{}' can't be written by this version of fiona"\
+                .format(out_format),
+            param_hint = '--out-format')
+
+    # Read networkx graph as pkl or graph store
+    with phase('read'):
+        G = read_graph(input_pkl)
 
     # Convert to geopandas
-    nodes_gdf, edges_gdf = gdfs_from_network(G)
+    with phase('transform'):
+        nodes_gdf, edges_gdf = gdfs_from_network(G)
 
     # Write output
     if out_stem is None:
@@ -77,10 +73,47 @@ def network(
 
     extension = format_to_extension[out_format]
 
-    nodes_gdf.to_file('{}_nodes{}'.format(out_stem, extension),
-                      driver = out_format)
+    with phase('write'):
+        nodes_gdf.to_file('{}_nodes{}'.format(out_stem, extension),
+                          driver = out_format)
+
+        edges_gdf.to_file('{}_edges{}'.format(out_stem, extension),
+                          driver = out_format)
+
+    return 0
+
+
+@click.argument(
+    'output',
+    type = str
+)
+@click.argument(
+    'input',
+    type = click.Path(exists = True)
+)
+@click.command()
+def graph(input, output):
+    """
+    Convert a road network graph between gpickle and graph store.
+
+    A graph store is a directory (conventionally with the .graph extension)
+    of memory-mappable arrays: the adjacency of the graph in CSR form, and
+    columnar tables of node and edge attributes. It loads faster and takes
+    less memory than a gpickle. Every command that reads or writes a network
+    graph accepts either, chosen by the path: a directory or a .graph path is
+    a graph store, anything else a gpickle.
+
+    \b
+        anpr convert graph data/merged_network.pkl data/merged_network.graph
+        anpr convert graph data/merged_network.graph data/merged_network.pkl
+    """
+    from ..graphs import read_graph
+    from ..graphs import write_graph
+
+    with phase('read'):
+        G = read_graph(input)
 
-    edges_gdf.to_file('{}_edges{}'.format(out_stem, extension),
-                      driver = out_format)
+    with phase('write'):
+        write_graph(G, output)
 
     return 0
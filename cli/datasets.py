@@ -0,0 +1,577 @@
+"""
+Datasets of anpr observations or trips, partitioned by date and camera.
+
+A dataset is a directory of parquet or feather files laid out in hive style,
+one directory per date and, optionally, per bucket of cameras:
+
+    wrangled/
+        _manifest.json
+        date=2019-01-07/camera_bucket=03/part-NPDATA_1-1f0c9a2e.parquet
+        date=2019-01-07/camera_bucket=05/part-NPDATA_1-1f0c9a2e.parquet
+        ...
+
+The manifest records the number of rows and the time range of each file, so
+that reads with a time range or camera filters only open the files that can
+match them, and only files in the manifest belong to the dataset. Files of
+the same name, one per partition, are written by the same batch (e.g. one
+raw anpr file) and are replaced together when the batch is written again:
+each write of a batch has its own file names, and replaces the previous
+files of the batch in the manifest in a single atomic update.
+"""
+
+import os
+import json
+import uuid
+import tempfile
+import contextlib
+import concurrent.futures
+import numpy     as np
+import pandas    as pd
+
+from .ids        import id_attrs
+from .ids        import id_string
+from .ids        import id_strings
+from .ids        import decode_ids
+from .ids        import recode_ids
+from .ids        import extend_dictionaries
+
+
+manifest_name = '_manifest.json'
+
+lock_name = '_manifest.lock'
+
+dataset_formats = ['parquet', 'feather']
+"""Formats of the files of a dataset (pickles can't be partially read)."""
+
+observations = dict(time_column = 'timestamp', camera_column = 'camera')
+"""Partitioning of datasets of wrangled anpr observations."""
+
+trip_steps = dict(time_column = ['t_origin', 't_destination'],
+                  camera_column = ['origin', 'destination'])
+"""
+Partitioning of datasets of trips. Steps are partitioned by the date they
+start and by their origin, or their destination if they have no origin.
+"""
+
+trip_order = ['vehicle', 'trip', 'trip_step']
+"""Order of the steps of trips, as in trip files."""
+
+
+def is_dataset(path):
+    return os.path.isfile(os.path.join(path, manifest_name))
+
+
+def read_manifest(root):
+    with open(os.path.join(root, manifest_name)) as f:
+        return json.load(f)
+
+
+def write_manifest(root, manifest):
+    """Write the manifest atomically, so that readers never see half of it."""
+    fd, tmp = tempfile.mkstemp(dir = root, prefix = '.manifest.')
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, indent = 1)
+        os.replace(tmp, os.path.join(root, manifest_name))
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def check_manifest(root, format, time_column, camera_column, camera_buckets):
+    """
+    Raise ValueError if the dataset in root, if any, is partitioned
+    differently. The partitioning of a dataset can't change once it's been
+    written.
+    """
+    if not is_dataset(root):
+        return
+
+    manifest = read_manifest(root)
+    partitioning = dict(
+        format = format,
+        time_column = time_column,
+        camera_column = camera_column,
+        camera_buckets = camera_buckets
+    )
+
+    for key, value in partitioning.items():
+        if as_key(manifest[key]) != as_key(value):
+            raise ValueError(
+                "Dataset {} has {} {}, not {}".format(
+                    root, key, manifest[key], value))
+
+
+def update_manifest(root, entries, names, format, time_column,
+                    camera_column, camera_buckets):
+    """
+    Record the files of a batch of names in the manifest of a dataset.
+
+    Files previously written for these names and not written again are
+    deleted once the manifest no longer lists them, so rewriting a batch
+    replaces it, and readers never see a manifest with missing files.
+
+    The manifest is locked while it's updated (see manifest_lock), so that
+    several processes can write batches into the same dataset.
+    """
+    with manifest_lock(root):
+        check_manifest(root, format, time_column, camera_column,
+                       camera_buckets)
+
+        manifest = dict(
+            format = format,
+            time_column = time_column,
+            camera_column = camera_column,
+            camera_buckets = camera_buckets,
+            files = read_manifest(root)['files'] if is_dataset(root) else []
+        )
+
+        paths = set(entry['path'] for entry in entries)
+        stale = [entry['path'] for entry in manifest['files']
+                 if entry['name'] in names and entry['path'] not in paths]
+
+        manifest['files'] = sorted(
+            [entry for entry in manifest['files']
+             if entry['name'] not in names] + list(entries),
+            key = lambda entry: (entry['date'], entry['path']))
+
+        write_manifest(root, manifest)
+
+        for path in stale:
+            path = os.path.join(root, path)
+            if os.path.isfile(path):
+                os.remove(path)
+
+    return manifest
+
+
+@contextlib.contextmanager
+def manifest_lock(root):
+    """
+    Hold an exclusive lock on the manifest of a dataset.
+
+    The lock is an advisory lock (flock) on a file next to the manifest, so
+    it's only available on POSIX systems. Elsewhere, a dataset must only be
+    written by one process at a time.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+
+    os.makedirs(root, exist_ok = True)
+
+    with open(os.path.join(root, lock_name), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class DatasetWriter:
+    """
+    Write a batch of rows into the partitions of a dataset.
+
+    Rows are split by the date of time_column and, if camera_buckets is
+    given, by a hash of camera_column. Each partition is written to its own
+    file, named after the batch, one chunk at a time (see FrameWriter). The
+    manifest is updated when the writer is closed, unless update is False,
+    in which case the caller collects the entries and calls update_manifest
+    (e.g. once for the files written by many processes).
+
+    Files are named after the batch and a token of the writer, so the files
+    of a previous write of the batch are left untouched until the manifest
+    is updated. If the block of the writer raises, the writer is aborted:
+    its files are deleted and the manifest isn't updated.
+    """
+
+    def __init__(
+        self,
+        root,
+        name,
+        time_column,
+        camera_column,
+        format = 'parquet',
+        compression = None,
+        camera_buckets = None,
+        update = True
+    ):
+        if format not in dataset_formats:
+            raise ValueError(
+                "Datasets can only be written as {}"\
+                    .format(' or '.join(dataset_formats)))
+
+        check_manifest(root, format, time_column, camera_column,
+                       camera_buckets)
+
+        self.root = root
+        self.name = name
+        self.time_column = time_column
+        self.camera_column = camera_column
+        self.format = format
+        self.compression = compression
+        self.camera_buckets = camera_buckets
+        self.update = update
+        self.token = uuid.uuid4().hex[:8]
+
+        self.writers = {}
+        self.stats = {}
+
+        os.makedirs(root, exist_ok = True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, df):
+        from .files import FrameWriter
+
+        if len(df) == 0:
+            return
+
+        t_start, t_end = time_bounds(df, self.time_column)
+        date = t_start.values.astype('datetime64[D]')
+
+        keys = [date]
+        if self.camera_buckets is not None:
+            keys.append(camera_buckets(
+                camera_ids(df, self.camera_column), self.camera_buckets))
+
+        for key, rows in df.groupby(keys, sort = True, dropna = False)\
+                           .indices.items():
+            key = key if isinstance(key, tuple) else (key,)
+            day = key[0]
+
+            if pd.isnull(day):
+                raise ValueError(
+                    "Rows without a time can't be partitioned by date")
+
+            partition = ['date={}'.format(pd.Timestamp(day).date())]
+            if self.camera_buckets is not None:
+                partition.append('camera_bucket={:02d}'.format(key[1]))
+
+            path = '/'.join(partition + ['part-{}-{}.{}'.format(
+                self.name, self.token,
+                'parquet' if self.format == 'parquet' else 'feather')])
+
+            if path not in self.writers:
+                os.makedirs(os.path.join(self.root, *partition),
+                            exist_ok = True)
+                self.writers[path] = FrameWriter(
+                    os.path.join(self.root, path), self.format,
+                    self.compression)
+                self.stats[path] = dict(
+                    path = path,
+                    name = self.name,
+                    date = str(pd.Timestamp(day).date()),
+                    camera_bucket = None if self.camera_buckets is None \
+                                    else int(key[1]),
+                    rows = 0,
+                    start = None,
+                    end = None
+                )
+
+            self.writers[path].write(df.iloc[rows])
+
+            stats = self.stats[path]
+            stats['rows'] += len(rows)
+            stats['start'] = min_time(stats['start'], t_start.iloc[rows].min())
+            stats['end'] = max_time(stats['end'], t_end.iloc[rows].max())
+
+    def close(self):
+        try:
+            for writer in self.writers.values():
+                writer.close()
+        except BaseException:
+            self.abort()
+            raise
+        self.writers = {}
+
+        if self.update:
+            update_manifest(self.root, self.entries(), [self.name],
+                            self.format, self.time_column,
+                            self.camera_column, self.camera_buckets)
+
+    def abort(self):
+        """Delete the files written so far, without updating the manifest."""
+        for writer in self.writers.values():
+            writer.abort()
+        self.writers = {}
+
+        for path in self.stats:
+            path = os.path.join(self.root, path)
+            if os.path.isfile(path):
+                os.remove(path)
+        self.stats = {}
+
+    def entries(self):
+        """Manifest entries of the files written so far."""
+        return list(self.stats.values())
+
+
+def write_dataset(df, root, name, **kwargs):
+    """Write df as the batch name of the dataset in root."""
+    with DatasetWriter(root, name, **kwargs) as writer:
+        writer.write(df)
+
+
+def time_bounds(df, time_column):
+    """Start and end time of each row (see files.time_range_mask)."""
+    if isinstance(time_column, str):
+        return df[time_column], df[time_column]
+
+    first, last = time_column
+    return df[first].fillna(df[last]), df[last].fillna(df[first])
+
+
+def min_time(current, value):
+    if pd.isnull(value):
+        return current
+    value = pd.Timestamp(value).isoformat()
+    return value if current is None else min(current, value)
+
+
+def max_time(current, value):
+    if pd.isnull(value):
+        return current
+    value = pd.Timestamp(value).isoformat()
+    return value if current is None else max(current, value)
+
+
+def camera_ids(df, camera_column):
+    """
+    Camera id of each row as a string (see ids.id_string), decoded if
+    encoded (see cli.ids).
+
+    With a pair of columns (e.g. origin and destination), the second one is
+    used if the first is missing.
+    """
+    columns = [camera_column] if isinstance(camera_column, str) \
+              else list(camera_column)
+
+    ids = decode_ids(df[columns])
+    values = ids[columns[0]]
+    for column in columns[1:]:
+        values = values.fillna(ids[column])
+
+    return id_strings(values).fillna('nan')
+
+
+def camera_buckets(ids, buckets):
+    """Bucket of each camera id, the same in every process and run."""
+    return (pd.util.hash_pandas_object(pd.Series(ids, dtype = object),
+                                       index = False).values % buckets)\
+        .astype(np.int64)
+
+
+def dataset_files(
+    root,
+    time_column = None,
+    start = None,
+    end = None,
+    filters = None
+):
+    """
+    Paths of the files of a dataset that can match a query.
+
+    Files whose time range is outside of [start, end) are skipped, if
+    time_column is the one the dataset was partitioned by. Files whose
+    camera bucket can't match filters (see files.read_frame) are skipped
+    too.
+    """
+    manifest = read_manifest(root)
+
+    entries = manifest['files']
+
+    if time_column is not None and \
+       as_key(time_column) == as_key(manifest['time_column']):
+
+        if start is not None:
+            start = pd.Timestamp(start).isoformat()
+            entries = [e for e in entries
+                       if e['end'] is not None and e['end'] >= start]
+        if end is not None:
+            end = pd.Timestamp(end).isoformat()
+            entries = [e for e in entries
+                       if e['start'] is not None and e['start'] < end]
+
+    if filters and manifest['camera_buckets'] is not None:
+        buckets = matching_buckets(filters, manifest['camera_column'],
+                                   manifest['camera_buckets'])
+        if buckets is not None:
+            entries = [e for e in entries if e['camera_bucket'] in buckets]
+
+    return [os.path.join(root, e['path']) for e in entries]
+
+
+def as_key(column):
+    if column is None or isinstance(column, (str, int)):
+        return (column,)
+    return tuple(column)
+
+
+def matching_buckets(filters, camera_column, buckets):
+    """
+    Camera buckets that can match filters, or None if any bucket can.
+
+    Only conditions on the first camera column (by which rows are bucketed
+    when it isn't missing) narrow down the buckets.
+    """
+    column = as_key(camera_column)[0]
+    matching = set()
+
+    for conjunction in filters:
+        values = None
+        for name, op, value in conjunction:
+            if name != column:
+                continue
+            ids = set(id_string(v)
+                      for v in (value if op == 'in' else [value]))
+            values = ids if values is None else values & ids
+
+        if values is None:
+            return None
+
+        matching |= set(camera_buckets(sorted(values), buckets).tolist())
+
+    return matching
+
+
+def read_dataset(
+    root,
+    columns = None,
+    time_column = None,
+    start = None,
+    end = None,
+    filters = None,
+    workers = None
+):
+    """
+    Read the files of a dataset that can match a query, in parallel threads.
+
+    Rows are then filtered as in files.read_frame. Ids encoded with different
+    dictionaries in different files are re-encoded with the same ones.
+    Observations are sorted by time, as in wrangled files, and trip steps
+    by vehicle, trip and step, as in trip files (if those columns are read).
+    """
+    from .files import read_frame
+
+    paths = dataset_files(root, time_column, start, end, filters)
+
+    def read(path):
+        return read_frame(path, columns, time_column, start, end, filters)
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers = workers or min(len(paths), os.cpu_count() or 1) or 1
+    ) as pool:
+        frames = combine_ids(list(pool.map(read, paths)))
+
+    if len(frames) == 0:
+        return empty_frame(root, columns)
+
+    df = pd.concat(frames, ignore_index = True)
+    df.attrs = frames[0].attrs
+
+    partitioned_by = read_manifest(root)['time_column']
+    order = [partitioned_by] if isinstance(partitioned_by, str) \
+            else trip_order
+
+    if len(frames) > 1 and all(column in df.columns for column in order):
+        df = df.sort_values(order, kind = 'mergesort')\
+               .reset_index(drop = True)
+
+    return df
+
+
+def iter_dataset(
+    root,
+    columns = None,
+    time_column = None,
+    start = None,
+    end = None,
+    chunksize = 1000000,
+    filters = None
+):
+    """
+    Read the files of a dataset that can match a query in chunks, one file
+    after another (see files.iter_frames).
+
+    Ids are re-encoded with the dictionaries of all the files to be read.
+    """
+    from .files import iter_frames
+    from .files import file_attrs
+    from .files import infer_format
+
+    paths = dataset_files(root, time_column, start, end, filters)
+
+    attrs = [file_attrs(path, infer_format(path)) for path in paths]
+    dictionaries = common_dictionaries(attrs)
+
+    for path, path_attrs in zip(paths, attrs):
+        for chunk in iter_frames(path, columns, time_column, start, end,
+                                 chunksize, filters):
+            if dictionaries and path_attrs.get('dictionaries') != dictionaries:
+                chunk = recode_ids(chunk, dictionaries)
+            yield chunk
+
+
+def common_dictionaries(attrs):
+    """Dictionaries that extend those of all of attrs (None if none)."""
+    dictionaries = None
+
+    for file_attrs in attrs:
+        current = file_attrs.get('dictionaries')
+        if current is None:
+            continue
+        if dictionaries is None:
+            dictionaries = current
+        elif current != dictionaries:
+            dictionaries = extend_dictionaries(dictionaries, current)
+
+    return dictionaries
+
+
+def combine_ids(frames):
+    """Re-encode frames with common dictionaries, if they differ."""
+    dictionaries = common_dictionaries([id_attrs(df) for df in frames])
+
+    if dictionaries is None:
+        return frames
+
+    return [df if df.attrs.get('dictionaries') == dictionaries
+            else recode_ids(df, dictionaries)
+            for df in frames]
+
+
+def empty_frame(root, columns = None):
+    """A dataframe with no rows and the columns of the files of a dataset."""
+    from .files import schema_attrs
+
+    manifest = read_manifest(root)
+
+    if len(manifest['files']) == 0:
+        return pd.DataFrame(columns = columns)
+
+    path = os.path.join(root, manifest['files'][0]['path'])
+
+    import pyarrow as pa
+
+    if manifest['format'] == 'parquet':
+        import pyarrow.parquet as pq
+        schema = pq.read_schema(path)
+    else:
+        with pa.memory_map(path) as source:
+            schema = pa.ipc.open_file(source).schema
+
+    df = schema.empty_table().to_pandas()
+    df.attrs.update(schema_attrs(schema))
+
+    return df if columns is None else df[columns]
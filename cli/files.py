@@ -0,0 +1,1067 @@
+"""Reading and writing the tabular files produced by each pipeline stage."""
+
+import os
+import gzip
+import json
+import tempfile
+import numpy     as np
+import pandas    as pd
+
+from .ids        import decode_ids
+from .ids        import encode_filters
+from .ids        import id_string
+from .datasets   import is_dataset
+
+
+formats = ['pkl', 'parquet', 'feather']
+"""Supported formats for intermediate dataframes."""
+
+compressions = ['snappy', 'gzip', 'brotli', 'zstd', 'lz4', 'none']
+"""Supported parquet compression codecs."""
+
+format_to_extensions = {
+    'pkl'     : ['.pkl', '.pickle'],
+    'parquet' : ['.parquet', '.pq'],
+    'feather' : ['.feather', '.arrow', '.ipc'],
+    'csv'     : ['.csv', '.gz', '.zst']
+}
+
+format_magic = {
+    'parquet' : b'PAR1',
+    'feather' : b'ARROW1'
+}
+
+csv_compressions = ['none', 'gzip', 'zstd']
+"""Supported compressions of csv files."""
+
+csv_compression_extensions = {
+    'gzip' : '.gz',
+    'zstd' : '.zst'
+}
+
+feather_compressions = ['lz4', 'zstd']
+
+
+def infer_format(path):
+    """
+    Infer the format of a dataframe file from its extension.
+
+    Compressed files have the extension of their format before that of their
+    compression (e.g. trips.pkl.gz), and are csv files if they have none.
+    Files with an unknown extension are sniffed for the parquet and feather
+    magic bytes, and assumed to be pickles otherwise.
+    """
+    root, extension = os.path.splitext(path)
+    extension = extension.lower()
+
+    if extension in csv_compression_extensions.values():
+        inner = os.path.splitext(root)[1].lower()
+        for format, extensions in format_to_extensions.items():
+            if inner in extensions:
+                return format
+        return 'csv'
+
+    for format, extensions in format_to_extensions.items():
+        if extension in extensions:
+            return format
+
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            head = f.read(max(len(magic) for magic in format_magic.values()))
+
+        for format, magic in format_magic.items():
+            if head.startswith(magic):
+                return format
+
+    return 'pkl'
+
+
+def file_root(path):
+    """path without the extensions of its format and compression."""
+    root, extension = os.path.splitext(path)
+
+    if extension.lower() in csv_compression_extensions.values():
+        inner_root, inner = os.path.splitext(root)
+        if any(inner.lower() in extensions
+               for extensions in format_to_extensions.values()):
+            return inner_root
+        return root
+
+    return root
+
+
+def frame_size(path):
+    """Size in bytes of a dataframe file, or of the files of a dataset."""
+    if is_dataset(path):
+        from .datasets import dataset_files
+        return sum(os.stat(f).st_size for f in dataset_files(path))
+
+    return os.stat(path).st_size
+
+
+def read_frame(
+    path,
+    columns = None,
+    time_column = None,
+    start = None,
+    end = None,
+    filters = None
+):
+    """
+    Read a dataframe written by any of the pipeline stages.
+
+    If columns is given, only those columns are returned. Parquet and feather
+    files only decode the requested columns, using multiple threads. Feather
+    files are memory-mapped, so other columns are never read from disk, but
+    the requested ones are still copied into the dataframe.
+
+    Rows can be filtered by a time range [start, end) of time_column (see
+    time_range_mask), and by filters in disjunctive normal form: a list of
+    lists of (column, op, value) conditions, where op is '=' or 'in', as in
+    pyarrow. Filters on ids match the ids of encoded files (see cli.ids), and
+    their values are cast to the type of each column (see cast_filters).
+    For parquet and feather files, filters are pushed down to arrow, which
+    skips row groups that can't match them.
+
+    path can also be the root of a dataset (see cli.datasets), of which only
+    the files that can match the filters are read.
+    """
+    if is_dataset(path):
+        from .datasets import read_dataset
+        return read_dataset(path, columns, time_column, start, end, filters)
+
+    format = infer_format(path)
+
+    # The columns of filters are needed to filter rows, even if not selected
+    read_columns = columns
+    if columns is not None:
+        read_columns = columns + [
+            c for c in filter_columns(time_column, start, end, filters)
+            if c not in columns]
+
+    if format in ['parquet', 'feather']:
+        schema = file_schema(path, format)
+        attrs = schema_attrs(schema)
+
+        expression = filter_expression(
+            time_column, start, end,
+            cast_filters(encode_filters(filters or [], attrs),
+                         arrow_kinds(schema)))
+
+        if format == 'parquet':
+            df = pd.read_parquet(path, columns = read_columns,
+                                 filters = expression, use_threads = True)
+        else:
+            import pyarrow.feather as feather
+
+            table = feather.read_table(path, columns = read_columns,
+                                       memory_map = True, use_threads = True)
+            if expression is not None:
+                table = table.filter(expression)
+
+            df = table.to_pandas(use_threads = True)
+
+        # Written by FrameWriter, or by versions of pandas without attrs
+        if len(df.attrs) == 0:
+            df.attrs.update(attrs)
+
+        # Conditions on pairs of columns can't be pushed down to arrow
+        if has_pair_filters(filters):
+            mask = filter_mask(df, None,
+                               filters = encode_filters(filters, attrs))
+            df = df[mask].reset_index(drop = True)
+
+    else:
+        if format == 'csv':
+            df = pd.read_csv(
+                csv_source(path),
+                usecols = read_columns,
+                parse_dates = time_columns(time_column) or None)
+        else:
+            df = pd.read_pickle(path)
+            if read_columns is not None:
+                df = df[read_columns]
+
+        mask = filter_mask(df, time_column, start, end,
+                           encode_filters(filters or [], df.attrs))
+        if mask is not None:
+            df = df[mask]
+
+    return df if read_columns == columns else df[columns]
+
+
+def write_frame(df, path, format = None, compression = 'snappy'):
+    """
+    Write a dataframe as a pickle, parquet, feather or csv file.
+
+    The format defaults to the one inferred from the extension of path.
+    The compression codec only applies to parquet and feather files. Parquet
+    and feather files are written with FrameWriter, which keeps the attrs of
+    df (e.g. the dictionaries of encoded ids) in their schema metadata with
+    any version of pandas.
+    """
+    if format is None:
+        format = infer_format(path)
+
+    if format in ['parquet', 'feather']:
+        with FrameWriter(path, format, compression) as writer:
+            writer.write(df)
+    elif format == 'csv':
+        write_csv(df, path)
+    elif format == 'pkl':
+        df.to_pickle(path)
+    else:
+        raise ValueError("Unsupported format '{}'".format(format))
+
+
+def replace_frame(df, path, format = None, compression = 'snappy'):
+    """
+    Write a dataframe over an existing file, atomically.
+
+    The dataframe is written to a temporary file in the same directory, which
+    then replaces path, so path is left untouched if writing fails.
+    """
+    if format is None:
+        format = infer_format(path)
+
+    folder, name = os.path.split(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(
+        dir = folder, prefix = '.{}.'.format(name),
+        suffix = os.path.splitext(name)[1])
+    os.close(fd)
+
+    try:
+        write_frame(df, tmp, format, compression)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def frame_header(path, columns = None):
+    """
+    A dataframe with no rows and the columns, types and attrs of a dataframe
+    file or dataset, e.g. to write a query that matched no rows.
+    """
+    if is_dataset(path):
+        from .datasets import empty_frame
+        return empty_frame(path, columns)
+
+    format = infer_format(path)
+
+    if format in ['parquet', 'feather']:
+        schema = file_schema(path, format)
+        df = schema.empty_table().to_pandas()
+        df.attrs.update(schema_attrs(schema))
+    elif format == 'csv':
+        df = pd.read_csv(csv_source(path), nrows = 0)
+    else:
+        df = pd.read_pickle(path).iloc[:0]
+
+    return df if columns is None else df[columns]
+
+
+def encode_geometries(df):
+    """
+    Encode columns of shapely geometries (e.g. routes) as WKB bytes.
+
+    Arrow based formats can't store python objects. Geometries can be decoded
+    with shapely.wkb.loads.
+    """
+    geometry_columns = []
+
+    for col in df.columns:
+        if df[col].dtype == object:
+            values = df[col].dropna()
+            if len(values) > 0 and hasattr(values.iloc[0], 'wkb'):
+                geometry_columns.append(col)
+
+    if len(geometry_columns) == 0:
+        return df
+
+    df = df.copy(deep = False)
+    for col in geometry_columns:
+        df[col] = df[col].map(lambda g: None if g is None else g.wkb)
+
+    return df
+
+
+def time_range_mask(df, time_column, start = None, end = None):
+    """
+    Rows of df whose time_column is within [start, end).
+
+    time_column can also be a pair of columns with the start and end time of
+    an interval (e.g. t_origin and t_destination of trip steps), in which
+    case rows whose interval overlaps [start, end) are kept. If either end of
+    an interval is missing, the interval is the other one.
+    """
+    first, last = time_interval(time_column)
+
+    t_first = df[first] if first == last else df[first].fillna(df[last])
+    t_last = df[last] if first == last else df[last].fillna(df[first])
+
+    mask = np.ones(len(df), dtype = bool)
+
+    if start is not None:
+        mask &= (t_last >= pd.Timestamp(start)).values
+    if end is not None:
+        mask &= (t_first < pd.Timestamp(end)).values
+
+    return mask
+
+
+def time_range_expression(time_column, start = None, end = None):
+    """The filter of time_range_mask as a pyarrow expression."""
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    first, last = time_interval(time_column)
+
+    if first == last:
+        t_first = t_last = ds.field(first)
+    else:
+        t_first = pc.coalesce(ds.field(first), ds.field(last))
+        t_last = pc.coalesce(ds.field(last), ds.field(first))
+
+    expression = None
+    if start is not None:
+        expression = t_last >= pd.Timestamp(start)
+    if end is not None:
+        before_end = t_first < pd.Timestamp(end)
+        expression = before_end if expression is None \
+                     else expression & before_end
+
+    return expression
+
+
+def time_interval(time_column):
+    if isinstance(time_column, str):
+        return time_column, time_column
+
+    first, last = time_column
+    return first, last
+
+
+def time_columns(time_column):
+    if time_column is None:
+        return []
+
+    return list(dict.fromkeys(time_interval(time_column)))
+
+
+def filter_columns(time_column, start = None, end = None, filters = None):
+    """Columns needed to filter rows (see read_frame)."""
+    columns = time_columns(time_column) if (start or end) else []
+
+    for conjunction in filters or []:
+        for column, _, _ in conjunction:
+            columns += list(column) if isinstance(column, tuple) \
+                       else [column]
+
+    return list(dict.fromkeys(columns))
+
+
+def has_pair_filters(filters):
+    """Whether any condition of filters is on a pair of columns."""
+    return any(isinstance(column, tuple)
+               for conjunction in filters or []
+               for column, _, _ in conjunction)
+
+
+def filter_expression(time_column, start = None, end = None, filters = None):
+    """
+    The filters of read_frame as a pyarrow expression (None if none).
+
+    Conditions on pairs of columns can't be expressed in arrow, and are left
+    out, so rows that match the expression must then be filtered by
+    filter_mask (see has_pair_filters).
+    """
+    expression = None
+
+    if time_column is not None and (start is not None or end is not None):
+        expression = time_range_expression(time_column, start, end)
+
+    if filters:
+        import pyarrow.compute as pc
+        import pyarrow.dataset as ds
+
+        def condition(column, op, value):
+            if isinstance(column, tuple):
+                return pc.scalar(True)
+            if op != 'in':
+                return ds.field(column) == value
+            if len(value) == 0:
+                return pc.scalar(False)
+            return ds.field(column).isin(np.asarray(value))
+
+        matches = None
+        for conjunction in filters:
+            match = pc.scalar(True)
+            for column, op, value in conjunction:
+                match = match & condition(column, op, value)
+
+            matches = match if matches is None else matches | match
+
+        expression = matches if expression is None else expression & matches
+
+    return expression
+
+
+def filter_mask(df, time_column, start = None, end = None, filters = None):
+    """
+    The filters of read_frame as a boolean mask (None if none).
+
+    A condition can also be on a pair of columns, e.g. (('origin',
+    'destination'), 'in', [(o1, d1), (o2, d2)]), which rows match if their
+    pair of values is one of the given ones. It's matched with a single hash
+    lookup, whatever the number of pairs.
+    """
+    mask = None
+
+    if time_column is not None and (start is not None or end is not None):
+        mask = time_range_mask(df, time_column, start, end)
+
+    if filters:
+        filters = cast_filters(filters, pandas_kinds(df))
+        matches = np.zeros(len(df), dtype = bool)
+
+        for conjunction in filters:
+            match = np.ones(len(df), dtype = bool)
+            for column, op, value in conjunction:
+                if isinstance(column, tuple):
+                    match &= pd.MultiIndex.from_arrays(
+                        [df[c] for c in column]).isin(value)
+                    continue
+                match &= df[column].isin(value if op == 'in' else [value])\
+                                   .values
+            matches |= match
+
+        mask = matches if mask is None else mask & matches
+
+    return mask
+
+
+def cast_filters(filters, kinds):
+    """
+    Cast the values of filters to the type of their columns.
+
+    Ids are given as strings, but may be stored as integers, or as floats if
+    some are missing. kinds maps columns to 'i', 'f' or 'U', for integer,
+    float and string columns (see pandas_kinds and arrow_kinds). Values that
+    can't be cast, e.g. non-numeric ids of an integer column, match no row.
+    """
+    def cast_pairs(columns, value):
+        pairs = []
+        for pair in value:
+            pair = tuple(cast_value(v, kinds[c]) if c in kinds else v
+                         for c, v in zip(columns, pair))
+            if all(v is not None for v in pair):
+                pairs.append(pair)
+        return pairs
+
+    def cast(column, op, value):
+        if isinstance(column, tuple):
+            return column, op, cast_pairs(column, value)
+
+        kind = kinds.get(column)
+        if kind is None:
+            return column, op, value
+
+        values = [cast_value(v, kind)
+                  for v in (value if op == 'in' else [value])]
+        values = [v for v in values if v is not None]
+
+        if op == 'in':
+            return column, op, values
+        if len(values) == 0:
+            return column, 'in', []
+        return column, op, values[0]
+
+    return [[cast(*condition) for condition in conjunction]
+            for conjunction in filters]
+
+
+def cast_value(value, kind):
+    """value as an int, float or str (see cast_filters), or None."""
+    try:
+        if kind == 'f':
+            return float(value)
+
+        if kind == 'i':
+            if isinstance(value, (float, np.floating)):
+                return int(value) if float(value).is_integer() else None
+            try:
+                return int(value)
+            except ValueError:
+                number = float(value)
+                return int(number) if number.is_integer() else None
+
+        return id_string(value)
+
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def pandas_kinds(df):
+    """Kind of each integer, float and string column of df."""
+    kinds = {}
+
+    for column, dtype in df.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            dtype = dtype.categories.dtype
+
+        if pd.api.types.is_bool_dtype(dtype):
+            continue
+        elif pd.api.types.is_integer_dtype(dtype):
+            kinds[column] = 'i'
+        elif pd.api.types.is_float_dtype(dtype):
+            kinds[column] = 'f'
+        elif pd.api.types.is_string_dtype(dtype):
+            kinds[column] = 'U'
+
+    return kinds
+
+
+def arrow_kinds(schema):
+    """Kind of each integer, float and string field of an arrow schema."""
+    import pyarrow as pa
+
+    kinds = {}
+
+    for field in schema:
+        type = field.type
+        if pa.types.is_dictionary(type):
+            type = type.value_type
+
+        if pa.types.is_integer(type):
+            kinds[field.name] = 'i'
+        elif pa.types.is_floating(type):
+            kinds[field.name] = 'f'
+        elif pa.types.is_string(type) or pa.types.is_large_string(type):
+            kinds[field.name] = 'U'
+
+    return kinds
+
+
+def iter_frames(
+    path,
+    columns = None,
+    time_column = None,
+    start = None,
+    end = None,
+    chunksize = 1000000,
+    filters = None
+):
+    """
+    Read a dataframe file in chunks of at most chunksize rows.
+
+    Parquet and feather files are streamed one record batch at a time, only
+    decoding the requested columns, and the time range [start, end) of
+    time_column and filters (see read_frame) are pushed down to skip row
+    groups that can't match them. Csv files are read in chunks. Pickles can't
+    be streamed and are read whole. Datasets (see cli.datasets) are read one
+    file at a time.
+    """
+    if is_dataset(path):
+        from .datasets import iter_dataset
+        yield from iter_dataset(path, columns, time_column, start, end,
+                                chunksize, filters)
+        return
+
+    format = infer_format(path)
+
+    read_columns = columns
+    if columns is not None:
+        read_columns = columns + [
+            c for c in filter_columns(time_column, start, end, filters)
+            if c not in columns]
+
+    if format in ['parquet', 'feather']:
+        import pyarrow.dataset as ds
+
+        dataset = ds.dataset(path,
+                             format = 'parquet' if format == 'parquet' \
+                                      else 'ipc')
+
+        attrs = schema_attrs(dataset.schema)
+
+        expression = filter_expression(
+            time_column, start, end,
+            cast_filters(encode_filters(filters or [], attrs),
+                         arrow_kinds(dataset.schema)))
+
+        # Conditions on pairs of columns can't be pushed down to arrow
+        pair_filters = None
+        if has_pair_filters(filters):
+            pair_filters = encode_filters(filters, attrs)
+        else:
+            read_columns = columns
+
+        for batch in dataset.to_batches(columns = read_columns,
+                                        filter = expression,
+                                        batch_size = chunksize):
+            if batch.num_rows > 0:
+                chunk = batch.to_pandas()
+                chunk.attrs.update(attrs)
+                if pair_filters is not None:
+                    chunk = chunk[filter_mask(chunk, None,
+                                              filters = pair_filters)]
+                if read_columns != columns:
+                    chunk = chunk[columns]
+                if len(chunk) > 0:
+                    yield chunk
+        return
+
+    if format == 'csv':
+        chunks = pd.read_csv(
+            csv_source(path),
+            usecols = read_columns,
+            parse_dates = time_columns(time_column) or None,
+            chunksize = chunksize
+        )
+    else:
+        df = pd.read_pickle(path)
+        if read_columns is not None:
+            df = df[read_columns]
+        filters = encode_filters(filters or [], df.attrs)
+        chunks = (df.iloc[i:i + chunksize]
+                  for i in range(0, len(df), chunksize))
+
+    for chunk in chunks:
+        mask = filter_mask(chunk, time_column, start, end, filters)
+        if mask is not None:
+            chunk = chunk[mask]
+        if read_columns != columns:
+            chunk = chunk[columns]
+        if len(chunk) > 0:
+            yield chunk
+
+
+def merge_sorted_frames(paths, column, chunksize = 1000000):
+    """
+    Merge files sorted by column into a sequence of sorted dataframes.
+
+    Files are read in chunks (see iter_frames) of chunksize rows in total, so
+    only about chunksize rows are held in memory at a time, plus any rows of
+    a file that share the last value read from it. Rows with the same value
+    are in the order of paths, and then in their order within each file, as
+    with a stable sort of the concatenation of the files. column must not
+    have missing values.
+    """
+    readers = [iter_frames(path, chunksize = max(chunksize // len(paths), 1))
+               for path in paths] if len(paths) > 0 else []
+    heads = [None] * len(paths)
+    done = [False] * len(paths)
+
+    def read(i):
+        chunk = next(readers[i], None)
+        if chunk is None:
+            done[i] = True
+        elif heads[i] is None or len(heads[i]) == 0:
+            heads[i] = chunk
+        else:
+            heads[i] = pd.concat([heads[i], chunk])
+
+    while True:
+        for i in range(len(paths)):
+            while not done[i] and (heads[i] is None or len(heads[i]) == 0):
+                read(i)
+
+        reading = [i for i in range(len(paths)) if not done[i]]
+
+        # Rows before the smallest last value read from a file that isn't
+        # read in full can't be preceded by rows that are still to be read
+        bound = None if len(reading) == 0 else \
+                min(heads[i][column].values[-1] for i in reading)
+
+        parts = []
+        for i, head in enumerate(heads):
+            if head is None:
+                continue
+            end = len(head) if bound is None else \
+                  head[column].values.searchsorted(bound, side = 'left')
+            parts.append(head.iloc[:end])
+            heads[i] = head.iloc[end:]
+
+        parts = [part for part in parts if len(part) > 0]
+        if len(parts) > 0:
+            yield pd.concat(parts, ignore_index = True)\
+                    .sort_values(column, kind = 'mergesort')\
+                    .reset_index(drop = True)
+
+        if bound is None:
+            return
+
+        # Files whose rows left all have the bound are read further
+        for i in reading:
+            if heads[i][column].values[-1] == bound:
+                read(i)
+
+
+class FrameWriter:
+    """
+    Write a dataframe incrementally, one chunk at a time.
+
+    Parquet files are written one row group per chunk, feather files one
+    record batch per chunk and csv files are appended to, so only one chunk
+    needs to be in memory at a time. Pickles can't be appended to, so chunks
+    are kept in memory and written when the writer is closed. The attrs of
+    the first chunk (e.g. the dictionaries of encoded ids, see cli.ids) are
+    kept in the file, except in csv files, whose ids are decoded.
+
+    The schema of parquet and feather files is fixed once the file is opened,
+    but columns whose values are all missing have no type yet. Chunks are
+    held back until all columns have a type, or until buffer_rows rows are
+    held, after which columns that still have no type are written as
+    strings.
+
+    For csv files, compression is one of csv_compressions (inferred from the
+    extension of path by default) and floating point columns can be written
+    in single precision or rounded to a number of decimal places.
+    """
+
+    def __init__(
+        self,
+        path,
+        format = None,
+        compression = None,
+        single_precision = False,
+        precision = None,
+        buffer_rows = 1000000
+    ):
+        self.path = path
+        self.format = format or infer_format(path)
+        self.compression = compression
+        self.single_precision = single_precision
+        self.precision = precision
+        self.buffer_rows = buffer_rows
+
+        self.writer = None
+        self.sink = None
+        self.schema = None
+        self.chunks = []
+
+        if self.format == 'csv' and compression is None:
+            self.compression = infer_csv_compression(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, df):
+        if self.format == 'pkl':
+            self.chunks.append(df)
+            return
+
+        if self.format == 'csv':
+            df = downcast(decode_ids(df), self.single_precision,
+                          self.precision, compact = False)
+
+            if self.sink is None:
+                self.sink = self.open_csv()
+                self.sink.write(df.iloc[:0].to_csv(index = False).encode())
+
+            self.sink.write(csv_chunk(df))
+            return
+
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(pd.DataFrame(encode_geometries(df)),
+                                     preserve_index = False)
+
+        if self.writer is not None:
+            self.writer.write_table(table.cast(self.schema))
+            return
+
+        if len(self.chunks) == 0 and len(df.attrs) > 0:
+            table = table.replace_schema_metadata({
+                **(table.schema.metadata or {}),
+                b'PANDAS_ATTRS' : json.dumps(df.attrs).encode()
+            })
+
+        # Columns that are all missing so far are typed by later chunks
+        self.chunks.append(table)
+        self.schema = pa.unify_schemas([self.schema or table.schema,
+                                        table.schema])
+
+        if has_null_fields(self.schema) and \
+           sum(t.num_rows for t in self.chunks) < self.buffer_rows:
+            return
+
+        self.flush()
+
+    def flush(self):
+        """Open the file with the schema of the chunks held so far."""
+        self.schema = promote_null_fields(self.schema)
+        self.writer = self.open(self.schema)
+
+        for table in self.chunks:
+            self.writer.write_table(table.cast(self.schema))
+
+        self.chunks = []
+
+    def open(self, schema):
+        import pyarrow as pa
+
+        if self.format == 'parquet':
+            import pyarrow.parquet as pq
+            return pq.ParquetWriter(
+                self.path, schema,
+                compression = 'none' if self.compression is None \
+                              else self.compression
+            )
+
+        if self.format == 'feather':
+            compression = self.compression \
+                          if self.compression in feather_compressions else None
+            return pa.ipc.new_file(
+                self.path, schema,
+                options = pa.ipc.IpcWriteOptions(compression = compression)
+            )
+
+        raise ValueError("Unsupported format '{}'".format(self.format))
+
+    def open_csv(self):
+        """
+        Open a csv file for writing.
+
+        pyarrow compresses zstd files without needing the zstandard package.
+        """
+        try:
+            import pyarrow as pa
+        except ImportError:
+            pa = None
+
+        if pa is not None:
+            return pa.output_stream(
+                self.path,
+                compression = None if self.compression == 'none' \
+                              else self.compression
+            )
+
+        if self.compression == 'gzip':
+            return gzip.open(self.path, 'wb')
+        if self.compression == 'zstd':
+            raise ValueError("Writing zstd compressed csv files needs pyarrow")
+
+        return open(self.path, 'wb', buffering = 1 << 20)
+
+    def close(self):
+        if self.format == 'pkl':
+            df = pd.concat(self.chunks, ignore_index = True) \
+                 if len(self.chunks) > 0 else pd.DataFrame()
+            if len(self.chunks) > 0:
+                df.attrs = self.chunks[0].attrs
+            self.chunks = []
+            df.to_pickle(self.path)
+            return
+
+        if self.writer is None and len(self.chunks) > 0:
+            self.flush()
+
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+
+
+    def abort(self):
+        """
+        Stop writing and delete the file, which would be left incomplete.
+        """
+        opened = self.writer is not None or self.sink is not None
+
+        for handle in [self.writer, self.sink]:
+            if handle is not None:
+                try:
+                    handle.close()
+                except Exception:
+                    pass
+
+        self.writer = None
+        self.sink = None
+        self.chunks = []
+
+        if opened and os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def has_null_fields(schema):
+    import pyarrow as pa
+    return any(pa.types.is_null(field.type) for field in schema)
+
+
+def promote_null_fields(schema):
+    """Schema with fields that have no type yet as strings."""
+    import pyarrow as pa
+
+    for i, field in enumerate(schema):
+        if pa.types.is_null(field.type):
+            schema = schema.set(i, field.with_type(pa.string()))
+
+    return schema
+
+
+def csv_chunk(df):
+    """
+    A chunk of rows of a csv file, without header, as bytes.
+
+    pyarrow's multi-threaded writer is used when no value needs to be
+    quoted, which is the common case, so that the output is the same as
+    DataFrame.to_csv's, which is used otherwise.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+    except ImportError:
+        return df.to_csv(index = False, header = False).encode()
+
+    errors = (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError)
+    buffer = pa.BufferOutputStream()
+
+    try:
+        pa_csv.write_csv(
+            pa.Table.from_pandas(pd.DataFrame(df), preserve_index = False),
+            buffer,
+            write_options = pa_csv.WriteOptions(include_header = False,
+                                                quoting_style = 'none'))
+        return buffer.getvalue().to_pybytes()
+    except errors:
+        # Values with delimiters, quotes or line breaks, or python objects
+        pass
+
+    # Values are formatted as by pyarrow, so that all chunks are alike
+    text = pd.DataFrame(index = df.index)
+    for col in df.columns:
+        try:
+            text[col] = pa.array(df[col]).cast(pa.string())\
+                          .to_numpy(zero_copy_only = False)
+        except errors:
+            text[col] = df[col]
+
+    return text.to_csv(index = False, header = False).encode()
+
+
+def file_attrs(path, format):
+    """The attrs of the dataframe stored in a parquet or feather file."""
+    return schema_attrs(file_schema(path, format))
+
+
+def file_schema(path, format):
+    """The arrow schema of a parquet or feather file."""
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(path)
+
+    import pyarrow as pa
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).schema
+
+
+def schema_attrs(schema):
+    """The attrs of the dataframe stored with an arrow schema, if any."""
+    metadata = schema.metadata or {}
+
+    if b'PANDAS_ATTRS' in metadata:
+        return json.loads(metadata[b'PANDAS_ATTRS'])
+
+    if b'pandas' in metadata:
+        return json.loads(metadata[b'pandas']).get('attributes', {})
+
+    return {}
+
+
+def infer_csv_compression(path):
+    """Infer the compression of a csv file from its extension."""
+    extension = os.path.splitext(path)[1].lower()
+
+    for compression, ext in csv_compression_extensions.items():
+        if extension == ext:
+            return compression
+
+    return 'none'
+
+
+def csv_source(path):
+    """
+    Path or stream from which to read a csv file.
+
+    pandas needs the zstandard package to read zstd compressed files, so
+    these are decompressed with pyarrow instead.
+    """
+    if infer_csv_compression(path) == 'zstd':
+        import pyarrow as pa
+        return pa.input_stream(path, compression = 'zstd')
+
+    return path
+
+
+def downcast(df, single_precision = False, precision = None, compact = True):
+    """
+    Reduce the size of numeric columns before writing them as text.
+
+    Floats are converted to float32 if single_precision, and rounded to the
+    given number of decimal places if precision is given. If compact,
+    integers are also downcast to the smallest type that holds them, and
+    timestamps without fractional seconds are truncated to seconds, so that
+    they are written without them. These depend on the values of df, so they
+    shouldn't be applied to each chunk of a larger dataframe separately.
+    """
+    df = df.copy(deep = False)
+
+    for col in df.columns:
+        dtype = df[col].dtype
+
+        if pd.api.types.is_float_dtype(dtype):
+            if precision is not None:
+                df[col] = df[col].round(precision)
+            if single_precision:
+                df[col] = df[col].astype(np.float32)
+
+        elif not compact:
+            continue
+
+        elif pd.api.types.is_integer_dtype(dtype):
+            df[col] = pd.to_numeric(df[col], downcast = 'integer')
+
+        elif pd.api.types.is_datetime64_dtype(dtype):
+            values = df[col].dropna().values.astype('datetime64[ns]')
+            if np.all(values.astype(np.int64) % 10**9 == 0):
+                df[col] = df[col].astype('datetime64[s]')
+
+    return df
+
+
+def write_csv(
+    df,
+    path,
+    compression = None,
+    single_precision = False,
+    precision = None,
+    chunksize = 1000000
+):
+    """
+    Write a dataframe as csv, in chunks, with a high-throughput writer.
+
+    Encoded ids are decoded (see cli.ids) and numeric columns are downcast
+    first (see downcast). The compression (none, gzip or zstd) is inferred
+    from the extension of path by default, and applied on the fly. pyarrow's
+    multi-threaded csv writer is used for chunks whose values don't need
+    quoting, if available, and DataFrame.to_csv otherwise (see csv_chunk).
+    """
+    if compression is None:
+        compression = infer_csv_compression(path)
+
+    df = downcast(decode_ids(df), single_precision, precision)
+
+    with FrameWriter(path, 'csv', compression) as writer:
+        for start in range(0, max(len(df), 1), chunksize):
+            writer.write(df.iloc[start:start + chunksize])
@@ -0,0 +1,137 @@
+"""Filters of the rows read by compute commands, by time and camera."""
+
+import os
+import click
+
+from .ids        import id_strings
+
+
+def filter_options(command):
+    """Add the --start, --end, --cameras and --pairs options to a command."""
+    options = [
+        click.option(
+            '--start',
+            type = str,
+            default = None,
+            required = False,
+            help = ("Only read observations, or trip steps that end, at or "
+                    "after this time (e.g. 2019-01-07).")
+        ),
+        click.option(
+            '--end',
+            type = str,
+            default = None,
+            required = False,
+            help = ("Only read observations, or trip steps that start, "
+                    "before this time (e.g. 2019-01-14).")
+        ),
+        click.option(
+            '--cameras',
+            type = str,
+            default = None,
+            required = False,
+            help = ("Only read observations at, or trip steps from or to, "
+                    "these cameras: comma separated ids, or a geospatial "
+                    "file of cameras with an 'id' column.")
+        ),
+        click.option(
+            '--pairs',
+            type = str,
+            default = None,
+            required = False,
+            help = ("Only read trip steps between these camera pairs, or "
+                    "observations at their cameras: comma separated "
+                    "origin:destination ids, or a file of camera pairs.")
+        )
+    ]
+
+    for option in options:
+        command = option(command)
+
+    return command
+
+
+def parse_cameras(value):
+    """Camera ids of --cameras, or None if not given."""
+    if value is None:
+        return None
+
+    if os.path.isfile(value):
+        import geopandas as gpd
+        return id_strings(gpd.read_file(value)['id']).dropna().tolist()
+
+    return [camera.strip() for camera in value.split(',') if camera.strip()]
+
+
+def parse_pairs(value):
+    """(origin, destination) pairs of --pairs, or None if not given."""
+    if value is None:
+        return None
+
+    if os.path.exists(value):
+        from .pairs import read_camera_pairs
+        pairs = read_camera_pairs(value)
+        return list(zip(id_strings(pairs['origin']),
+                        id_strings(pairs['destination'])))
+
+    pairs = []
+    for pair in value.split(','):
+        if not pair.strip():
+            continue
+
+        if pair.count(':') != 1:
+            raise click.BadParameter(
+                "Camera pairs must be given as origin:destination, "
+                "got '{}'".format(pair),
+                param_hint = '--pairs')
+
+        origin, destination = pair.split(':')
+        pairs.append((origin.strip(), destination.strip()))
+
+    return pairs
+
+
+def camera_filters(cameras = None, pairs = None, columns = ('camera',)):
+    """
+    Filters of read_frame (see cli.files) for --cameras and --pairs.
+
+    With a single camera column, as in observations, rows at any of the
+    cameras (and at any camera of the pairs) are kept. With origin and
+    destination columns, as in trip steps, steps from or to any of the
+    cameras, and between any of the pairs, are kept.
+
+    Pairs are matched by a single condition on both columns, whatever their
+    number (see files.filter_mask), and narrowed down beforehand by their
+    origins and destinations, which parquet and feather files can push down.
+    """
+    if cameras is None and pairs is None:
+        return None
+
+    if len(columns) == 1:
+        ids = set(cameras) if cameras is not None else set()
+        if pairs is not None:
+            pair_ids = set(o for o, _ in pairs) | set(d for _, d in pairs)
+            ids = pair_ids if cameras is None else ids & pair_ids
+
+        return [[(columns[0], 'in', sorted(ids))]]
+
+    origin, destination = columns
+
+    if pairs is None:
+        return [[(column, 'in', sorted(set(cameras)))]
+                for column in columns]
+
+    pairs = set(pairs)
+    if cameras is not None:
+        cameras = set(cameras)
+        pairs = set((o, d) for o, d in pairs
+                    if o in cameras or d in cameras)
+
+    return [[(origin, 'in', sorted(set(o for o, _ in pairs))),
+             (destination, 'in', sorted(set(d for _, d in pairs))),
+             ((origin, destination), 'in', sorted(pairs))]]
+
+
+def is_filtered(start, end, cameras, pairs):
+    """Whether any of the options of filter_options were given."""
+    return any(value is not None for value in [start, end, cameras, pairs])
@@ -0,0 +1,737 @@
+"""Road network graphs: building, storing and caching them."""
+
+import os
+import re
+import json
+import pickle
+import shutil
+import hashlib
+import tempfile
+import contextlib
+import subprocess
+import numpy     as np
+import pandas    as pd
+import networkx  as nx
+
+from collections import namedtuple
+
+from anprx.utils import settings
+from anprx.utils import log
+
+
+graph_extension = '.graph'
+
+BBox = namedtuple('BBox', ['north', 'south', 'east', 'west'])
+
+def camera_bbox(cameras):
+    """Bounding box of a set of cameras, in degrees."""
+    if 'lat' in cameras.columns and 'lon' in cameras.columns:
+        lat, lon = cameras['lat'], cameras['lon']
+    else:
+        points = cameras.geometry.to_crs(epsg = 4326)
+        lat, lon = points.y, points.x
+
+    return BBox(north = lat.max(), south = lat.min(),
+                east = lon.max(), west = lon.min())
+
+
+@contextlib.contextmanager
+def offline_osm(path):
+    """
+    Serve the graph requests of osmnx from a local OpenStreetMap extract.
+
+    While active, ox.graph_from_bbox and ox.graph_from_polygon build graphs
+    from the extract (see graph_from_extract) instead of downloading them.
+    Callers, such as anprx's network_from_cameras, are otherwise unchanged:
+    they still choose the bounding box, the road filter, and how the graph
+    is projected, filtered and plotted.
+    """
+    import osmnx as ox
+
+    def graph_from_bbox(*args, **kwargs):
+        # osmnx < 2 takes north, south, east and west, osmnx 2 a single
+        # (west, south, east, north) tuple
+        if len(args) == 1 or 'bbox' in kwargs:
+            west, south, east, north = kwargs.pop('bbox', None) or args[0]
+        else:
+            bounds = dict(zip(['north', 'south', 'east', 'west'], args))
+            bounds.update({key : kwargs.pop(key) for key in
+                           ['north', 'south', 'east', 'west']
+                           if key in kwargs})
+            north, south, east, west = [
+                bounds[key] for key in ['north', 'south', 'east', 'west']]
+
+        return graph_from_extract(
+            path, BBox(north, south, east, west), **osm_kwargs(kwargs))
+
+    def graph_from_polygon(polygon, *args, **kwargs):
+        west, south, east, north = polygon.bounds
+        return graph_from_extract(
+            path, BBox(north, south, east, west), polygon = polygon,
+            **osm_kwargs(kwargs))
+
+    patched = {'graph_from_bbox'    : graph_from_bbox,
+               'graph_from_polygon' : graph_from_polygon}
+    original = {name : getattr(ox, name, None) for name in patched}
+
+    for name, f in patched.items():
+        setattr(ox, name, f)
+
+    try:
+        yield
+    finally:
+        for name, f in original.items():
+            if f is None:
+                delattr(ox, name)
+            else:
+                setattr(ox, name, f)
+
+
+def osm_kwargs(kwargs):
+    """Arguments of osmnx graph requests that graph_from_extract uses."""
+    return {key : kwargs[key]
+            for key in ['network_type', 'custom_filter', 'simplify',
+                        'retain_all']
+            if kwargs.get(key) is not None}
+
+
+def graph_from_extract(
+    path,
+    bbox,
+    network_type = 'all_private',
+    custom_filter = None,
+    simplify = True,
+    retain_all = False,
+    polygon = None
+):
+    """
+    Build the road network within bbox from a local OpenStreetMap extract,
+    as osmnx would from the OpenStreetMap API.
+
+    Ways are kept if they match custom_filter, or the filter osmnx uses for
+    network_type, given in overpass syntax. Xml extracts (.osm) are parsed by
+    osmnx. Pbf extracts (.pbf) are first clipped to bbox and converted to xml
+    with osmium-tool, which must be installed.
+    """
+    import osmnx as ox
+    from shapely.geometry import Point
+
+    conditions = osm_filter_conditions(custom_filter or
+                                       network_filter(network_type))
+
+    # Keep the tags the filter needs on the edges
+    tags_setting = 'useful_tags_way' \
+                   if hasattr(ox.settings, 'useful_tags_way') \
+                   else 'useful_tags_path'
+    useful_tags = getattr(ox.settings, tags_setting)
+    setattr(ox.settings, tags_setting, list(useful_tags) + [
+        key for key, _, _ in conditions if key not in useful_tags])
+
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            if path.lower().endswith('.pbf'):
+                path = clip_pbf(path, bbox,
+                                os.path.join(folder, 'extract.osm'))
+
+            log("Parsing OpenStreetMap extract {}.".format(path))
+
+            graph_from_xml = getattr(ox, 'graph_from_xml', None) or \
+                             ox.graph_from_file
+            G = graph_from_xml(path, simplify = False, retain_all = True)
+    finally:
+        setattr(ox.settings, tags_setting, useful_tags)
+
+    G.remove_edges_from([
+        (u, v, k) for u, v, k, data in G.edges(keys = True, data = True)
+        if not matches_osm_filter(data, conditions)
+    ])
+
+    G.remove_nodes_from([
+        node for node, data in G.nodes(data = True)
+        if not (bbox.south <= data['y'] <= bbox.north and
+                bbox.west <= data['x'] <= bbox.east) or
+           (polygon is not None and
+            not polygon.intersects(Point(data['x'], data['y'])))
+    ])
+
+    G.remove_nodes_from(list(nx.isolates(G)))
+
+    if len(G) == 0:
+        raise ValueError("No roads matching {} within {} in {}"\
+                            .format(custom_filter or network_type, bbox,
+                                    path))
+
+    if not retain_all:
+        G = G.subgraph(max(nx.weakly_connected_components(G),
+                           key = len)).copy()
+
+    return ox.simplify_graph(G) if simplify else G
+
+
+def network_filter(network_type):
+    """The overpass filter of osmnx for a network type."""
+    import osmnx as ox
+
+    for module, name in [('_overpass', '_get_network_filter'),
+                         ('downloader', '_get_osm_filter'),
+                         ('core', 'get_osm_filter')]:
+        f = getattr(getattr(ox, module, None), name, None)
+        if f is not None:
+            return f(network_type)
+
+    raise RuntimeError("Can't find the road filters of this version of osmnx")
+
+
+osm_condition = re.compile(r'\["([^"]+)"(?:(=|!=|~|!~)"([^"]*)")?\]')
+
+
+def osm_filter_conditions(osm_filter):
+    """
+    (key, op, value) conditions of an overpass filter, such as
+    '["highway"]["highway"!~"service"]', where op is None for conditions that
+    only require the key.
+    """
+    return [(key, op or None, value)
+            for key, op, value in osm_condition.findall(osm_filter or '')]
+
+
+def matches_osm_filter(tags, conditions):
+    """
+    Whether the tags of a way (the attributes of an edge) match all
+    conditions, as in overpass: negated conditions match missing keys.
+    """
+    for key, op, value in conditions:
+        values = tags.get(key)
+        values = [] if values is None else \
+                 [str(v) for v in (values if isinstance(values, list)
+                                   else [values])]
+
+        if op is None:
+            matches = len(values) > 0
+        elif op == '=':
+            matches = value in values
+        elif op == '!=':
+            matches = value not in values
+        elif op == '~':
+            matches = any(re.search(value, v) for v in values)
+        else:
+            matches = not any(re.search(value, v) for v in values)
+
+        if not matches:
+            return False
+
+    return True
+
+
+def clip_pbf(path, bbox, output):
+    """Clip a pbf extract to bbox, and convert it to xml, using osmium."""
+    if shutil.which('osmium') is None:
+        raise RuntimeError(("Reading .pbf extracts requires osmium-tool. "
+                            "Install it or convert {} to .osm.").format(path))
+
+    subprocess.run([
+        'osmium', 'extract',
+        '--bbox', '{},{},{},{}'.format(bbox.west, bbox.south,
+                                       bbox.east, bbox.north),
+        '--overwrite',
+        '--output', output,
+        path
+    ], check = True)
+
+    return output
+
+
+def cache_folder():
+    return os.path.join(settings['app_folder'],
+                        settings['cache_folder_name'],
+                        'graphs')
+
+
+def graph_cache_key(bbox, road_type, source = None):
+    """
+    Key of a graph in the cache.
+
+    Graphs are identified by the bounding box of the cameras, the road type,
+    and the OpenStreetMap extract they were built from (by its path, size and
+    modification time), if any.
+    """
+    key = {
+        'bbox'      : [round(x, 6) for x in bbox],
+        'road_type' : road_type
+    }
+
+    if source is not None:
+        stat = os.stat(source)
+        key['source'] = [os.path.abspath(source), stat.st_size, stat.st_mtime]
+
+    return hashlib.sha1(json.dumps(key, sort_keys = True).encode())\
+                  .hexdigest()
+
+
+def cached_graph_path(key):
+    return os.path.join(cache_folder(), '{}{}'.format(key, graph_extension))
+
+
+def read_cached_graph(key):
+    """The cached graph with the given key, or None if it isn't cached."""
+    path = cached_graph_path(key)
+
+    if not os.path.isdir(path):
+        return None
+
+    log("Reading road network from cache {}.".format(path))
+
+    return read_graph(path)
+
+
+def write_cached_graph(G, key):
+    os.makedirs(cache_folder(), exist_ok = True)
+
+    path = cached_graph_path(key)
+    write_graph(G, path)
+
+    log("Cached road network in {}.".format(path))
+
+
+class GraphStore:
+    """
+    Compact, columnar representation of a networkx graph.
+
+    Nodes are mapped to consecutive integer codes, and edges are sorted by the
+    code of their source node, so that the adjacency of the graph is stored
+    in CSR form: the edges out of node i are edges indptr[i]:indptr[i+1],
+    and indices holds the code of their target nodes. Node and edge
+    attributes are stored as columns of a table each.
+
+    Nodes and edges that don't have an attribute have a missing value in its
+    column. Attributes that are set to None are told apart from those by
+    nulls, which holds the rows of each column whose value is None.
+
+    On disk, a graph is a directory of .npy arrays and uncompressed feather
+    tables, which are memory-mapped when read. Attribute values that arrow
+    can't store natively are encoded: shapely geometries as WKB and values of
+    mixed types (e.g. a list or a single osmid) as json. Integer columns with
+    missing values are read as nullable integers, so that their values are
+    still ints. Graph attributes are stored as json, or pickled if they can't
+    be.
+    """
+
+    def __init__(self, nodes, edges, indptr, indices,
+                 graph = None, directed = True, multigraph = True,
+                 nulls = None):
+        self.nodes      = nodes
+        self.edges      = edges
+        self.indptr     = indptr
+        self.indices    = indices
+        self.graph      = graph or {}
+        self.directed   = directed
+        self.multigraph = multigraph
+        self.nulls      = nulls or {'nodes' : {}, 'edges' : {}}
+
+    @classmethod
+    def from_networkx(cls, G):
+        node_ids = list(G.nodes)
+        codes = {node : i for i, node in enumerate(node_ids)}
+
+        node_data = [data for _, data in G.nodes(data = True)]
+        nodes = attribute_frame(node_data)
+        nodes.insert(0, 'node', pd.Series(node_ids, dtype = object))
+
+        if G.is_multigraph():
+            edge_list = list(G.edges(keys = True, data = True))
+            keys = [k for _, _, k, _ in edge_list]
+        else:
+            edge_list = [(u, v, None, d) for u, v, d in G.edges(data = True)]
+            keys = None
+
+        u = np.array([codes[e[0]] for e in edge_list], dtype = np.int64)
+        v = np.array([codes[e[1]] for e in edge_list], dtype = np.int64)
+        order = np.argsort(u, kind = 'mergesort')
+
+        edge_data = [edge_list[i][3] for i in order]
+        edges = attribute_frame(edge_data)
+        if keys is not None:
+            edges.insert(0, 'key', pd.Series([keys[i] for i in order],
+                                             dtype = object))
+
+        indptr = np.searchsorted(u[order], np.arange(len(node_ids) + 1))
+
+        return cls(
+            nodes, edges,
+            indptr.astype(np.int64), v[order].astype(np.int32),
+            graph = dict(G.graph),
+            directed = G.is_directed(),
+            multigraph = G.is_multigraph(),
+            nulls = {'nodes' : null_rows(node_data),
+                     'edges' : null_rows(edge_data)}
+        )
+
+    def sources(self):
+        """Code of the source node of each edge."""
+        return np.repeat(np.arange(len(self.indptr) - 1, dtype = np.int32),
+                         np.diff(self.indptr))
+
+    def adjacency(self, weight = 'length'):
+        """
+        Sparse (n x n) matrix with the smallest weight of the edges between
+        each pair of nodes, for use with scipy.sparse.csgraph.
+        """
+        from scipy.sparse import csr_matrix
+
+        u, v, keep = self.lightest_edges(weight)
+        w = self.edges[weight].values.astype(np.float64)
+
+        n = len(self.indptr) - 1
+        return csr_matrix((w[keep], (u, v)), shape = (n, n))
+
+    def lightest_edges(self, weight = 'length'):
+        """
+        Source, target and index of the lightest of the edges between each
+        pair of adjacent nodes.
+        """
+        u = self.sources()
+        v = np.asarray(self.indices)
+        w = self.edges[weight].values.astype(np.float64)
+
+        order = np.lexsort((w, v, u))
+        first = np.ones(len(order), dtype = bool)
+        first[1:] = (np.diff(u[order]) != 0) | (np.diff(v[order]) != 0)
+        keep = order[first]
+
+        return u[keep], v[keep], keep
+
+    def to_networkx(self):
+        if self.multigraph:
+            G = nx.MultiDiGraph() if self.directed else nx.MultiGraph()
+        else:
+            G = nx.DiGraph() if self.directed else nx.Graph()
+
+        G.graph.update(self.graph)
+
+        node_ids = self.nodes['node'].tolist()
+        G.add_nodes_from(zip(node_ids,
+                             records(self.nodes.drop(columns = 'node'),
+                                     self.nulls['nodes'])))
+
+        u = [node_ids[i] for i in self.sources()]
+        v = [node_ids[i] for i in np.asarray(self.indices)]
+
+        if self.multigraph:
+            attributes = records(self.edges.drop(columns = 'key'),
+                                 self.nulls['edges'])
+            G.add_edges_from(zip(u, v, self.edges['key'].tolist(), attributes))
+        else:
+            G.add_edges_from(zip(u, v, records(self.edges,
+                                               self.nulls['edges'])))
+
+        return G
+
+    def write(self, path):
+        """Write the graph as a directory of .npy and feather files."""
+        import pyarrow         as pa
+        import pyarrow.feather as feather
+
+        os.makedirs(path, exist_ok = True)
+
+        encodings = {}
+        for name, df in [('nodes', self.nodes), ('edges', self.edges)]:
+            columns = {}
+            encodings[name] = {}
+
+            for col in df.columns:
+                columns[str(col)], encodings[name][str(col)] = \
+                    encode_attribute(df[col].tolist())
+
+            feather.write_feather(
+                pa.table(columns) if len(columns) > 0 \
+                    else pa.table({'_': pa.nulls(len(df))}),
+                os.path.join(path, '{}.feather'.format(name)),
+                compression = 'uncompressed')
+
+        np.save(os.path.join(path, 'indptr.npy'), self.indptr)
+        np.save(os.path.join(path, 'indices.npy'), self.indices)
+
+        graph = {key : value for key, value in self.graph.items()
+                 if is_json(value)}
+        other = {key : value for key, value in self.graph.items()
+                 if key not in graph}
+
+        with open(os.path.join(path, 'graph.json'), 'w') as f:
+            json.dump({
+                'directed'   : self.directed,
+                'multigraph' : self.multigraph,
+                'encodings'  : encodings,
+                'nulls'      : self.nulls,
+                'graph'      : graph
+            }, f, indent = 2)
+
+        other_path = os.path.join(path, 'graph.pkl')
+        if len(other) > 0:
+            with open(other_path, 'wb') as f:
+                pickle.dump(other, f)
+        elif os.path.exists(other_path):
+            os.remove(other_path)
+
+    @classmethod
+    def read(cls, path, mmap = True):
+        """Read a graph written by GraphStore.write."""
+        import pyarrow.feather as feather
+
+        with open(os.path.join(path, 'graph.json')) as f:
+            meta = json.load(f)
+
+        tables = {}
+        for name in ['nodes', 'edges']:
+            table = feather.read_table(
+                os.path.join(path, '{}.feather'.format(name)),
+                memory_map = mmap)
+
+            df = table.to_pandas(types_mapper = nullable_integers(table))
+
+            for col, encoding in meta['encodings'][name].items():
+                df[col] = decode_attribute(df[col], encoding)
+
+            tables[name] = df[list(meta['encodings'][name])]
+
+        graph = meta['graph']
+        other_path = os.path.join(path, 'graph.pkl')
+        if os.path.exists(other_path):
+            with open(other_path, 'rb') as f:
+                graph = {**graph, **pickle.load(f)}
+
+        mmap_mode = 'r' if mmap else None
+
+        return cls(
+            tables['nodes'], tables['edges'],
+            np.load(os.path.join(path, 'indptr.npy'), mmap_mode = mmap_mode),
+            np.load(os.path.join(path, 'indices.npy'), mmap_mode = mmap_mode),
+            graph = graph,
+            directed = meta['directed'],
+            multigraph = meta['multigraph'],
+            nulls = meta.get('nulls')
+        )
+
+
+def attribute_frame(data):
+    """
+    Table of a list of attribute dicts, one column per attribute.
+
+    Integer attributes that some rows don't have are stored as nullable
+    integers, rather than floats.
+    """
+    df = pd.DataFrame.from_records(data, index = range(len(data)))
+
+    for col in df.columns:
+        if not pd.api.types.is_float_dtype(df[col].dtype) or \
+           not df[col].isna().any():
+            continue
+
+        values = [attributes.get(col) for attributes in data]
+        if all(is_null(value) or is_integer(value) for value in values):
+            df[col] = pd.array([None if is_null(value) else int(value)
+                                for value in values], dtype = 'Int64')
+
+    return df
+
+
+def null_rows(data):
+    """Rows of each attribute of a list of attribute dicts that are None."""
+    nulls = {}
+
+    for i, attributes in enumerate(data):
+        for key, value in attributes.items():
+            if value is None:
+                nulls.setdefault(str(key), []).append(i)
+
+    return nulls
+
+
+def nullable_integers(table):
+    """
+    types_mapper of Table.to_pandas that reads integer columns with missing
+    values as nullable integers rather than floats.
+    """
+    import pyarrow as pa
+
+    nullable = {
+        pa.int8()   : pd.Int8Dtype(),
+        pa.int16()  : pd.Int16Dtype(),
+        pa.int32()  : pd.Int32Dtype(),
+        pa.int64()  : pd.Int64Dtype(),
+        pa.uint8()  : pd.UInt8Dtype(),
+        pa.uint16() : pd.UInt16Dtype(),
+        pa.uint32() : pd.UInt32Dtype(),
+        pa.uint64() : pd.UInt64Dtype()
+    }
+
+    types = {column.type : nullable[column.type]
+             for column in table.columns
+             if column.type in nullable and column.null_count > 0}
+
+    return types.get
+
+
+def records(df, nulls = None):
+    """
+    Attribute dicts of the rows of df, without missing values, except those
+    in nulls (see GraphStore), which are None.
+    """
+    rows = [{} for _ in range(len(df))]
+
+    for col in df.columns:
+        values = df[col].tolist()
+        for i in np.flatnonzero(df[col].notna().values).tolist():
+            rows[i][col] = values[i]
+
+    for col, null in (nulls or {}).items():
+        for i in null:
+            rows[i][col] = None
+
+    return rows
+
+
+def is_null(value):
+    return value is None or value is pd.NA or \
+           (isinstance(value, float) and value != value)
+
+
+def is_integer(value):
+    return isinstance(value, (int, np.integer)) and \
+           not isinstance(value, (bool, np.bool_))
+
+
+def is_json(value):
+    """Whether value is the same once written as json and read back."""
+    try:
+        return json.loads(json.dumps(value)) == value
+    except (TypeError, ValueError):
+        return False
+
+
+def encode_attribute(values):
+    """
+    Arrow array of a node or edge attribute, and how it was encoded.
+
+    Scalar values are stored natively if arrow supports them, shapely
+    geometries as WKB, and anything else (e.g. lists) as json (see
+    as_json).
+    """
+    import pyarrow as pa
+
+    present = [value for value in values if not is_null(value)]
+
+    if len(present) > 0 and all(hasattr(value, 'wkb') for value in present):
+        return pa.array([None if is_null(value) else value.wkb
+                         for value in values], type = pa.binary()), 'wkb'
+
+    try:
+        array = pa.array([None if is_null(value) else value
+                          for value in values], from_pandas = True)
+        # Lists would be read back as numpy arrays
+        if not pa.types.is_nested(array.type) and \
+           (not pa.types.is_null(array.type) or len(present) == 0):
+            return array, 'native'
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError, ValueError):
+        pass
+
+    return pa.array([None if is_null(value) else json.dumps(as_json(value))
+                     for value in values], type = pa.string()), 'json'
+
+
+def as_json(value):
+    """
+    json compatible form of an attribute value.
+
+    Tuples, sets and dicts whose keys aren't all strings (e.g. int keys) are
+    tagged with the name of their type, so that they're read back as they
+    were (see from_json). Values of other types are stored as strings.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, list):
+        return [as_json(v) for v in value]
+    if isinstance(value, tuple):
+        return {'__tuple__' : [as_json(v) for v in value]}
+    if isinstance(value, (set, frozenset)):
+        return {'__set__' : [as_json(v) for v in value]}
+    if isinstance(value, dict):
+        if all(isinstance(k, str) for k in value):
+            return {k : as_json(v) for k, v in value.items()}
+        return {'__dict__' : [[as_json(k), as_json(v)]
+                              for k, v in value.items()]}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def from_json(value):
+    """Hook of json.loads that reads back the values tagged by as_json."""
+    if len(value) == 1:
+        if '__tuple__' in value:
+            return tuple(value['__tuple__'])
+        if '__set__' in value:
+            return set(value['__set__'])
+        if '__dict__' in value:
+            return {frozenset(k) if isinstance(k, set) else k : v
+                    for k, v in value['__dict__']}
+
+    return value
+
+
+def decode_attribute(column, encoding):
+    if encoding == 'native':
+        return column
+
+    present = np.flatnonzero(column.notna().values)
+    values = np.full(len(column), None, dtype = object)
+
+    if encoding == 'wkb':
+        import shapely
+        import shapely.wkb
+
+        if hasattr(shapely, 'from_wkb'):
+            # Vectorised, with shapely >= 2
+            values[present] = shapely.from_wkb(column.values[present])
+        else:
+            for i in present:
+                values[i] = shapely.wkb.loads(column.values[i])
+    else:
+        # Decode all values at once, as a single json array
+        decoded = json.loads(
+            '[{}]'.format(','.join(column.values[present])),
+            object_hook = from_json)
+        for i, value in zip(present, decoded):
+            values[i] = value
+
+    return pd.Series(values, index = column.index, dtype = object)
+
+
+def is_graph_store(path):
+    return os.path.isdir(path) or \
+           os.path.splitext(path)[1].lower() == graph_extension
+
+
+def read_graph(path, networkx = True):
+    """
+    Read a road network graph, from either a graph store or a gpickle.
+
+    Unless networkx is set, the graph is returned as a GraphStore, which for
+    graph stores skips building the networkx graph altogether.
+    """
+    if is_graph_store(path):
+        store = GraphStore.read(path)
+        return store.to_networkx() if networkx else store
+
+    G = nx.read_gpickle(path)
+    return G if networkx else GraphStore.from_networkx(G)
+
+
+def write_graph(G, path):
+    """
+    Write a road network graph as a graph store, if path is a directory or
+    has the .graph extension, or as a gpickle otherwise.
+    """
+    if is_graph_store(path):
+        GraphStore.from_networkx(G).write(path)
+    else:
+        nx.write_gpickle(G, path)
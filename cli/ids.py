@@ -0,0 +1,268 @@
+"""Compact integer encoding of vehicle and camera ids."""
+
+import numpy     as np
+import pandas    as pd
+
+
+id_columns = {
+    'vehicle'     : 'vehicle',
+    'camera'      : 'camera',
+    'origin'      : 'camera',
+    'destination' : 'camera'
+}
+"""Columns holding ids, and the dictionary their codes refer to."""
+
+attrs_keys = ['dictionaries', 'hashed_ids', 'encoded_ids']
+
+
+def id_attrs(df):
+    """
+    The dictionaries of the ids of df, stored in df.attrs.
+
+    'dictionaries' maps the name of each dictionary to the list of ids that
+    its codes refer to, 'encoded_ids' lists the names of the dictionaries
+    that ids were encoded with, and 'hashed_ids' maps columns of hashed
+    vehicle ids, stored as int64, to the size of their digest in bytes.
+    attrs are kept in pickles, and in the schema metadata of parquet and
+    feather files (see files.FrameWriter).
+    """
+    return {key : df.attrs[key] for key in attrs_keys if key in df.attrs}
+
+
+def with_id_attrs(df, attrs):
+    """Set the id dictionaries of df, e.g. after they were lost by anprx."""
+    df.attrs.update(attrs)
+    return df
+
+
+def is_encoded(df):
+    return len(id_attrs(df)) > 0
+
+
+def encode_ids(df, dictionaries = None, columns = None):
+    """
+    Replace the ids in df with int32 codes.
+
+    Ids are looked up in dictionaries, which are extended with any ids they
+    don't have yet, so that files encoded with the same dictionaries can be
+    combined. Columns that are already encoded are left as is. Missing ids
+    are encoded as -1.
+    """
+    dictionaries = {name : list(ids)
+                    for name, ids in (dictionaries or {}).items()}
+    for name, ids in df.attrs.get('dictionaries', {}).items():
+        dictionaries.setdefault(name, list(ids))
+
+    attrs = id_attrs(df)
+    df = df.copy(deep = False)
+
+    for col, name in id_columns.items():
+        if col not in df.columns or (columns is not None and col not in columns):
+            continue
+
+        if col in attrs.get('hashed_ids', {}) or \
+           pd.api.types.is_numeric_dtype(df[col].dtype):
+            continue
+
+        dictionary = pd.Index(dictionaries.get(name, []), dtype = object)
+        new_ids = pd.Index(df[col].dropna().unique(), dtype = object)\
+                    .difference(dictionary)\
+                    .sort_values()
+
+        dictionary = dictionary.append(new_ids)
+        dictionaries[name] = dictionary.tolist()
+
+        df[col] = dictionary.get_indexer(df[col]).astype(np.int32)
+
+    df.attrs.update(attrs)
+    df.attrs['dictionaries'] = dictionaries
+    df.attrs['encoded_ids'] = sorted(dictionaries)
+
+    return df
+
+
+def recode_ids(df, dictionaries):
+    """
+    Re-encode the ids in df with other dictionaries.
+
+    The dictionaries are extended with any ids of df they don't have yet, so
+    df can then be combined with files encoded with the given dictionaries.
+    """
+    current = df.attrs.get('dictionaries', {})
+    dictionaries = extend_dictionaries(dictionaries, current)
+
+    df = df.copy(deep = False)
+
+    for name, ids in current.items():
+        target = pd.Index(dictionaries[name], dtype = object)
+
+        # New code of each old code, and -1 for missing ids
+        mapping = np.append(target.get_indexer(pd.Index(ids, dtype = object)),
+                            -1).astype(np.int32)
+
+        for col, dictionary in id_columns.items():
+            if dictionary != name or col not in df.columns:
+                continue
+
+            codes = df[col].fillna(-1).values.astype(np.int64)
+            recoded = mapping[np.where(codes < 0, len(mapping) - 1, codes)]
+
+            if df[col].isna().any():
+                df[col] = np.where(recoded < 0, np.nan, recoded)
+            else:
+                df[col] = recoded
+
+    df.attrs['dictionaries'] = dictionaries
+    df.attrs['encoded_ids'] = sorted(dictionaries)
+
+    return df
+
+
+def extend_dictionaries(dictionaries, other):
+    """
+    Append the ids of other that aren't in dictionaries yet, sorted, to them.
+
+    Codes into dictionaries remain valid in the extended dictionaries.
+    """
+    dictionaries = {name : list(ids) for name, ids in dictionaries.items()}
+
+    for name, ids in other.items():
+        target = pd.Index(dictionaries.get(name, []), dtype = object)
+        target = target.append(pd.Index(ids, dtype = object)\
+                                 .difference(target)\
+                                 .sort_values())
+        dictionaries[name] = target.tolist()
+
+    return dictionaries
+
+
+def encode_filters(filters, attrs):
+    """
+    Filters on ids (see files.read_frame) as filters on their codes.
+
+    Ids that aren't in the dictionaries of attrs, and so can't be in the
+    file, are encoded as -2, which matches no code. Conditions on pairs of
+    columns (see files.filter_mask) have each of their columns encoded.
+    """
+    dictionaries = attrs.get('dictionaries', {})
+
+    def encoded(column):
+        return column in id_columns and id_columns[column] in dictionaries
+
+    def codes(column, ids):
+        if not encoded(column):
+            return list(ids)
+
+        dictionary = pd.Index(dictionaries[id_columns[column]], dtype = object)
+        codes = dictionary.get_indexer(pd.Index([id_string(i) for i in ids],
+                                                dtype = object))
+        return np.where(codes < 0, -2, codes).astype(np.int32)
+
+    def encode(column, op, value):
+        if isinstance(column, tuple):
+            if not any(encoded(c) for c in column):
+                return column, op, value
+            columns = list(zip(*value)) if len(value) > 0 \
+                      else [[] for _ in column]
+            return column, op, list(zip(*[codes(c, ids) for c, ids
+                                          in zip(column, columns)]))
+
+        if not encoded(column):
+            return column, op, value
+
+        ids = codes(column, value if op == 'in' else [value])
+
+        return (column, op, ids) if op == 'in' else (column, op, ids[0])
+
+    return [[encode(*condition) for condition in conjunction]
+            for conjunction in filters]
+
+
+def id_string(value):
+    """
+    An id as a string, e.g. of a filter.
+
+    Ids of columns with missing values are read as floats, so integral floats
+    are written as integers: 1.0 is the id '1'.
+    """
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+
+    return str(value)
+
+
+def id_strings(values):
+    """Ids of a series as strings (see id_string), or nan if missing."""
+    return values.map(lambda value: np.nan if pd.isnull(value)
+                                    else id_string(value))
+
+
+def decode_ids(df):
+    """
+    Replace the codes in df with the ids they encode, for export.
+
+    Hashed vehicle ids are decoded to their hex digests. Codes of -1, or
+    missing codes, are decoded as missing ids. Raises a ValueError if ids
+    were encoded but the dictionary of their codes was lost.
+    """
+    attrs = id_attrs(df)
+
+    if len(attrs) == 0:
+        return df
+
+    dictionaries = attrs.get('dictionaries', {})
+    hashed_ids = attrs.get('hashed_ids', {})
+
+    lost = [col for col in df.columns
+            if col in id_columns and col not in hashed_ids and
+               id_columns[col] in attrs.get('encoded_ids', []) and
+               id_columns[col] not in dictionaries]
+    if len(lost) > 0:
+        raise ValueError(
+            "Ids of {} are encoded, but their dictionaries are missing"\
+                .format(', '.join(lost)))
+
+    df = df.copy(deep = False)
+
+    for col in df.columns:
+        if not pd.api.types.is_numeric_dtype(df[col].dtype):
+            continue
+
+        if col in hashed_ids:
+            df[col] = decode_digests(df[col], hashed_ids[col])
+
+        elif col in id_columns and id_columns[col] in dictionaries:
+            ids = np.array(dictionaries[id_columns[col]] + [np.nan],
+                           dtype = object)
+            codes = df[col].fillna(-1).values.astype(np.int64)
+            # Code -1 takes the last element (a missing id)
+            df[col] = ids.take(np.where(codes < 0, len(ids) - 1, codes))
+
+    df.attrs = {key : value for key, value in df.attrs.items()
+                if key not in attrs_keys}
+
+    return df
+
+
+def encode_digests(digests):
+    """Digests of at most 8 bytes as int64, read as big-endian."""
+    width = len(digests[0]) if len(digests) > 0 else 8
+    return np.frombuffer(
+        b''.join(bytes(8 - width) + digest for digest in digests),
+        dtype = '>i8'
+    ).astype(np.int64)
+
+
+def decode_digests(values, digest_size):
+    """Hex digests of int64 hashed ids (nan if missing)."""
+    width = 2 * digest_size
+    missing = values.isna().values
+
+    hexdigests = np.full(len(values), np.nan, dtype = object)
+    hexdigests[~missing] = [
+        '{:0{}x}'.format(value, width)
+        for value in values[~missing].values.astype(np.int64)\
+                                     .view(np.uint64).tolist()
+    ]
+
+    return pd.Series(hexdigests, index = values.index, name = values.name)
@@ -0,0 +1,156 @@
+"""Compact, memory-mappable index of camera pair distances."""
+
+import os
+import numpy     as np
+import pandas    as pd
+import geopandas as gpd
+
+from .ids        import id_strings
+
+
+index_extension = '.pairs'
+
+MISSING = -1
+"""Validity flag of camera pairs that are not part of the index."""
+
+
+class PairIndex:
+    """
+    Dense lookup table of (origin, destination) camera pairs.
+
+    Camera ids are mapped to consecutive integer codes, and the distance and
+    validity flag of each pair are stored in (n x n) matrices indexed by the
+    codes of origin and destination. Matrices are memory-mapped when read
+    from disk, so only the pages that are looked up are loaded into memory.
+    """
+
+    def __init__(self, cameras, distance, valid):
+        self.cameras  = pd.Index(cameras)
+        self.distance = distance
+        self.valid    = valid
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """Build an index from a camera pairs (geo)dataframe."""
+        origins = id_strings(pairs['origin'])
+        destinations = id_strings(pairs['destination'])
+
+        cameras = np.union1d(origins.dropna().values.astype(str),
+                             destinations.dropna().values.astype(str))
+        index = pd.Index(cameras)
+
+        o = index.get_indexer(origins).astype(np.int32)
+        d = index.get_indexer(destinations).astype(np.int32)
+
+        # Pairs with a missing camera can't be looked up
+        known = (o >= 0) & (d >= 0)
+        o, d = o[known], d[known]
+
+        distance = np.full((len(cameras), len(cameras)), np.nan)
+        valid = np.full((len(cameras), len(cameras)), MISSING, dtype = np.int8)
+
+        distance[o, d] = pairs['distance'].values[known]
+        valid[o, d] = pairs['valid'].values[known].astype(np.int8)
+
+        return cls(cameras, distance, valid)
+
+    def codes(self, cameras):
+        """
+        Integer codes of the given camera ids (-1 if unknown), which are
+        compared as strings (see ids.id_strings).
+        """
+        return self.cameras.get_indexer(id_strings(pd.Series(cameras)))\
+                           .astype(np.int32)
+
+    def lookup(self, origins, destinations):
+        """
+        Distance and validity flag of each (origin, destination) pair.
+
+        Flags are 1 for valid pairs, 0 for invalid ones and MISSING for pairs
+        that aren't in the index, which have a nan distance.
+        """
+        o = self.codes(origins)
+        d = self.codes(destinations)
+        known = (o >= 0) & (d >= 0)
+
+        distance = np.full(len(o), np.nan)
+        valid = np.full(len(o), MISSING, dtype = np.int8)
+
+        distance[known] = self.distance[o[known], d[known]]
+        valid[known] = self.valid[o[known], d[known]]
+
+        return distance, valid
+
+    def to_frame(self, cameras = None):
+        """
+        Camera pairs in the index as a dataframe, without geometries.
+
+        If cameras is given, only the pairs between them are looked up, which
+        only loads their rows of the matrices.
+        """
+        if cameras is None:
+            o, d = np.nonzero(np.asarray(self.valid) != MISSING)
+            origins = self.cameras.values[o]
+            destinations = self.cameras.values[d]
+        else:
+            known = self.cameras.intersection(
+                pd.Index(id_strings(pd.Series(cameras)).dropna()))
+            origins = np.repeat(known.values, len(known))
+            destinations = np.tile(known.values, len(known))
+
+        distance, valid = self.lookup(origins, destinations)
+        in_index = valid != MISSING
+
+        return pd.DataFrame({
+            'origin'      : origins[in_index],
+            'destination' : destinations[in_index],
+            'distance'    : distance[in_index],
+            'valid'       : valid[in_index] == 1
+        })
+
+    def write(self, path):
+        """Write the index as a directory of .npy files."""
+        os.makedirs(path, exist_ok = True)
+
+        np.save(os.path.join(path, 'cameras.npy'),
+                np.asarray(self.cameras, dtype = str))
+        np.save(os.path.join(path, 'distance.npy'), self.distance)
+        np.save(os.path.join(path, 'valid.npy'), self.valid)
+
+    @classmethod
+    def read(cls, path, mmap = True):
+        """Read an index written by PairIndex.write."""
+        mmap_mode = 'r' if mmap else None
+
+        return cls(
+            np.load(os.path.join(path, 'cameras.npy')),
+            np.load(os.path.join(path, 'distance.npy'), mmap_mode = mmap_mode),
+            np.load(os.path.join(path, 'valid.npy'), mmap_mode = mmap_mode)
+        )
+
+
+def is_pair_index(path):
+    return os.path.isdir(path) or \
+           os.path.splitext(path)[1].lower() == index_extension
+
+
+def read_camera_pairs(path, cameras = None):
+    """
+    Read camera pairs from either a pair index or a geospatial file.
+
+    A pair index is read without route geometries, which is all that's
+    needed to look up the distance and validity of camera pairs. If cameras
+    is given, only the pairs between them are returned, and a pair index
+    only looks those up.
+    """
+    if is_pair_index(path):
+        return PairIndex.read(path).to_frame(cameras)
+
+    pairs = gpd.GeoDataFrame.from_file(path)
+
+    if cameras is not None:
+        cameras = set(cameras)
+        pairs = pairs[id_strings(pairs['origin']).isin(cameras) &
+                      id_strings(pairs['destination']).isin(cameras)]
+
+    return pairs
@@ -0,0 +1,154 @@
+"""Wall time, cpu time and memory instrumentation of pipeline commands."""
+
+import os
+import sys
+import json
+import time
+import socket
+import cProfile
+import platform
+import contextlib
+from datetime import datetime
+
+
+_profiler = None
+
+
+def peak_rss_mb(children = False):
+    """
+    Peak resident set size of this process (or its children) in MB.
+
+    The resource module is POSIX only. Elsewhere, the peak is read with
+    psutil, if it's installed and reports one (e.g. on Windows), and is None
+    otherwise.
+    """
+    try:
+        import resource
+    except ImportError:
+        resource = None
+
+    if resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_CHILDREN if children
+                                    else resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes on linux
+        return maxrss / 1e6 if sys.platform == 'darwin' else maxrss / 1e3
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+
+    peak = getattr(psutil.Process().memory_info(), 'peak_wset', None)
+
+    return None if children or peak is None else peak / 1e6
+
+
+class Profiler:
+    """
+    Record the wall time, cpu time and peak memory of each phase of a command.
+
+    Phases that run more than once (e.g. reading a file in chunks) accumulate
+    their times. Peak memory is the high-water mark of the whole process at
+    the end of the phase, so it only increases from one phase to the next,
+    and is None where it can't be measured (see peak_rss_mb).
+    """
+
+    def __init__(self, cprofile = False):
+        self.phases = {}
+        self.wall_time = time.perf_counter()
+        self.cpu_time = time.process_time()
+        self.started = datetime.now()
+
+        self.cprofile = cProfile.Profile() if cprofile else None
+        if self.cprofile is not None:
+            self.cprofile.enable()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        wall_time = time.perf_counter()
+        cpu_time = time.process_time()
+
+        try:
+            yield
+        finally:
+            stats = self.phases.setdefault(name, {
+                'calls'       : 0,
+                'wall_time'   : 0.0,
+                'cpu_time'    : 0.0,
+                'peak_rss_mb' : 0.0
+            })
+            stats['calls']       += 1
+            stats['wall_time']   += time.perf_counter() - wall_time
+            stats['cpu_time']    += time.process_time() - cpu_time
+            stats['peak_rss_mb'] = peak_rss_mb()
+
+    def summary(self):
+        return {
+            'command'      : sys.argv[1:],
+            'started'      : self.started.isoformat(),
+            'host'         : socket.gethostname(),
+            'python'       : platform.python_version(),
+            'anprx'        : anprx_version(),
+            'wall_time'    : time.perf_counter() - self.wall_time,
+            'cpu_time'     : time.process_time() - self.cpu_time,
+            'peak_rss_mb'  : peak_rss_mb(),
+            'children_peak_rss_mb' : peak_rss_mb(children = True),
+            'phases'       : self.phases
+        }
+
+    def write(self, folder):
+        """
+        Write the summary as json (and cProfile stats, if enabled) to folder.
+
+        Returns the path of the json file.
+        """
+        os.makedirs(folder, exist_ok = True)
+
+        stem = os.path.join(folder, 'profile_{}_{}'.format(
+            self.started.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats('{}.pstats'.format(stem))
+
+        with open('{}.json'.format(stem), 'w') as f:
+            json.dump(self.summary(), f, indent = 2)
+
+        return '{}.json'.format(stem)
+
+
+def anprx_version():
+    try:
+        from importlib.metadata import version
+        from importlib.metadata import PackageNotFoundError
+    except ImportError:
+        # python < 3.8
+        from pkg_resources import get_distribution
+        from pkg_resources import DistributionNotFound as PackageNotFoundError
+
+        def version(name):
+            return get_distribution(name).version
+
+    try:
+        return version('anprx')
+    except PackageNotFoundError:
+        return None
+
+
+def enable(cprofile = False):
+    """Start profiling the current command."""
+    global _profiler
+    _profiler = Profiler(cprofile = cprofile)
+    return _profiler
+
+
+def phase(name):
+    """
+    Context manager that records a phase of the current command.
+
+    Does nothing unless profiling was enabled.
+    """
+    if _profiler is None:
+        return contextlib.nullcontext()
+
+    return _profiler.phase(name)
@@ -0,0 +1,79 @@
+"""Neighbour search of cameras and nodes on projected coordinates."""
+
+import numpy     as np
+import pandas    as pd
+
+from scipy.spatial      import cKDTree
+from scipy.sparse       import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+def to_projected(gdf):
+    """Project gdf to its UTM zone, if it's in geographic coordinates."""
+    if gdf.crs is not None and gdf.crs.is_geographic:
+        return gdf.to_crs(gdf.estimate_utm_crs())
+
+    return gdf
+
+
+def projected_xy(gdf):
+    """Coordinates of the points in gdf, in metres."""
+    gdf = to_projected(gdf)
+
+    return np.column_stack([gdf.geometry.x.values, gdf.geometry.y.values])
+
+
+def neighbour_components(xy, distance):
+    """
+    Connected component of each point, where points within distance of each
+    other are connected.
+
+    Pairs of points within distance are found with a kd-tree, so it takes
+    O(n log n) time rather than comparing every pair.
+    """
+    n = len(xy)
+    if n == 0:
+        return np.zeros(0, dtype = np.int64)
+
+    pairs = cKDTree(xy).query_pairs(r = distance, output_type = 'ndarray')\
+                       .reshape(-1, 2)
+
+    adjacency = coo_matrix(
+        (np.ones(len(pairs), dtype = np.int8), (pairs[:, 0], pairs[:, 1])),
+        shape = (n, n))
+
+    _, component = connected_components(adjacency, directed = False)
+
+    return component
+
+
+def neighbour_batches(frames, distance, batch_size = 500):
+    """
+    Split the points of several geodataframes into batches, such that no
+    point is within distance of a point of another batch.
+
+    Batches are made of whole connected components (see
+    neighbour_components) of the points of all frames, projected to the
+    same coordinates, and hold about batch_size points, unless a component
+    is larger. Returns, for each batch, the positions of its rows in each
+    frame.
+    """
+    crs = to_projected(frames[0]).crs
+    xy = np.concatenate([
+        projected_xy(gdf if gdf.crs is None or crs is None
+                     else gdf.to_crs(crs))
+        for gdf in frames])
+
+    component = neighbour_components(xy, distance)
+    if len(component) == 0:
+        return []
+
+    # Consecutive components are packed into the same batch
+    sizes = np.bincount(component)
+    batch = ((np.cumsum(sizes) - sizes) // batch_size)[component]
+
+    frame = np.repeat(np.arange(len(frames)), [len(gdf) for gdf in frames])
+    position = np.concatenate([np.arange(len(gdf)) for gdf in frames])
+
+    return [[position[rows[frame[rows] == i]] for i in range(len(frames))]
+            for rows in pd.Series(batch).groupby(batch).indices.values()]
@@ -4,6 +4,9 @@ from anprx.cameras  import wrangle_cameras
 from anprx.cameras  import map_nodes_cameras
 from anprx.utils    import log
 
+from ..profiling    import phase
+from ..spatial      import neighbour_batches
+
 import numpy     as np
 import pandas    as pd
 import geopandas as gpd
@@ -47,10 +50,19 @@ import logging   as lg
     required = False,
     help ="Whether to merge nearby cameras with the same address and direction."
 )
+@click.option(
+    '--spatial-index/--no-spatial-index',
+    default = False,
+    show_default = True,
+    required = False,
+    help = ("Split cameras into batches of nearby cameras with a kd-tree, "
+            "and merge each batch separately with anprx, instead of "
+            "comparing every pair of cameras. The result is the same.")
+)
 @click.command()
 def cameras(input_csv, output_geojson,
             names, skip_lines,
-            distance, merge):
+            distance, merge, spatial_index):
     """
     Wrangle a raw dataset of ANPR cameras.
 
@@ -95,26 +107,32 @@ def cameras(input_csv, output_geojson,
     Working with UTM coordinates is useful to merge cameras onto the
     road network (see command wrangle merge-cameras).
 
+    With --spatial-index, cameras are first split into batches of nearby
+    cameras with a kd-tree on their UTM coordinates, and anprx merges each
+    batch separately (see merge_by_neighbours), which scales to many
+    thousands of cameras with the same result.
+
     This script uses anprx to wrangle the cameras dataset. For more
     fine-grained control over the behavior of this function please consider
     using the python library: https://github.com/ppintosilva/anprx
     """
 
-    cameras = pd.read_csv(
-        filepath_or_buffer = input_csv,
-        sep    = ',',
-        names  = names.split(',') if names else None,
-        header = None if names else 0,
-        skiprows = skip_lines,
-        dtype  = {
-            "id": object,
-            "name": object,
-            "lat": np.float64,
-            "lon": np.float64,
-            "is_commissioned" : bool,
-            "description" : object
-        }
-    )
+    with phase('read'):
+        cameras = pd.read_csv(
+            filepath_or_buffer = input_csv,
+            sep    = ',',
+            names  = names.split(',') if names else None,
+            header = None if names else 0,
+            skiprows = skip_lines,
+            dtype  = {
+                "id": object,
+                "name": object,
+                "lat": np.float64,
+                "lon": np.float64,
+                "is_commissioned" : bool,
+                "description" : object
+            }
+        )
 
     col_names = names.split(',') if names else cameras.columns.values
 
@@ -122,19 +140,28 @@ def cameras(input_csv, output_geojson,
     has_description      = ('description' in col_names)
     has_is_commissioned  = ('is_commissioned' in col_names)
 
-    wcameras = wrangle_cameras(
-        cameras               = cameras,
-        is_test_col           = "name" if has_name else False,
-        is_commissioned_col   = "is_commissioned" if has_is_commissioned else False,
-        road_attr_col         = "description" if has_description else False,
-        drop_car_park         = True,
-        drop_na_direction     = True,
-        distance_threshold    = distance,
-        sort_by               = 'id',
-        merge_cameras         = merge
-    )
-
-    wcameras.to_file(output_geojson, driver='GeoJSON')
+    with phase('anprx'):
+        wrangle_kwargs = dict(
+            is_test_col           = "name" if has_name else False,
+            is_commissioned_col   = "is_commissioned" if has_is_commissioned else False,
+            road_attr_col         = "description" if has_description else False,
+            drop_car_park         = True,
+            drop_na_direction     = True,
+            distance_threshold    = distance,
+            sort_by               = 'id'
+        )
+
+        if merge and spatial_index:
+            wcameras = merge_by_neighbours(cameras, distance, wrangle_kwargs)
+        else:
+            wcameras = wrangle_cameras(
+                cameras               = cameras,
+                merge_cameras         = merge,
+                **wrangle_kwargs
+            )
+
+    with phase('write'):
+        wcameras.to_file(output_geojson, driver='GeoJSON')
 
     return 0
 
@@ -175,33 +202,48 @@ def cameras(input_csv, output_geojson,
     required = False,
     help = "Number of lines to skip at the start of the file."
 )
+@click.option(
+    '--spatial-index/--no-spatial-index',
+    default = False,
+    show_default = True,
+    required = False,
+    help = ("Split nodes and cameras into batches of nearby ones with a "
+            "kd-tree, and map each batch separately with anprx, instead of "
+            "comparing every node with every camera. The result is the same.")
+)
 @click.command()
 def nodes(input_nodes_csv,
           input_cameras_geojson,
           output_nodes_geojson,
           names,
           skip_lines,
-          distance
+          distance,
+          spatial_index
 ):
     """
     Wrangle a raw dataset of Nodes.
+
+    Nodes are wrangled in the same way as cameras (see wrangle cameras), and
+    each node is mapped to the nearest camera within --distance meters with
+    the same address and direction.
     """
 
-    raw_nodes = pd.read_csv(
-        filepath_or_buffer = input_nodes_csv,
-        sep    = ',',
-        names  = names.split(',') if names else None,
-        header = None if names else 0,
-        skiprows = skip_lines,
-        dtype  = {
-            "id": object,
-            "name": object,
-            "lat": np.float64,
-            "lon": np.float64,
-            "is_commissioned" : bool,
-            "description" : object
-        }
-    )
+    with phase('read'):
+        raw_nodes = pd.read_csv(
+            filepath_or_buffer = input_nodes_csv,
+            sep    = ',',
+            names  = names.split(',') if names else None,
+            header = None if names else 0,
+            skiprows = skip_lines,
+            dtype  = {
+                "id": object,
+                "name": object,
+                "lat": np.float64,
+                "lon": np.float64,
+                "is_commissioned" : bool,
+                "description" : object
+            }
+        )
 
     col_names = names.split(',') if names else raw_nodes.columns.values
 
@@ -209,23 +251,121 @@ def nodes(input_nodes_csv,
     has_description      = ('description' in col_names)
     has_is_commissioned  = ('is_commissioned' in col_names)
 
-    cameras = gpd.GeoDataFrame.from_file(input_cameras_geojson)
-
-    wnodes = map_nodes_cameras(
-        nodes                 = raw_nodes,
-        cameras               = cameras,
-        is_test_col           = "name" if has_name else False,
-        is_commissioned_col   = "is_commissioned" if has_is_commissioned else False,
-        road_attr_col         = "description" if has_description else False,
-        drop_car_park         = True,
-        drop_na_direction     = True,
-        distance_threshold    = distance,
-        sort_by               = 'id'
+    with phase('read'):
+        cameras = gpd.GeoDataFrame.from_file(input_cameras_geojson)
+
+    with phase('anprx'):
+        wrangle_kwargs = dict(
+            is_test_col           = "name" if has_name else False,
+            is_commissioned_col   = "is_commissioned" if has_is_commissioned else False,
+            road_attr_col         = "description" if has_description else False,
+            drop_car_park         = True,
+            drop_na_direction     = True,
+            distance_threshold    = distance,
+            sort_by               = 'id'
+        )
+
+        if spatial_index:
+            wnodes = map_by_neighbours(raw_nodes, cameras, distance,
+                                       wrangle_kwargs)
+        else:
+            wnodes = map_nodes_cameras(
+                nodes             = raw_nodes,
+                cameras           = cameras,
+                **wrangle_kwargs
+            )
+
+    with phase('write'):
+        wnodes.to_file(output_nodes_geojson, driver='GeoJSON')
+
+    return 0
+
+def merge_by_neighbours(raw_cameras, distance, wrangle_kwargs,
+                        batch_size = 500):
+    """
+    Wrangle and merge cameras with anprx, one batch of nearby cameras at a
+    time (see spatial.neighbour_batches).
+
+    anprx compares every pair of cameras to find those within distance of
+    each other, which takes O(n^2) time. Cameras of different batches are
+    more than twice distance apart, further than anprx merges cameras, so
+    merging each batch separately gives the same cameras as merging all of
+    them at once, in O(n log n) time for batches of bounded size.
+    """
+    wcameras = wrangle_cameras(
+        cameras           = raw_cameras,
+        merge_cameras     = False,
+        **wrangle_kwargs
     )
 
-    wnodes.to_file(output_nodes_geojson, driver='GeoJSON')
+    if len(wcameras) == 0:
+        return wcameras
+
+    batches = neighbour_batches([wcameras], 2 * distance, batch_size)
+
+    log("Merging cameras in {:,} batches of nearby cameras."\
+            .format(len(batches)),
+        level = lg.INFO)
+
+    return concat_by_id([
+        wrangle_cameras(
+            cameras           = raw_rows(raw_cameras, wcameras.iloc[rows]),
+            merge_cameras     = True,
+            **wrangle_kwargs
+        )
+        for rows, in batches])
+
+
+def map_by_neighbours(raw_nodes, cameras, distance, wrangle_kwargs,
+                      batch_size = 500):
+    """
+    Wrangle nodes and map them to cameras with anprx, one batch of nearby
+    nodes and cameras at a time (see merge_by_neighbours).
+    """
+    wnodes = wrangle_cameras(
+        cameras           = raw_nodes,
+        merge_cameras     = False,
+        **wrangle_kwargs
+    )
+
+    if len(wnodes) == 0 or len(cameras) == 0:
+        return map_nodes_cameras(nodes = raw_nodes, cameras = cameras,
+                                 **wrangle_kwargs)
+
+    parts = []
+    for node_rows, camera_rows in neighbour_batches(
+            [wnodes, cameras], 2 * distance, batch_size):
+        if len(node_rows) == 0:
+            continue
+
+        # No camera is near these nodes, but anprx expects some cameras
+        if len(camera_rows) == 0:
+            camera_rows = [0]
+
+        parts.append(map_nodes_cameras(
+            nodes             = raw_rows(raw_nodes, wnodes.iloc[node_rows]),
+            cameras           = cameras.iloc[camera_rows],
+            **wrangle_kwargs
+        ))
+
+    return concat_by_id(parts)
+
+
+def raw_rows(raw, wrangled):
+    """Rows of a raw dataset of cameras or nodes, that wrangled came from."""
+    return raw[raw['id'].astype(str).isin(wrangled['id'].astype(str))]
+
+
+def concat_by_id(parts):
+    """Concatenate wrangled batches, sorted by id as anprx sorts them."""
+    crs = parts[0].crs
+    parts = [part if part.crs == crs else part.to_crs(crs) for part in parts]
+
+    # Columns all missing in some batches are objects once concatenated
+    return pd.concat(parts).infer_objects()\
+             .sort_values('id', kind = 'mergesort')\
+             .reset_index(drop = True)
 
-    return 0
 
 @click.argument(
     'output-pairs-csv',
@@ -3,7 +3,26 @@ import click
 from anprx.cameras  import wrangle_raw_anpr
 from anprx.utils    import log
 
+from ..files        import formats
+from ..files        import compressions
+from ..files        import write_frame
+from ..files        import FrameWriter
+from ..files        import merge_sorted_frames
+from ..ids          import encode_ids
+from ..ids          import encode_digests
+from ..ids          import id_columns
+from ..datasets     import DatasetWriter
+from ..datasets     import update_manifest
+from ..datasets     import observations
+from ..datasets     import check_manifest
+from ..profiling    import phase
+
 import os
+import glob
+import hashlib
+import tempfile
+import multiprocessing as mp
+from datetime import datetime
 import numpy     as np
 import pandas    as pd
 import geopandas as gpd
@@ -74,8 +93,18 @@ import logging   as lg
     type = str,
     show_default = True,
     required = False,
-    help = ("Salt used in hashing plate numbers. "
-            "Defaults to a randomly generated string.")
+    help = ("Salt used in hashing plate numbers, at most 16 bytes long. "
+            "Defaults to a randomly generated string. Can't be combined "
+            "with --salt-file.")
+)
+@click.option(
+    '--salt-file',
+    default = None,
+    type = click.Path(dir_okay = False),
+    required = False,
+    help = ("File that persists the salt used in hashing plate numbers, so "
+            "that plates are hashed the same way across runs. A random salt "
+            "is generated and saved to this file if it doesn't exist yet.")
 )
 @click.option(
     '--date-format',
@@ -85,6 +114,70 @@ import logging   as lg
     required = False,
     help = "Timestamp datetime format."
 )
+@click.option(
+    '--chunksize',
+    default = None,
+    type = click.IntRange(min = 1),
+    required = False,
+    help = ("Read and wrangle the input csv file in chunks of this many "
+            "rows. Wrangled chunks are sorted into temporary files next to "
+            "the output, which are then merged by timestamp, so only about "
+            "this many rows are held in memory (unless the output is a "
+            "pickle). Defaults to reading the whole file at once.")
+)
+@click.option(
+    '--format',
+    type = click.Choice(formats),
+    default = None,
+    required = False,
+    help = ("Format of output file. "
+            "Inferred from the output file extension by default.")
+)
+@click.option(
+    '--compression',
+    type = click.Choice(compressions),
+    default = 'snappy',
+    show_default = True,
+    required = False,
+    help = "Compression codec used when writing parquet files."
+)
+@click.option(
+    '--workers',
+    default = 1,
+    type = click.IntRange(min = 1),
+    show_default = True,
+    required = False,
+    help = ("Number of processes used to wrangle input files in parallel, "
+            "when the input is a glob pattern.")
+)
+@click.option(
+    '--encode-ids/--no-encode-ids',
+    default = False,
+    show_default = True,
+    help = ("Store camera ids as int32 codes into a dictionary kept in the "
+            "output file, and anonymised vehicles as int64 digests (which "
+            "requires --digest-size 8 or less). Ids are decoded when "
+            "exporting to csv.")
+)
+@click.option(
+    '--dataset',
+    is_flag = True,
+    default = False,
+    show_default = True,
+    help = ("Write OUTPUT_PKL as a dataset directory partitioned by date, "
+            "with a manifest of the rows and time range of each file, which "
+            "compute commands can read with partition pruning. Parquet "
+            "(default) or feather only.")
+)
+@click.option(
+    '--camera-buckets',
+    default = None,
+    type = click.IntRange(min = 1),
+    required = False,
+    help = ("With --dataset, also partition observations by a hash of the "
+            "camera id into this many buckets, so that reads of a few "
+            "cameras skip most files.")
+)
 @click.command()
 def raw_anpr(
     input_csv,
@@ -97,7 +190,15 @@ def raw_anpr(
     confidence_threshold,
     digest_size,
     digest_salt,
-    date_format
+    salt_file,
+    date_format,
+    chunksize,
+    format,
+    compression,
+    workers,
+    encode_ids,
+    dataset,
+    camera_buckets
 ):
     """
     Wrangle a csv file containing raw ANPR data.
@@ -108,20 +209,377 @@ def raw_anpr(
         - Sort by Timestamp
         - Anonymise
         - Correct camera ids, given a wrangled cameras dataframe
+
+    If INPUT_CSV is a glob pattern (quoted, e.g. "data/NPDATA_*.csv"), every
+    matching file is wrangled into its own file inside the directory
+    OUTPUT_PKL, named after the input file: wrangled_<name>.<format>.
+    Cameras are read only once and the same digest salt is used for every
+    file, so that vehicle hashes match across files.
+
+    With --encode-ids, ids take much less memory and are much faster to
+    group and sort in compute trips, displacement and flows, which keep them
+    encoded. Camera codes refer to the ids of --cameras-geojson, if given,
+    so that they match across files.
+
+    \b
+        anpr wrangle raw-anpr \\
+            --workers 8 \\
+            --cameras-geojson data/wrangled_cameras.geojson \\
+            "data/NPDATA_*.csv" data/wrangled
+
+    With --dataset, OUTPUT_PKL is instead the root of a dataset partitioned
+    by date (see cli.datasets), into which the observations of every input
+    file are written. Wrangling a file again replaces its observations, so
+    an archive can be built incrementally, e.g. one day at a time:
+
+    \b
+        anpr wrangle raw-anpr --dataset --camera-buckets 16 \\
+            --cameras-geojson data/wrangled_cameras.geojson \\
+            data/NPDATA_20190107.csv data/wrangled
     """
+    if dataset and format == 'pkl':
+        raise click.BadParameter(
+            "Datasets can only be written as parquet or feather files",
+            param_hint = '--format')
+
+    if camera_buckets is not None and not dataset:
+        raise click.BadParameter(
+            "--camera-buckets requires --dataset",
+            param_hint = '--camera-buckets')
+
+    if digest_salt and salt_file:
+        raise click.BadParameter(
+            "Give either --digest-salt or --salt-file, not both",
+            param_hint = '--digest-salt')
+
+    dataset_kwargs = None if not dataset else dict(
+        format = format or 'parquet',
+        camera_buckets = camera_buckets,
+        **observations
+    )
+
+    if dataset:
+        try:
+            check_manifest(output_pkl, **dataset_kwargs)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+
+    with phase('read'):
+        cameras = None if cameras_geojson is None else \
+                  gpd.GeoDataFrame.from_file(cameras_geojson)
 
+    # The same salt must be used for every chunk and file, otherwise the same
+    # plate would be hashed differently depending on where it appears. Plates
+    # aren't hashed with --no-anonymise, so no salt file is read or created.
+    if not anonymise:
+        digest_salt = None
+    elif digest_salt:
+        digest_salt = digest_salt.encode()
+    elif salt_file:
+        digest_salt = load_salt(salt_file)
+    else:
+        log(("Using a random digest salt: vehicle hashes won't match those of "
+             "other runs. Use --salt-file to persist the salt."),
+            level = lg.WARNING)
+        digest_salt = os.urandom(10)
+
+    if anonymise and len(digest_salt) > hashlib.blake2b.SALT_SIZE:
+        raise click.BadParameter(
+            "Digest salt must be at most {} bytes long"\
+                .format(hashlib.blake2b.SALT_SIZE),
+            param_hint = '--digest-salt')
+
+    if anonymise and encode_ids and digest_size > 8:
+        raise click.BadParameter(
+            "Vehicles can only be encoded as int64 with digests of at most "
+            "8 bytes",
+            param_hint = '--digest-size')
+
+    anonymise_kwargs = None if not anonymise else dict(
+        digest_size = digest_size,
+        digest_salt = digest_salt,
+        as_int64 = encode_ids
+    )
+
+    encode_kwargs = None
+    if encode_ids:
+        encode_kwargs = {
+            'dictionaries' : {} if cameras is None else \
+                             {'camera' : sorted(cameras['id'].astype(str))},
+            'hashed_ids'   : {} if not anonymise else \
+                             {'vehicle' : digest_size}
+        }
+
+    read_kwargs = dict(
+        names = names,
+        skip_lines = skip_lines,
+        date_format = date_format,
+        chunksize = chunksize
+    )
+
+    wrangle_kwargs = dict(
+        cameras = cameras,
+        filter_low_confidence = filter,
+        confidence_threshold = confidence_threshold,
+        # Plates are hashed by anonymise_plates instead
+        anonymise = False
+    )
+
+    if not glob.has_magic(input_csv):
+        output = wrangle_file(input_csv, output_pkl, read_kwargs,
+                              wrangle_kwargs, anonymise_kwargs, format,
+                              compression, encode_kwargs, dataset_kwargs)
+        if dataset:
+            update_manifest(output_pkl, output, [batch_name(input_csv)],
+                            **dataset_kwargs)
+        return 0
+
+    input_csvs = sorted(glob.glob(input_csv))
+
+    if len(input_csvs) == 0:
+        raise click.BadParameter(
+            "No files match pattern '{}'".format(input_csv),
+            param_hint = 'INPUT_CSV')
+
+    os.makedirs(output_pkl, exist_ok = True)
+
+    jobs = []
+    for path in input_csvs:
+        output = output_pkl if dataset else os.path.join(
+            output_pkl,
+            'wrangled_{}.{}'.format(batch_name(path), format or 'pkl'))
+        jobs.append((path, output))
+
+    log("Wrangling {} raw anpr files using {} workers."\
+            .format(len(jobs), workers),
+        level = lg.INFO)
+
+    entries = []
+
+    if workers == 1:
+        for path, output in jobs:
+            output = wrangle_file(path, output, read_kwargs, wrangle_kwargs,
+                                  anonymise_kwargs, format, compression,
+                                  encode_kwargs, dataset_kwargs)
+            if dataset:
+                entries.extend(output)
+    else:
+        # Each worker receives the cameras and options once, at startup
+        with mp.Pool(
+            processes = min(workers, len(jobs)),
+            initializer = init_batch_worker,
+            initargs = (read_kwargs, wrangle_kwargs, anonymise_kwargs,
+                        format, compression, encode_kwargs, dataset_kwargs)
+        ) as pool:
+            for i, output in enumerate(pool.imap(wrangle_batch_file, jobs)):
+                log("Wrangled {} ({}/{})".format(jobs[i][0], i + 1, len(jobs)),
+                    level = lg.INFO)
+                if dataset:
+                    entries.extend(output)
+
+    # The manifest is written once, after every file of the batch
+    if dataset:
+        update_manifest(output_pkl, entries,
+                        [batch_name(path) for path in input_csvs],
+                        **dataset_kwargs)
+
+    return 0
+
+
+def batch_name(path):
+    """Name of the files of a dataset with the observations of a raw file."""
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def wrangle_file(
+    input_csv,
+    output,
+    read_kwargs,
+    wrangle_kwargs,
+    anonymise_kwargs = None,
+    format = None,
+    compression = 'snappy',
+    encode_kwargs = None,
+    dataset_kwargs = None
+):
+    """
+    Read, wrangle and write a single csv file with raw ANPR data.
+
+    Plates are anonymised with anonymise_plates, if anonymise_kwargs is given,
+    and ids are encoded with encode_ids, if encode_kwargs is given.
+
+    If dataset_kwargs is given (see DatasetWriter), output is the root of a
+    dataset, and the manifest entries of the files written are returned
+    rather than the output path. The caller updates the manifest.
+    """
     log(("Reading input csv file with raw anpr data of size {:,.2f} MB.")\
             .format(os.stat(input_csv).st_size/1e6),
         level = lg.INFO)
 
+    def wrangle(raw_anpr):
+        with phase('anprx'):
+            wrangled_anpr = wrangle_raw_anpr(raw_anpr, **wrangle_kwargs)
+
+        if anonymise_kwargs is not None:
+            with phase('transform'):
+                wrangled_anpr['vehicle'] = anonymise_plates(
+                    wrangled_anpr['vehicle'], **anonymise_kwargs)
+
+        return wrangled_anpr
+
+    with phase('read'):
+        raw_anpr = read_raw_anpr(input_csv, **read_kwargs)
+
+    if read_kwargs.get('chunksize') is not None:
+        return wrangle_file_chunks(raw_anpr, input_csv, output, wrangle,
+                                   read_kwargs['chunksize'], format,
+                                   compression, encode_kwargs,
+                                   dataset_kwargs)
+
+    log("OK", level = lg.INFO)
+    wrangled_anpr = wrangle(raw_anpr)
+
+    if encode_kwargs is not None:
+        with phase('transform'):
+            wrangled_anpr = encode_ids(wrangled_anpr,
+                                       encode_kwargs['dictionaries'])
+            wrangled_anpr.attrs['hashed_ids'] = encode_kwargs['hashed_ids']
+
+    with phase('write'):
+        if dataset_kwargs is not None:
+            with DatasetWriter(output, batch_name(input_csv),
+                               compression = compression,
+                               update = False,
+                               **dataset_kwargs) as writer:
+                writer.write(wrangled_anpr)
+            return writer.entries()
+
+        write_frame(wrangled_anpr, output, format, compression)
+
+    return output
+
+
+def wrangle_file_chunks(
+    chunks,
+    input_csv,
+    output,
+    wrangle,
+    chunksize,
+    format = None,
+    compression = 'snappy',
+    encode_kwargs = None,
+    dataset_kwargs = None
+):
+    """
+    Wrangle and write the chunks of a raw ANPR file, see wrangle_file.
+
+    Wrangled chunks are written to temporary files next to output (see
+    wrangle_chunks), which are then merged by timestamp and written one
+    chunk at a time, so only about chunksize rows are held in memory, unless
+    the output is a pickle. Ids are encoded with the dictionaries that
+    encode_ids would build from the whole file.
+    """
+    writer = DatasetWriter(output, batch_name(input_csv),
+                           compression = compression,
+                           update = False,
+                           **dataset_kwargs) \
+             if dataset_kwargs is not None else \
+             FrameWriter(output, format, compression)
+
+    folder = os.path.dirname(os.path.abspath(output))
+
+    with writer, tempfile.TemporaryDirectory(dir = folder,
+                                             prefix = '.wrangle-') as tmp:
+        runs, header, ids = wrangle_chunks(chunks, wrangle, tmp)
+
+        def encode(df):
+            if encode_kwargs is None:
+                return df
+
+            with phase('transform'):
+                df = encode_ids(df, dictionaries)
+                df.attrs['hashed_ids'] = encode_kwargs['hashed_ids']
+                return df
+
+        if encode_kwargs is not None:
+            dictionaries = encode_ids(
+                pd.DataFrame({col : pd.Series(values, dtype = object)
+                              for col, values in ids.items()}),
+                encode_kwargs['dictionaries']).attrs['dictionaries']
+
+        merged = merge_sorted_frames(runs, 'timestamp', chunksize)
+        written = False
+
+        while True:
+            with phase('transform'):
+                chunk = next(merged, None)
+
+            if chunk is None:
+                break
+
+            with phase('write'):
+                writer.write(encode(chunk))
+            written = True
+
+        # The file has the columns of the wrangled data even if it's empty
+        if not written and header is not None:
+            with phase('write'):
+                writer.write(encode(header))
+
+    if dataset_kwargs is not None:
+        return writer.entries()
+
+    return output
+
+
+_batch_worker = {}
+
+
+def init_batch_worker(
+    read_kwargs,
+    wrangle_kwargs,
+    anonymise_kwargs,
+    format,
+    compression,
+    encode_kwargs,
+    dataset_kwargs
+):
+    """Store the options shared by every file in a batch, once per worker."""
+    _batch_worker.update(
+        read_kwargs = read_kwargs,
+        wrangle_kwargs = wrangle_kwargs,
+        anonymise_kwargs = anonymise_kwargs,
+        format = format,
+        compression = compression,
+        encode_kwargs = encode_kwargs,
+        dataset_kwargs = dataset_kwargs
+    )
+
+
+def wrangle_batch_file(job):
+    input_csv, output = job
+    return wrangle_file(input_csv, output, **_batch_worker)
+
+
+def read_raw_anpr(
+    input_csv,
+    names = None,
+    skip_lines = 0,
+    date_format = '%Y-%m-%d %H:%M:%S.%f',
+    chunksize = None
+):
+    """
+    Read a csv file containing raw ANPR data.
+
+    Returns a dataframe, or an iterator of dataframes with at most
+    `chunksize` rows each if `chunksize` is given.
+    """
     raw_anpr = pd.read_csv(
         filepath_or_buffer = input_csv,
         sep    = ',',
         names  = names.split(',') if names else None,
         header = None if names else 0,
         skiprows = skip_lines,
-        parse_dates = ['timestamp'],
-        date_parser = lambda x: pd.datetime.strptime(x, date_format),
         dtype  = {
             "vehicle": object,
             "camera": object,
@@ -130,24 +588,162 @@ def raw_anpr(
         },
         # Ignore any na values, assume there isn't any
         # (potentially just badly formatted plate numbers)
-        na_values = ""
+        na_values = "",
+        chunksize = chunksize
     )
 
-    log("OK", level = lg.INFO)
+    def with_timestamps(df):
+        df['timestamp'] = parse_timestamps(df['timestamp'], date_format)
+        return df
 
-    cameras = None if cameras_geojson is None else \
-              gpd.GeoDataFrame.from_file(cameras_geojson)
+    if chunksize is None:
+        return with_timestamps(raw_anpr)
+    else:
+        return (with_timestamps(chunk) for chunk in raw_anpr)
 
-    wrangled_anpr = wrangle_raw_anpr(
-        raw_anpr,
-        cameras = cameras,
-        filter_low_confidence = filter,
-        confidence_threshold = confidence_threshold,
-        anonymise = anonymise,
-        digest_size = digest_size,
-        digest_salt = digest_salt.encode() if digest_salt else os.urandom(10),
-    )
 
-    pd.to_pickle(wrangled_anpr, output_pkl)
+def parse_timestamps(timestamps, date_format):
+    """
+    Parse a series of timestamp strings with the given datetime format.
 
-    return 0
+    Fixed layouts, such as the default '%Y-%m-%d %H:%M:%S.%f', are parsed in
+    a single vectorised call. If pandas can't handle the format, each value is
+    parsed with datetime.strptime instead, which is much slower but accepts
+    anything strptime does.
+    """
+    try:
+        return pd.to_datetime(timestamps, format = date_format, cache = True)
+    except (ValueError, TypeError):
+        log(("Could not parse timestamps with a vectorised parser, "
+             "falling back to strptime for format '{}'.")\
+                .format(date_format),
+            level = lg.WARNING)
+
+        return pd.to_datetime(
+            timestamps.map(lambda x: datetime.strptime(x, date_format)))
+
+
+def wrangle_chunks(chunks, wrangle, folder):
+    """
+    Wrangle an iterator of raw ANPR chunks into sorted files.
+
+    Each chunk is filtered, corrected and anonymised on its own, sorted by
+    timestamp and written to its own feather file in folder, so only one
+    chunk is held in memory at a time. The files can then be merged into the
+    order of the whole file with merge_sorted_frames.
+
+    Returns the paths of the files, an empty dataframe with the columns of
+    the wrangled data (None if there were no chunks), and the unique values
+    of each id column (see cli.ids) that isn't numeric, so that ids can be
+    encoded the same way in every chunk.
+    """
+    paths = []
+    header = None
+    ids = {}
+    nchunks = 0
+    nrows = 0
+    chunks = iter(chunks)
+
+    while True:
+        # Chunks are read (and parsed) lazily
+        with phase('read'):
+            chunk = next(chunks, None)
+
+        if chunk is None:
+            break
+
+        nchunks += 1
+        nrows += len(chunk)
+        wrangled = wrangle(chunk)
+
+        with phase('transform'):
+            wrangled = wrangled\
+                .sort_values('timestamp', kind = 'mergesort')\
+                .reset_index(drop = True)
+
+            for col in id_columns:
+                if col in wrangled.columns and \
+                   not pd.api.types.is_numeric_dtype(wrangled[col].dtype):
+                    values = pd.Index(wrangled[col].dropna().unique(),
+                                      dtype = object)
+                    ids[col] = values if col not in ids else \
+                               ids[col].union(values)
+
+        if header is None:
+            header = wrangled.iloc[:0]
+
+        if len(wrangled) > 0:
+            path = os.path.join(folder, 'chunk_{}.feather'.format(len(paths)))
+            with phase('write'), \
+                 FrameWriter(path, 'feather', 'none') as writer:
+                writer.write(wrangled)
+            paths.append(path)
+
+        log("Wrangled chunk {} ({:,} rows read so far)"\
+                .format(nchunks - 1, nrows),
+            level = lg.INFO)
+
+    return paths, header, ids
+
+
+def load_salt(salt_file):
+    """
+    Read the digest salt stored in salt_file, as a hex string.
+
+    If the file doesn't exist, a random salt is generated and saved to it,
+    readable only by the current user.
+    """
+    if os.path.isfile(salt_file):
+        with open(salt_file, 'r') as f:
+            return bytes.fromhex(f.read().strip())
+
+    salt = os.urandom(10)
+
+    fd = os.open(salt_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(salt.hex())
+
+    log("Saved new digest salt to {}".format(salt_file), level = lg.INFO)
+
+    return salt
+
+
+def anonymise_plates(
+    plates,
+    digest_size = 10,
+    digest_salt = b'',
+    as_int64 = False
+):
+    """
+    Replace license plate numbers with their salted blake2b hex digests.
+
+    Each vehicle is usually observed many times in a batch of ANPR data, so
+    plates are first factorised and only unique plates are hashed. The digests
+    are then broadcast back to every observation with a single array take.
+    Missing plates remain missing.
+
+    If as_int64, digests (of at most 8 bytes) are returned as int64 instead,
+    see cli.ids.
+    """
+    codes, uniques = pd.factorize(plates)
+
+    digests = [
+        hashlib.blake2b(plate.encode(),
+                        digest_size = digest_size,
+                        salt = digest_salt).digest()
+        for plate in uniques
+    ]
+
+    if as_int64:
+        digests = encode_digests(digests)
+        if (codes < 0).any():
+            # Code -1 (missing plate) takes the last element
+            digests = pd.array(np.append(digests, 0), dtype = 'Int64')
+            digests[-1] = pd.NA
+    else:
+        # Code -1 (missing plate) takes the last element
+        digests = np.array([digest.hex() for digest in digests] + [np.nan],
+                           dtype = object)
+
+    return pd.Series(digests.take(codes), index = plates.index,
+                     name = plates.name)
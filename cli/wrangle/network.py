@@ -1,15 +1,33 @@
 import  os
 import  click
+import  contextlib
 import  geopandas           as gpd
 import  osmnx               as ox
 import  networkx            as nx
 import  pathlib
+import  numpy               as np
+import  pandas              as pd
+import  logging             as lg
+import  multiprocessing     as mp
+
+from    shapely.geometry    import LineString
 
 from    anprx.cameras       import network_from_cameras
 from    anprx.cameras       import merge_cameras_network
 from    anprx.cameras       import camera_pairs_from_graph
 from    anprx.cameras       import gdfs_from_network
 from    anprx.nominatim     import get_amenities
+from    anprx.utils         import log
+
+from    ..pairs             import PairIndex
+from    ..graphs            import camera_bbox
+from    ..graphs            import offline_osm
+from    ..graphs            import graph_cache_key
+from    ..graphs            import read_cached_graph
+from    ..graphs            import write_cached_graph
+from    ..graphs            import read_graph
+from    ..graphs            import write_graph
+from    ..profiling         import phase
 
 @click.argument(
     'output-pkl',
@@ -61,30 +79,81 @@ from    anprx.nominatim     import get_amenities
     help = ("Where to save close-up camera figures within the working "
             "directory's image folder")
 )
+@click.option(
+    '--osm-file',
+    type = click.Path(exists = True, dir_okay = False),
+    default = None,
+    required = False,
+    help = ("Build the graph from a local OpenStreetMap extract (.osm or "
+            ".pbf) instead of downloading it.")
+)
+@click.option(
+    '--cache/--no-cache',
+    default = False,
+    show_default = True,
+    help = ("Reuse the graph built by a previous run for the same cameras, "
+            "road type and extract, or build it and cache it for later "
+            "runs.")
+)
 @click.command()
 def network(
     input_geojson, output_pkl,
     road_type,
     figures, figure_format,
-    dpi, fig_height, subdir
+    dpi, fig_height, subdir,
+    osm_file, cache
 ):
     """
     Obtain the road network graph from OpenStreetMap.
+
+    The graph is written as a gpickle, or as a compact graph store if
+    OUTPUT_PKL is a directory or ends with .graph (see convert graph).
+
+    By default, the graph is downloaded from the OpenStreetMap API. With
+    --osm-file, it's built offline from a local extract instead. anprx still
+    chooses the bounding box and roads of --road-type, projects the graph
+    and makes the figures, but osmnx reads the roads from the extract rather
+    than downloading them (see cli.graphs.offline_osm). Pbf extracts require
+    osmium-tool.
+
+    With --cache, graphs are cached in the app folder, keyed by the bounding
+    box of the cameras, --road-type and --osm-file, so repeated runs load the
+    cached graph instead of building it again. Downloaded graphs can change
+    as OpenStreetMap is edited, so caching is off by default. Figures are
+    only made when the graph is built, so --figures skips reading the cache.
     """
 
-    cameras = gpd.GeoDataFrame.from_file(input_geojson)
+    with phase('read'):
+        cameras = gpd.GeoDataFrame.from_file(input_geojson)
 
-    G = network_from_cameras(
-        cameras,
-        road_type = road_type,
-        plot = figures,
-        file_format = figure_format,
-        fig_height = fig_height,
-        dpi = dpi,
-        subdir = subdir
-    )
+        key = graph_cache_key(camera_bbox(cameras), road_type, osm_file)
+
+        G = None
+        if cache and not figures:
+            G = read_cached_graph(key)
 
-    nx.write_gpickle(G, output_pkl)
+    if G is None:
+        with phase('anprx'):
+            source = offline_osm(osm_file) if osm_file is not None \
+                     else contextlib.nullcontext()
+
+            with source:
+                G = network_from_cameras(
+                    cameras,
+                    road_type = road_type,
+                    plot = figures,
+                    file_format = figure_format,
+                    fig_height = fig_height,
+                    dpi = dpi,
+                    subdir = subdir
+                )
+
+        if cache:
+            with phase('write'):
+                write_cached_graph(G, key)
+
+    with phase('write'):
+        write_graph(G, output_pkl)
 
     return 0
 
@@ -95,7 +164,7 @@ def network(
 )
 @click.argument(
     'input_network_pkl',
-    type=click.File('rb')
+    type = click.Path(exists = True)
 )
 @click.argument(
     'input_cameras_geojson',
@@ -163,23 +232,26 @@ def merge(
     Merge a set of cameras with a road network graph.
     """
 
-    cameras = gpd.GeoDataFrame.from_file(input_cameras_geojson)
+    with phase('read'):
+        cameras = gpd.GeoDataFrame.from_file(input_cameras_geojson)
 
-    G = nx.read_gpickle(input_network_pkl)
+        G = read_graph(input_network_pkl)
 
-    G = merge_cameras_network(
-        G,
-        cameras,
-        passes = passes,
-        camera_range = camera_range,
-        plot = figures,
-        figure_format = figure_format,
-        fig_height = fig_height,
-        dpi = dpi,
-        subdir = subdir
-    )
+    with phase('anprx'):
+        G = merge_cameras_network(
+            G,
+            cameras,
+            passes = passes,
+            camera_range = camera_range,
+            plot = figures,
+            figure_format = figure_format,
+            fig_height = fig_height,
+            dpi = dpi,
+            subdir = subdir
+        )
 
-    nx.write_gpickle(G, output_pkl)
+    with phase('write'):
+        write_graph(G, output_pkl)
 
     return 0
 
@@ -190,26 +262,235 @@ def merge(
 )
 @click.argument(
     'input-pkl',
-    type=click.File('rb')
+    type = click.Path(exists = True)
+)
+@click.option(
+    '--index',
+    default = None,
+    type = click.Path(file_okay = False),
+    required = False,
+    help = ("Also write a compact, memory-mappable index of camera pair "
+            "distances to this directory (e.g. camera-pairs.pairs), for "
+            "fast lookups in compute trips and compute avspeed.")
+)
+@click.option(
+    '--routes',
+    type = click.Choice(['anprx', 'dijkstra']),
+    default = 'dijkstra',
+    show_default = True,
+    help = ("Compute routes with scipy's Dijkstra from each origin camera, "
+            "over a process pool, or pair by pair with anprx. Both give "
+            "the same pairs.")
+)
+@click.option(
+    '--workers',
+    default = 1,
+    type = click.IntRange(min = 1),
+    show_default = True,
+    required = False,
+    help = ("With --routes dijkstra, number of processes used to compute "
+            "shortest routes.")
+)
+@click.option(
+    '--geometry/--no-geometry',
+    default = True,
+    show_default = True,
+    help = ("With --routes dijkstra, whether to compute the geometry of each "
+            "route. Skip it if only distances are needed.")
 )
 @click.command()
-def camera_pairs(input_pkl, output_geojson):
+def camera_pairs(input_pkl, output_geojson, index, routes, workers, geometry):
     """
     Compute valid camera pairs and their distance.
 
     Compute the shortest route and the total driving distance for all valid
     combinations of cameras pairs : (origin, destination).
+
+    By default, routes are computed with scipy's Dijkstra, once from each
+    origin camera to every destination, in batches of origins over a process
+    pool, rather than pair by pair as anprx's camera_pairs_from_graph does.
+    The pairs are the same as anprx's: cameras are the nodes with a truthy
+    'is_camera' attribute, identified by their camera id (see camera_id),
+    the distance is that of the shortest route, and a pair is valid if that
+    route doesn't go through any other camera. If the input is a graph store
+    (see convert graph), routes are computed directly on its memory-mapped
+    arrays, without building a networkx graph. Use --routes anprx to compute
+    them with anprx instead.
     """
 
-    G = nx.read_gpickle(input_pkl)
+    if routes == 'anprx' and (workers > 1 or not geometry):
+        raise click.BadParameter(
+            "--workers and --no-geometry require --routes dijkstra",
+            param_hint = '--routes')
 
-    pairs = camera_pairs_from_graph(G)
+    if routes == 'anprx':
+        with phase('read'):
+            G = read_graph(input_pkl)
 
-    pairs.to_file(output_geojson, driver='GeoJSON')
+        with phase('anprx'):
+            pairs = camera_pairs_from_graph(G)
+    else:
+        with phase('read'):
+            store = read_graph(input_pkl, networkx = False)
+
+        with phase('transform'):
+            pairs = store_camera_pairs(store, workers, geometry)
+
+    with phase('write'):
+        pairs.to_file(output_geojson, driver='GeoJSON')
+
+        if index is not None:
+            PairIndex.from_pairs(pairs).write(index)
 
     return 0
 
 
+_routes_worker = {}
+
+
+def store_camera_pairs(store, workers = 1, geometry = True, batch_size = 64):
+    """
+    Compute the shortest route between every pair of cameras in a graph store.
+
+    Shortest distances from batches of batch_size origin cameras are computed
+    with scipy's Dijkstra over the adjacency matrix of the graph (weighted by
+    the length of the shortest of parallel edges), and routes are read back
+    from the predecessors of each camera. Batches run over a process pool.
+    Pairs have the columns of anprx's camera_pairs_from_graph, and are
+    identified by camera ids (see camera_id).
+    """
+    nodes = store.nodes
+    is_camera = nodes['is_camera'].fillna(False).values.astype(bool) \
+                if 'is_camera' in nodes.columns \
+                else np.zeros(len(nodes), dtype = bool)
+    cameras = np.flatnonzero(is_camera)
+
+    log("Computing shortest routes between {} cameras using {} workers."\
+            .format(len(cameras), workers),
+        level = lg.INFO)
+
+    batches = [cameras[i:i + batch_size]
+               for i in range(0, len(cameras), batch_size)]
+    initargs = (store, is_camera, cameras, geometry)
+
+    if workers == 1:
+        init_store_routes_worker(*initargs)
+        rows = [store_routes_from_cameras(batch) for batch in batches]
+    else:
+        with mp.Pool(
+            processes = workers,
+            initializer = init_store_routes_worker,
+            initargs = initargs
+        ) as pool:
+            rows = pool.map(store_routes_from_cameras, batches)
+
+    pairs = pd.DataFrame(
+        [row for batch_rows in rows for row in batch_rows],
+        columns = ['origin', 'destination', 'distance', 'valid', 'geometry']
+    )
+
+    return gpd.GeoDataFrame(pairs, geometry = 'geometry',
+                            crs = store.graph.get('crs'))
+
+
+def init_store_routes_worker(store, is_camera, cameras, geometry):
+    # Geometry of the lightest edge between adjacent nodes, where it has one
+    edge_geometries = {}
+    if geometry and 'geometry' in store.edges.columns:
+        u, v, edges = store.lightest_edges('length')
+        lines = store.edges['geometry'].values[edges]
+        edge_geometries = {(a, b) : line
+                           for a, b, line in zip(u.tolist(), v.tolist(), lines)
+                           if hasattr(line, 'coords')}
+
+    _routes_worker.update(
+        adjacency       = store.adjacency('length'),
+        ids             = np.array([camera_id(node)
+                                    for node in store.nodes['node'].values],
+                                   dtype = object),
+        x               = store.nodes['x'].values,
+        y               = store.nodes['y'].values,
+        is_camera       = is_camera,
+        cameras         = cameras,
+        geometry        = geometry,
+        edge_geometries = edge_geometries
+    )
+
+
+def store_routes_from_cameras(origins):
+    """Shortest routes from each of origins to every other camera."""
+    from scipy.sparse.csgraph import dijkstra
+
+    ids       = _routes_worker['ids']
+    is_camera = _routes_worker['is_camera']
+    cameras   = _routes_worker['cameras']
+
+    distances, predecessors = dijkstra(
+        _routes_worker['adjacency'],
+        indices = origins,
+        return_predecessors = True
+    )
+
+    rows = []
+
+    for i, origin in enumerate(origins):
+        for destination in cameras:
+            if destination == origin:
+                continue
+
+            if not np.isfinite(distances[i, destination]):
+                rows.append((ids[origin], ids[destination], np.nan, False, None))
+                continue
+
+            route = [destination]
+            while route[-1] != origin:
+                route.append(predecessors[i, route[-1]])
+            route = route[::-1]
+
+            valid = not is_camera[route[1:-1]].any()
+
+            line = None
+            if _routes_worker['geometry']:
+                line = route_line(route)
+
+            rows.append((ids[origin], ids[destination],
+                         distances[i, destination], valid, line))
+
+    return rows
+
+
+def camera_id(node):
+    """
+    Camera id of a camera node. anprx labels the nodes of the cameras it
+    merges into a network 'c_<camera id>' (see wrangle merge), and camera
+    pairs are identified by camera ids, as anpr observations are.
+    """
+    if isinstance(node, str) and node.startswith('c_'):
+        return node[2:]
+
+    return node
+
+
+def route_line(route):
+    """
+    Geometry of a route, along the geometry of its edges, or straight between
+    its nodes where edges have none.
+    """
+    x = _routes_worker['x']
+    y = _routes_worker['y']
+    edge_geometries = _routes_worker['edge_geometries']
+
+    coords = [(x[route[0]], y[route[0]])]
+
+    for a, b in zip(route[:-1], route[1:]):
+        line = edge_geometries.get((int(a), int(b)))
+        points = list(line.coords)[1:] if line is not None \
+                 else [(x[b], y[b])]
+        coords.extend(points)
+
+    return LineString(coords)
+
+
 @click.argument(
     'output-geojson',
     type = str,
@@ -8,8 +8,12 @@ setup(
     py_modules=[],
     install_requires=[
         'click',
-        'anprx >= 0.1.3'
+        'anprx >= 0.1.3',
+        'scipy'
     ],
+    extras_require={
+        'parquet': ['pyarrow']
+    },
     entry_points='''
         [console_scripts]
         anpr=cli.anpr:cli
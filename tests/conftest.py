@@ -0,0 +1,37 @@
+import re
+import pytest
+
+from cli.profiling import anprx_version
+
+anprx_requirement = (0, 1, 3)
+"""Version of anprx that the integration tests check the CLI against."""
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        'markers',
+        "integration: compares the CLI with anprx itself, and only runs "
+        "with anprx {} or later installed".format(
+            '.'.join(map(str, anprx_requirement))))
+
+
+def version_tuple(version):
+    return tuple(int(part) for part in re.findall(r'\d+', version)[:3])
+
+
+def pytest_collection_modifyitems(config, items):
+    """
+    Skip integration tests unless a release of anprx is installed, rather
+    than e.g. a stand-in module without package metadata.
+    """
+    version = anprx_version()
+
+    if version is not None and version_tuple(version) >= anprx_requirement:
+        return
+
+    skip = pytest.mark.skip(reason = "needs anprx {} or later, found {}"\
+        .format('.'.join(map(str, anprx_requirement)), version))
+
+    for item in items:
+        if 'integration' in item.keywords:
+            item.add_marker(skip)
@@ -0,0 +1,54 @@
+import os
+import sys
+import json
+import subprocess
+import pandas as pd
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_cli(args, cwd):
+    """
+    Run the CLI in a new interpreter, and return the modules it imported.
+    """
+    script = (
+        "import sys, json\n"
+        "from cli.anpr import cli\n"
+        "try:\n"
+        "    cli({!r}, standalone_mode = False)\n"
+        "finally:\n"
+        "    print(json.dumps(sorted(sys.modules)))\n"
+    ).format(args)
+
+    result = subprocess.run(
+        [sys.executable, '-c', script],
+        cwd = cwd,
+        env = dict(os.environ, PYTHONPATH = root),
+        stdout = subprocess.PIPE,
+        universal_newlines = True,
+        check = True)
+
+    lines = result.stdout.strip().splitlines()
+    return '\n'.join(lines[:-1]), set(json.loads(lines[-1]))
+
+
+def test_group_help_imports_no_subcommand(tmp_path):
+    output, modules = run_cli(['convert', '--help'], str(tmp_path))
+
+    assert 'Convert trip files between pickle, csv, parquet and feather.' \
+           in output
+    assert 'Obtain the road network graph from OpenStreetMap.' in output
+    assert 'anprx' not in modules
+    assert not any(module.startswith('cli.convert.') for module in modules)
+    assert not os.path.exists(str(tmp_path / '.temp'))
+
+
+def test_command_without_anprx(tmp_path):
+    pd.DataFrame({'vehicle' : ['a', 'b'], 'trip' : [1, 2]})\
+      .to_pickle(str(tmp_path / 'trips.pkl'))
+
+    _, modules = run_cli(['convert', 'pkl', '--to', 'csv',
+                          str(tmp_path / 'trips.pkl')], str(tmp_path))
+
+    assert os.path.isfile(str(tmp_path / 'trips.csv'))
+    assert 'anprx' not in modules
@@ -0,0 +1,129 @@
+import numpy  as np
+import pandas as pd
+import pytest
+
+gpd = pytest.importorskip('geopandas')
+pytest.importorskip('scipy')
+
+from cli.spatial import neighbour_batches
+
+
+def points(xy, crs = 'EPSG:27700'):
+    xy = np.asarray(xy, dtype = float)
+    return gpd.GeoDataFrame(
+        geometry = gpd.points_from_xy(xy[:, 0], xy[:, 1]), crs = crs)
+
+
+@pytest.fixture
+def raw_cameras():
+    """
+    Clusters of cameras 1 km apart, on the same road in both directions.
+    Cameras of a cluster are 80 m apart in a line, so with a distance of
+    100 m the first and the last aren't within distance of each other.
+    """
+    rng = np.random.default_rng(0)
+    rows = []
+
+    for cluster in range(30):
+        lat = 54.97 + 0.01 * (cluster // 6)
+        lon = -1.62 + 0.015 * (cluster % 6)
+        for i in range(rng.integers(1, 4)):
+            for direction in ['N/B', 'S/B']:
+                rows.append(dict(
+                    id = 'C{:02d}{}{}'.format(cluster, i, direction[0]),
+                    name = 'Camera {}'.format(len(rows)),
+                    # About 80 m per step of longitude at this latitude
+                    lat = lat,
+                    lon = lon + i * 0.00125,
+                    description = 'A{} Road {}'.format(cluster % 3, direction),
+                    is_commissioned = True
+                ))
+
+    return pd.DataFrame(rows)
+
+
+def test_batches_are_apart():
+    rng = np.random.default_rng(0)
+    first = points(rng.uniform(0, 5000, (300, 2)))
+    second = points(rng.uniform(0, 5000, (200, 2)))
+
+    batches = neighbour_batches([first, second], 150, batch_size = 20)
+
+    batch = [np.full(len(first), -1), np.full(len(second), -1)]
+    for b, rows in enumerate(batches):
+        for i in range(2):
+            batch[i][rows[i]] = b
+
+    assert (batch[0] >= 0).all() and (batch[1] >= 0).all()
+
+    xy = np.concatenate([np.column_stack([f.geometry.x, f.geometry.y])
+                         for f in [first, second]])
+    batch = np.concatenate(batch)
+    distances = np.hypot(*(xy[:, None, :] - xy[None, :, :]).transpose(2, 0, 1))
+
+    assert (batch[:, None] == batch[None, :])[distances <= 150].all()
+    assert len(batches) > 1
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize('batch_size', [1, 4, 500])
+def test_merge_matches_anprx(raw_cameras, batch_size):
+    pytest.importorskip('anprx')
+
+    from anprx.cameras       import wrangle_cameras
+    from cli.wrangle.cameras import merge_by_neighbours
+
+    kwargs = dict(
+        is_test_col = 'name',
+        is_commissioned_col = 'is_commissioned',
+        road_attr_col = 'description',
+        drop_car_park = True,
+        drop_na_direction = True,
+        distance_threshold = 100.0,
+        sort_by = 'id'
+    )
+
+    expected = wrangle_cameras(cameras = raw_cameras.copy(),
+                               merge_cameras = True, **kwargs)
+    merged = merge_by_neighbours(raw_cameras.copy(), 100.0, kwargs,
+                                 batch_size = batch_size)
+
+    pd.testing.assert_frame_equal(merged,
+                                  expected.reset_index(drop = True))
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize('batch_size', [1, 4, 500])
+def test_nodes_match_anprx(raw_cameras, batch_size):
+    pytest.importorskip('anprx')
+
+    from anprx.cameras       import wrangle_cameras
+    from anprx.cameras       import map_nodes_cameras
+    from cli.wrangle.cameras import map_by_neighbours
+
+    kwargs = dict(
+        is_test_col = 'name',
+        is_commissioned_col = 'is_commissioned',
+        road_attr_col = 'description',
+        drop_car_park = True,
+        drop_na_direction = True,
+        distance_threshold = 100.0,
+        sort_by = 'id'
+    )
+
+    cameras = wrangle_cameras(cameras = raw_cameras.copy(),
+                              merge_cameras = True, **kwargs)
+
+    # Nodes next to every other camera, and some far from any camera
+    raw_nodes = raw_cameras.iloc[::2].assign(
+        id = lambda df: 'N' + df['id'],
+        lat = lambda df: df['lat'] + 0.0003)
+    raw_nodes.loc[raw_nodes.index[::5], 'lat'] += 0.1
+
+    expected = map_nodes_cameras(nodes = raw_nodes.copy(), cameras = cameras,
+                                 **kwargs)
+    mapped = map_by_neighbours(raw_nodes.copy(), cameras, 100.0, kwargs,
+                               batch_size = batch_size)
+
+    pd.testing.assert_frame_equal(mapped,
+                                  expected.reset_index(drop = True))
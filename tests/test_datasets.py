@@ -0,0 +1,129 @@
+import multiprocessing as mp
+import numpy           as np
+import pandas          as pd
+import pytest
+
+from cli.datasets import DatasetWriter
+from cli.datasets import camera_ids
+from cli.datasets import matching_buckets
+from cli.datasets import read_manifest
+from cli.datasets import trip_steps
+from cli.datasets import update_manifest
+from cli.datasets import write_dataset
+from cli.files    import read_frame
+
+
+def trips():
+    rng = np.random.default_rng(0)
+    n = 200
+
+    start = pd.Timestamp('2019-01-01') + \
+            pd.to_timedelta(np.sort(rng.integers(0, 3 * 86400, n)), 's')
+
+    df = pd.DataFrame({
+        'vehicle'       : rng.choice(['v1', 'v2', 'v3'], n),
+        'origin'        : rng.choice([1.0, 2.0, 3.0, np.nan], n),
+        'destination'   : rng.choice([1.0, 2.0, 3.0], n),
+        't_origin'      : start,
+        't_destination' : start + pd.Timedelta('10min')
+    })
+
+    df['trip'] = df.groupby('vehicle').cumcount() // 5
+    df['trip_step'] = df.groupby(['vehicle', 'trip']).cumcount() + 1
+
+    return df.sort_values(['vehicle', 'trip', 'trip_step'])\
+             .reset_index(drop = True)
+
+
+def test_camera_ids_of_float_columns():
+    df = pd.DataFrame({'origin'      : [1.0, np.nan, np.nan],
+                       'destination' : [2.0, 3.0, np.nan]})
+
+    assert camera_ids(df, ['origin', 'destination']).tolist() == \
+           ['1', '3', 'nan']
+
+
+def test_matching_buckets_of_float_ids():
+    buckets = matching_buckets([[('origin', 'in', [1.0, '2'])]],
+                               ['origin', 'destination'], 4)
+    ids = camera_ids(pd.DataFrame({'origin' : [1.0, 2.0]}), 'origin')
+
+    assert buckets == set(matching_buckets(
+        [[('origin', 'in', ids.tolist())]], 'origin', 4))
+
+
+def test_read_filtered_trips(tmp_path):
+    df = trips()
+    root = str(tmp_path / 'trips')
+
+    write_dataset(df, root, 'trips', camera_buckets = 4, **trip_steps)
+
+    assert len(read_manifest(root)['files']) > 3
+
+    filtered = read_frame(root, filters = [[('origin', 'in', ['1'])]])
+    expected = df[df['origin'] == 1.0].reset_index(drop = True)
+
+    pd.testing.assert_frame_equal(filtered[expected.columns], expected,
+                                  check_dtype = False)
+
+
+def test_read_sorts_trip_steps(tmp_path):
+    df = trips()
+    root = str(tmp_path / 'trips')
+
+    write_dataset(df, root, 'trips', camera_buckets = 4, **trip_steps)
+
+    pd.testing.assert_frame_equal(read_frame(root)[df.columns], df,
+                                  check_dtype = False)
+
+
+def update(args):
+    root, name = args
+    entry = dict(path = name, name = name, date = '2019-01-01',
+                 camera_bucket = None, rows = 1, start = None, end = None)
+    update_manifest(root, [entry], [name], 'parquet', 'timestamp',
+                    'camera', None)
+
+
+def test_concurrent_manifest_updates(tmp_path):
+    root = str(tmp_path / 'anpr')
+    names = ['part-{}'.format(i) for i in range(32)]
+
+    with mp.Pool(4) as pool:
+        pool.map(update, [(root, name) for name in names])
+
+    assert sorted(e['name'] for e in read_manifest(root)['files']) == \
+           sorted(names)
+
+
+def test_failed_rewrite_keeps_batch(tmp_path):
+    df = trips()
+    root = str(tmp_path / 'trips')
+
+    write_dataset(df, root, 'batch', **trip_steps)
+    manifest = read_manifest(root)
+
+    with pytest.raises(RuntimeError):
+        with DatasetWriter(root, 'batch', **trip_steps) as writer:
+            writer.write(df.iloc[:10])
+            raise RuntimeError
+
+    assert read_manifest(root) == manifest
+    assert sorted(str(p.relative_to(root))
+                  for p in tmp_path.glob('trips/date=*/*')) == \
+           sorted(e['path'] for e in manifest['files'])
+    pd.testing.assert_frame_equal(read_frame(root)[df.columns], df,
+                                  check_dtype = False)
+
+
+def test_rewrite_replaces_batch(tmp_path):
+    df = trips()
+    root = str(tmp_path / 'trips')
+
+    write_dataset(df, root, 'batch', **trip_steps)
+    write_dataset(df.iloc[:10], root, 'batch', **trip_steps)
+
+    assert sorted(str(p.relative_to(root))
+                  for p in tmp_path.glob('trips/date=*/*')) == \
+           sorted(e['path'] for e in read_manifest(root)['files'])
+    assert len(read_frame(root)) == 10
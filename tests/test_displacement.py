@@ -0,0 +1,77 @@
+import click
+import numpy  as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('anprx')
+pytest.importorskip('geopandas')
+
+import cli.compute.displacement as D
+
+
+@pytest.fixture
+def trips():
+    rng = np.random.default_rng(0)
+    n = 500
+
+    t = pd.Timestamp('2019-01-01') + \
+        pd.to_timedelta(np.sort(rng.integers(0, 86400, n)), 's')
+
+    trips = pd.DataFrame({
+        'vehicle'       : rng.choice(['v{}'.format(i) for i in range(20)], n),
+        'origin'        : rng.choice(['1', '2', '3', '4'], n).astype(object),
+        'destination'   : rng.choice(['1', '2', '3', '4'], n).astype(object),
+        't_origin'      : t,
+        't_destination' : t + pd.to_timedelta(rng.integers(60, 600, n), 's')
+    })
+
+    trips.loc[rng.choice(n, 30, replace = False), 'origin'] = np.nan
+    trips.loc[rng.choice(n, 30, replace = False), 'destination'] = np.nan
+
+    return trips
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize('chunk_size', [1, 3, 100])
+def test_workers(trips, chunk_size):
+    single = D.parallel_displacement(trips, 100, workers = 1,
+                                     chunk_size = chunk_size)
+    multi = D.parallel_displacement(trips, 100, workers = 2,
+                                    chunk_size = chunk_size)
+
+    pd.testing.assert_frame_equal(single, multi)
+    pd.testing.assert_frame_equal(single[trips.columns], trips)
+
+    has_od = trips['origin'].notna() & trips['destination'].notna()
+    assert single.loc[~has_od, 'displacement'].isna().all()
+    assert single.loc[has_od, 'displacement'].notna().all()
+
+
+def test_columns_dropped_by_anprx(monkeypatch, trips):
+    def displacement(df, buffer_size, parallel = True):
+        # Reorders rows and drops the columns it doesn't use, but keeps the
+        # index
+        df = df.sort_values('t_destination')[['origin', 'destination']]
+        return df.assign(displacement = 1.0)
+
+    monkeypatch.setattr(D, 'all_ods_displacement', displacement)
+
+    result = D.parallel_displacement(trips, 100, workers = 1)
+
+    has_od = trips['origin'].notna() & trips['destination'].notna()
+
+    pd.testing.assert_frame_equal(
+        result[['origin', 'destination']],
+        trips[['origin', 'destination']])
+    assert (result.loc[has_od, 'displacement'] == 1.0).all()
+
+
+def test_format_without_output(tmp_path, trips):
+    path = str(tmp_path / 'trips.pkl')
+    trips.to_pickle(path)
+
+    with pytest.raises(click.BadParameter):
+        D.displacement.main(['--format', 'parquet', path],
+                            standalone_mode = False)
+
+    pd.testing.assert_frame_equal(pd.read_pickle(path), trips)
@@ -0,0 +1,216 @@
+import os
+import numpy  as np
+import pandas as pd
+import pytest
+
+from cli.compute.engine import compute_flows
+from cli.compute.engine import freq_nanos
+from cli.compute.engine import multi_resolution_flows
+from cli.compute.engine import SparseFlows
+
+
+FREQS = ['1min', '5min', '15min']
+
+
+@pytest.fixture
+def trips():
+    rng = np.random.default_rng(0)
+    n = 400
+
+    start = pd.Timestamp('2019-01-01 08:00:00') + \
+            pd.to_timedelta(rng.integers(0, 3 * 3600, n), 's')
+    duration = pd.to_timedelta(rng.gamma(2, 150, n).astype(int), 's')
+
+    trips = pd.DataFrame({
+        'vehicle'       : rng.choice(['v1', 'v2', 'v3', 'v4'], n),
+        'origin'        : rng.choice(['1', '2', '3'], n).astype(object),
+        'destination'   : rng.choice(['1', '2', '3'], n).astype(object),
+        't_origin'      : start,
+        't_destination' : start + duration
+    })
+
+    # Steps ending exactly at the start of a period, and instantaneous ones
+    trips.loc[:9, 't_origin'] = pd.Timestamp('2019-01-01 09:14:30')
+    trips.loc[:4, 't_destination'] = pd.Timestamp('2019-01-01 09:15:00')
+    trips.loc[5:9, 't_destination'] = pd.Timestamp('2019-01-01 09:14:30')
+
+    # First and last steps of trips
+    trips.loc[10:19, 'origin'] = np.nan
+    trips.loc[10:19, 't_origin'] = pd.NaT
+    trips.loc[20:29, 'destination'] = np.nan
+    trips.loc[20:29, 't_destination'] = pd.NaT
+
+    return trips
+
+
+def normalise(flows):
+    """Non-zero flows sorted by (origin, destination, period)."""
+    if 'flow' not in flows.columns:
+        flows = flows.reset_index()
+
+    flows = flows[flows['flow'] > 0]
+    flows = flows[['origin', 'destination', 'period', 'flow']]\
+                .fillna({'origin' : '', 'destination' : ''})\
+                .astype({'period' : 'datetime64[ns]', 'flow' : np.int64})
+
+    return flows.sort_values(['origin', 'destination', 'period'])\
+                .reset_index(drop = True)
+
+
+def brute_force_flows(trips, freq, apply_pthreshold, pthreshold,
+                      same_period, remove_na):
+    """Count flows period by period, from the overlap of each step."""
+    nanos = freq_nanos(freq)
+    counts = {}
+
+    for step in trips.itertuples():
+        if remove_na and (pd.isna(step.origin) or pd.isna(step.destination)):
+            continue
+
+        t_start = step.t_origin if pd.notna(step.t_origin) \
+                  else step.t_destination
+        t_end = step.t_destination if pd.notna(step.t_destination) \
+                else step.t_origin
+
+        start = t_start.value
+        end = max(t_end.value, start)
+
+        periods = range(start // nanos, max(end - 1, start) // nanos + 1)
+
+        if same_period:
+            periods = [start // nanos]
+        elif apply_pthreshold:
+            periods = [p for p in periods
+                       if min(end, (p + 1) * nanos) - max(start, p * nanos)
+                          >= pthreshold * nanos]
+
+        for p in periods:
+            key = (step.origin if pd.notna(step.origin) else '',
+                   step.destination if pd.notna(step.destination) else '',
+                   pd.Timestamp(p * nanos))
+            counts[key] = counts.get(key, 0) + 1
+
+    return normalise(pd.DataFrame(
+        [key + (flow,) for key, flow in counts.items()],
+        columns = ['origin', 'destination', 'period', 'flow']))
+
+
+@pytest.mark.parametrize('freq', FREQS)
+@pytest.mark.parametrize('apply_pthreshold, pthreshold, same_period', [
+    (False, 0.02, False),
+    (True,  0.02, False),
+    (True,  0.5,  False),
+    (False, 0.02, True),
+])
+@pytest.mark.parametrize('remove_na', [False, True])
+def test_engine_matches_brute_force(trips, freq, apply_pthreshold, pthreshold,
+                                    same_period, remove_na):
+    flows = compute_flows(
+        trips,
+        freq = freq,
+        apply_pthreshold = apply_pthreshold,
+        pthreshold = pthreshold,
+        same_period = same_period,
+        remove_na = remove_na
+    )
+
+    expected = brute_force_flows(trips, freq, apply_pthreshold, pthreshold,
+                                 same_period, remove_na)
+
+    pd.testing.assert_frame_equal(normalise(flows.to_frame()), expected)
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize('freq', FREQS)
+@pytest.mark.parametrize('apply_pthreshold, pthreshold, same_period', [
+    (False, 0.02, False),
+    (True,  0.02, False),
+    (True,  0.5,  False),
+    (False, 0.02, True),
+])
+@pytest.mark.parametrize('remove_na', [False, True])
+def test_engine_matches_anprx(trips, freq, apply_pthreshold, pthreshold,
+                              same_period, remove_na):
+    anprx_flows = pytest.importorskip('anprx.flows')
+
+    dtrips = anprx_flows.discretise_time(
+        trips.copy(),
+        freq = freq,
+        apply_pthreshold = apply_pthreshold,
+        pthreshold = pthreshold,
+        same_period = same_period
+    )
+    expected = anprx_flows.get_flows(dtrips, remove_na = remove_na)
+
+    flows = compute_flows(
+        trips,
+        freq = freq,
+        apply_pthreshold = apply_pthreshold,
+        pthreshold = pthreshold,
+        same_period = same_period,
+        remove_na = remove_na
+    )
+
+    pd.testing.assert_frame_equal(normalise(flows.to_frame()),
+                                  normalise(expected))
+
+
+@pytest.mark.parametrize('same_period', [False, True])
+def test_multi_resolution_flows(trips, same_period):
+    flows = dict(multi_resolution_flows(trips, FREQS,
+                                        same_period = same_period))
+
+    for freq in FREQS:
+        expected = compute_flows(trips, freq = freq,
+                                 same_period = same_period)
+
+        pd.testing.assert_frame_equal(normalise(flows[freq].to_frame()),
+                                      normalise(expected.to_frame()))
+
+
+@pytest.mark.parametrize('mmap', [False, True])
+def test_sparse_round_trip(tmp_path, trips, mmap):
+    flows = compute_flows(trips, freq = '5min')
+    path = str(tmp_path / 'flows_5min')
+
+    flows.write(path)
+    read = SparseFlows.read(path, mmap = mmap)
+
+    assert os.path.isfile(os.path.join(path, 'pairs.parquet'))
+    assert read.freq == flows.freq
+
+    pd.testing.assert_frame_equal(read.pairs, flows.pairs)
+    pd.testing.assert_frame_equal(normalise(read.to_frame()),
+                                  normalise(flows.to_frame()))
+
+
+def test_expanded_round_trip(tmp_path, trips):
+    flows = compute_flows(trips, freq = '15min')
+    flows.expanded = True
+    path = str(tmp_path / 'flows_15min')
+
+    flows.write(path)
+    read = SparseFlows.read(path)
+
+    assert read.expanded
+    assert len(read.flow) == len(flows.flow)
+
+    expanded = read.to_frame()
+    assert len(expanded) == len(read.pairs) * len(read.periods())
+    pd.testing.assert_frame_equal(expanded, flows.expand())
+    pd.testing.assert_frame_equal(
+        normalise(read.to_frame(expand = False)),
+        normalise(expanded[expanded['flow'] > 0]))
+
+
+@pytest.mark.parametrize('freq, message', [
+    ('5QQ', "can't be parsed"),
+    ('often', "can't be parsed"),
+    ('1W', "does not have a fixed length"),
+    ('0min', "must be positive")
+])
+def test_invalid_freq(freq, message):
+    with pytest.raises(ValueError, match = message):
+        freq_nanos(freq)
+
+    assert freq_nanos('15min') == 15 * 60 * 10**9
@@ -0,0 +1,181 @@
+import numpy  as np
+import pandas as pd
+import pytest
+
+from click.testing import CliRunner
+
+from cli.files       import FrameWriter
+from cli.files       import read_frame
+from cli.files       import write_csv
+from cli.files       import infer_format
+from cli.files       import file_root
+from cli.files       import merge_sorted_frames
+from cli.convert.any import pkl
+
+
+@pytest.mark.parametrize('format', ['pkl', 'parquet', 'feather'])
+@pytest.mark.parametrize('buffer_rows', [1, 1000])
+def test_all_missing_first_chunk(tmp_path, format, buffer_rows):
+    first = pd.DataFrame({'vehicle' : ['a', 'b'], 'origin' : [None, None]})
+    first.attrs = {'hashed_ids' : {'vehicle' : 8}}
+    second = pd.DataFrame({'vehicle' : ['c'], 'origin' : ['x']})
+
+    path = str(tmp_path / ('trips.' + format))
+    with FrameWriter(path, buffer_rows = buffer_rows) as writer:
+        writer.write(first)
+        writer.write(second)
+
+    df = read_frame(path)
+
+    assert df['vehicle'].tolist() == ['a', 'b', 'c']
+    assert df['origin'].isna().tolist() == [True, True, False]
+    assert df.attrs == first.attrs
+
+
+@pytest.mark.parametrize('extension', ['csv', 'csv.gz', 'csv.zst'])
+def test_csv_quoting(tmp_path, extension):
+    df = pd.DataFrame({
+        'name'      : ['x', 'y,z', 'q"'],
+        'count'     : [1, 2, 3],
+        'timestamp' : pd.to_datetime(['2019-01-01 00:00:00',
+                                      '2019-01-02 00:00:01',
+                                      '2019-01-03 00:00:00'])
+    })
+
+    path = str(tmp_path / ('flows.' + extension))
+    write_csv(df, path, chunksize = 1)
+
+    pd.testing.assert_frame_equal(
+        read_frame(path, time_column = 'timestamp'), df,
+        check_dtype = False)
+
+    if extension == 'csv':
+        with open(path) as f:
+            assert f.read() == ('name,count,timestamp\n'
+                                'x,1,2019-01-01 00:00:00\n'
+                                '"y,z",2,2019-01-02 00:00:01\n'
+                                '"q""",3,2019-01-03 00:00:00\n')
+
+
+@pytest.mark.parametrize('path, format', [
+    ('trips.pkl', 'pkl'),
+    ('trips.pkl.gz', 'pkl'),
+    ('trips.parquet', 'parquet'),
+    ('flows.csv', 'csv'),
+    ('flows.csv.gz', 'csv'),
+    ('flows.zst', 'csv')
+])
+def test_infer_format(path, format):
+    assert infer_format(path) == format
+
+
+def test_file_root():
+    assert file_root('data/trips.pkl.gz') == 'data/trips'
+    assert file_root('data/flows.csv.zst') == 'data/flows'
+    assert file_root('data/flows.zst') == 'data/flows'
+    assert file_root('data/trips.parquet') == 'data/trips'
+
+
+@pytest.mark.parametrize('to', ['csv', 'parquet', 'feather'])
+def test_convert_chunks(tmp_path, to):
+    df = pd.DataFrame({
+        'vehicle' : ['a', 'b', 'c', 'd'],
+        'origin'  : [None, None, 'x', 'y']
+    })
+    path = str(tmp_path / 'trips.pkl.gz')
+    df.to_pickle(path)
+
+    result = CliRunner().invoke(
+        pkl, ['--to', to, '--chunksize', '2', path])
+
+    assert result.exit_code == 0, result.output
+
+    converted = read_frame(str(tmp_path / ('trips.' + to)))
+
+    assert converted['vehicle'].tolist() == df['vehicle'].tolist()
+    assert converted['origin'].isna().tolist() == [True, True, False, False]
+
+
+@pytest.mark.parametrize('to', ['csv', 'pkl', 'parquet', 'feather'])
+def test_convert_no_matching_rows(tmp_path, to):
+    df = pd.DataFrame({
+        'vehicle'  : ['a', 'b'],
+        't_origin' : pd.to_datetime(['2019-01-01', '2019-01-02'])
+    })
+    path = str(tmp_path / 'trips.parquet')
+    df.to_parquet(path)
+
+    result = CliRunner().invoke(
+        pkl, ['--to', to, '--time-column', 't_origin',
+              '--start', '2020-01-01', '--out-name',
+              str(tmp_path / 'converted'), path])
+
+    assert result.exit_code == 0, result.output
+
+    converted = read_frame(str(tmp_path / ('converted.' + to)))
+
+    assert len(converted) == 0
+    assert converted.columns.tolist() == df.columns.tolist()
+
+
+@pytest.mark.parametrize('to, compression', [
+    ('feather', 'snappy'),
+    ('pkl', 'gzip')
+])
+def test_convert_unsupported_compression(tmp_path, to, compression):
+    path = str(tmp_path / 'trips.pkl')
+    pd.DataFrame({'vehicle' : ['a']}).to_pickle(path)
+
+    result = CliRunner().invoke(
+        pkl, ['--to', to, '--compression', compression, '--out-name',
+              str(tmp_path / 'converted'), path])
+
+    assert result.exit_code != 0
+    assert '--compression' in result.output
+
+
+@pytest.mark.parametrize('format', ['csv', 'parquet', 'feather'])
+def test_writer_deletes_file_on_error(tmp_path, format):
+    path = str(tmp_path / ('trips.' + format))
+
+    with pytest.raises(RuntimeError):
+        with FrameWriter(path, buffer_rows = 1) as writer:
+            writer.write(pd.DataFrame({'vehicle' : ['a', 'b']}))
+            raise RuntimeError
+
+    assert not (tmp_path / ('trips.' + format)).exists()
+
+
+@pytest.mark.parametrize('chunksize', [1, 7, 100, 10000])
+def test_merge_sorted_frames(tmp_path, chunksize):
+    rng = np.random.default_rng(0)
+
+    # Few distinct times, so that many rows of different files are tied
+    runs = [pd.DataFrame({
+                'timestamp' : pd.Timestamp('2019-01-01') + pd.to_timedelta(
+                    np.sort(rng.integers(0, 50, n)), 's'),
+                'run'       : i,
+                'row'       : np.arange(n)})
+            for i, n in enumerate([300, 1, 250, 2, 40])]
+
+    paths = []
+    for i, run in enumerate(runs):
+        paths.append(str(tmp_path / 'run_{}.feather'.format(i)))
+        with FrameWriter(paths[-1], buffer_rows = 1) as writer:
+            for start in range(0, len(run), 13):
+                writer.write(run.iloc[start:start + 13])
+
+    chunks = list(merge_sorted_frames(paths, 'timestamp', chunksize))
+
+    expected = pd.concat(runs, ignore_index = True)\
+                 .sort_values('timestamp', kind = 'mergesort')\
+                 .reset_index(drop = True)
+
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index = True),
+                                  expected)
+
+    # Only rows tied with the last time read from a file are held beyond
+    # the chunk size
+    ties = expected.groupby('timestamp').size().max()
+    assert max(len(chunk) for chunk in chunks) <= \
+           max(chunksize, len(paths)) + len(paths) * ties
@@ -0,0 +1,185 @@
+import numpy  as np
+import pandas as pd
+import pytest
+
+from cli.files   import read_frame
+from cli.files   import iter_frames
+from cli.filters import camera_filters
+from cli.filters import parse_cameras
+from cli.filters import parse_pairs
+from cli.ids     import encode_ids
+from cli.ids     import decode_ids
+
+
+formats = ['pkl', 'parquet', 'feather', 'csv']
+
+
+def write(df, path):
+    {
+        'pkl'     : df.to_pickle,
+        'parquet' : df.to_parquet,
+        'feather' : df.to_feather,
+        'csv'     : lambda path: df.to_csv(path, index = False)
+    }[path.rsplit('.', 1)[1]](path)
+
+    return path
+
+
+@pytest.fixture
+def anpr():
+    return pd.DataFrame({
+        'vehicle'   : ['a', 'b', 'c', 'a'],
+        'camera'    : [1, 2, 3, 1],
+        'timestamp' : pd.to_datetime(['2019-01-01', '2019-01-02',
+                                      '2019-01-03', '2019-01-04'])
+    })
+
+
+@pytest.fixture
+def steps():
+    return pd.DataFrame({
+        'vehicle'       : ['a', 'a', 'a', 'b'],
+        'origin'        : [np.nan, 1.0, 2.0, np.nan],
+        'destination'   : [1.0, 2.0, 3.0, 2.0],
+        't_origin'      : pd.to_datetime([None, '2019-01-01',
+                                          '2019-01-02', None]),
+        't_destination' : pd.to_datetime(['2019-01-01', '2019-01-02',
+                                          '2019-01-03', '2019-01-02'])
+    })
+
+
+@pytest.mark.parametrize('format', formats)
+def test_integer_cameras(tmp_path, anpr, format):
+    path = write(anpr, str(tmp_path / ('anpr.' + format)))
+    filters = camera_filters(parse_cameras('1,2,x'))
+
+    df = read_frame(path, time_column = 'timestamp', filters = filters)
+
+    assert df['vehicle'].tolist() == ['a', 'b', 'a']
+
+
+@pytest.mark.parametrize('format', formats)
+def test_float_pairs(tmp_path, steps, format):
+    path = write(steps, str(tmp_path / ('steps.' + format)))
+    filters = camera_filters(None, parse_pairs('1:2,2:3'),
+                             ('origin', 'destination'))
+
+    df = read_frame(path, filters = filters)
+
+    assert df['origin'].tolist() == [1.0, 2.0]
+    assert df['destination'].tolist() == [2.0, 3.0]
+
+
+@pytest.mark.parametrize('format', formats)
+def test_float_cameras(tmp_path, steps, format):
+    path = write(steps, str(tmp_path / ('steps.' + format)))
+    filters = camera_filters(parse_cameras('2'), None,
+                             ('origin', 'destination'))
+
+    chunks = list(iter_frames(path, chunksize = 2, filters = filters))
+
+    assert pd.concat(chunks)['destination'].tolist() == [2.0, 3.0, 2.0]
+
+
+@pytest.mark.parametrize('format', ['pkl', 'parquet', 'feather'])
+def test_encoded_cameras(tmp_path, anpr, format):
+    encoded = encode_ids(anpr.astype({'camera' : str}))
+    path = write(encoded, str(tmp_path / ('anpr.' + format)))
+    filters = camera_filters(parse_cameras('2,3'))
+
+    df = decode_ids(read_frame(path, filters = filters))
+
+    assert df['vehicle'].tolist() == ['b', 'c']
+
+
+@pytest.fixture
+def many_steps():
+    rng = np.random.default_rng(0)
+    n = 200000
+
+    df = pd.DataFrame({
+        'origin'      : rng.integers(1, 101, n).astype(float),
+        'destination' : rng.integers(1, 101, n).astype(float)
+    })
+    df.loc[rng.choice(n, 1000, replace = False), 'origin'] = np.nan
+
+    return df
+
+
+@pytest.fixture
+def many_pairs():
+    rng = np.random.default_rng(1)
+    cameras = np.arange(1, 101)
+
+    pairs = pd.DataFrame({
+        'origin'      : np.repeat(cameras, len(cameras)),
+        'destination' : np.tile(cameras, len(cameras))
+    })
+
+    return pairs.iloc[rng.choice(len(pairs), 5000, replace = False)]
+
+
+def expected_steps(df, pairs, cameras = None):
+    mask = pd.MultiIndex.from_frame(df[['origin', 'destination']])\
+             .isin(list(pairs[['origin', 'destination']]
+                        .astype(float).itertuples(index = False)))
+    if cameras is not None:
+        mask &= df['origin'].isin(cameras) | df['destination'].isin(cameras)
+
+    return df[mask].reset_index(drop = True)
+
+
+@pytest.mark.parametrize('format', formats)
+@pytest.mark.parametrize('cameras', [None, '1,2,3'])
+def test_many_pairs(tmp_path, many_steps, many_pairs, format, cameras):
+    path = write(many_steps, str(tmp_path / ('steps.' + format)))
+    pairs = list(zip(many_pairs['origin'].astype(str),
+                     many_pairs['destination'].astype(str)))
+    filters = camera_filters(parse_cameras(cameras), pairs,
+                             ('origin', 'destination'))
+
+    expected = expected_steps(
+        many_steps, many_pairs,
+        None if cameras is None else [1.0, 2.0, 3.0])
+
+    pd.testing.assert_frame_equal(
+        read_frame(path, filters = filters).reset_index(drop = True),
+        expected)
+
+    chunks = list(iter_frames(path, chunksize = 50000, filters = filters))
+
+    pd.testing.assert_frame_equal(
+        pd.concat(chunks, ignore_index = True), expected)
+
+
+def test_many_encoded_pairs(tmp_path, many_steps, many_pairs):
+    steps = many_steps.dropna().astype(int).astype(str)
+    encoded = encode_ids(steps)
+    path = write(encoded, str(tmp_path / 'steps.parquet'))
+    filters = camera_filters(None, list(zip(
+        many_pairs['origin'].astype(str),
+        many_pairs['destination'].astype(str))), ('origin', 'destination'))
+
+    df = decode_ids(read_frame(path, filters = filters))
+
+    expected = expected_steps(steps.astype(float), many_pairs)
+
+    pd.testing.assert_frame_equal(df.astype(float).reset_index(drop = True),
+                                  expected)
+
+
+def test_pair_index_file(tmp_path, many_steps, many_pairs):
+    pytest.importorskip('geopandas')
+
+    from cli.pairs import PairIndex
+
+    path = str(tmp_path / 'pairs.pairs')
+    PairIndex.from_pairs(many_pairs.assign(distance = 1.0, valid = True))\
+             .write(path)
+
+    steps = write(many_steps, str(tmp_path / 'steps.parquet'))
+    filters = camera_filters(None, parse_pairs(path),
+                             ('origin', 'destination'))
+
+    pd.testing.assert_frame_equal(read_frame(steps, filters = filters),
+                                  expected_steps(many_steps, many_pairs))
@@ -0,0 +1,98 @@
+import click
+import numpy  as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('anprx')
+pytest.importorskip('geopandas')
+
+from cli.compute.engine import compute_flows
+from cli.compute.engine import SparseFlows
+from cli.compute.flows  import flows
+from cli.compute.flows  import rollup_flows
+from cli.files          import read_frame
+from cli.files          import write_frame
+
+
+@pytest.fixture
+def trips():
+    rng = np.random.default_rng(0)
+    n = 300
+
+    start = pd.Timestamp('2019-01-01 08:00:00') + \
+            pd.to_timedelta(rng.integers(0, 6 * 3600, n), 's')
+
+    return pd.DataFrame({
+        'vehicle'       : rng.choice(['v1', 'v2', 'v3'], n),
+        'origin'        : rng.choice(['1', '2', '3'], n).astype(object),
+        'destination'   : rng.choice(['1', '2', '3'], n).astype(object),
+        't_origin'      : start,
+        't_destination' : start + pd.Timedelta('20min')
+    })
+
+
+def sorted_flows(df):
+    return df.sort_values(['origin', 'destination', 'period'])\
+             .reset_index(drop = True)
+
+
+@pytest.mark.parametrize('same_period', [False, True])
+def test_multiple_frequencies(tmp_path, trips, same_period):
+    path = str(tmp_path / 'trips.parquet')
+    write_frame(trips, path)
+
+    freqs = ['10min', '15min', '30min', '1h']
+    options = ['--engine', 'numpy', '--output-format', 'parquet']
+    if same_period:
+        options.append('--same-period')
+
+    flows.main(options + ['--freq', ','.join(freqs), path,
+                          str(tmp_path / 'flows.parquet')],
+               standalone_mode = False)
+
+    for freq in freqs:
+        expected = str(tmp_path / 'flows_{}_direct.parquet'.format(freq))
+        flows.main(options + ['--freq', freq, path, expected],
+                   standalone_mode = False)
+
+        pd.testing.assert_frame_equal(
+            sorted_flows(read_frame(
+                str(tmp_path / 'flows_{}.parquet'.format(freq)))),
+            sorted_flows(read_frame(expected)))
+
+
+def test_rollup_flows(trips):
+    fine = compute_flows(trips, freq = '15min', same_period = True)
+    coarse = compute_flows(trips, freq = '1h', same_period = True)
+
+    pd.testing.assert_frame_equal(
+        sorted_flows(rollup_flows(fine.to_frame(), '1h')),
+        sorted_flows(coarse.to_frame()),
+        check_dtype = False)
+
+
+@pytest.mark.parametrize('expand', [False, True])
+def test_sparse_output(tmp_path, trips, expand):
+    path = str(tmp_path / 'trips.parquet')
+    write_frame(trips, path)
+
+    options = ['--engine', 'numpy', '--freq', '15min'] + \
+              (['--expand'] if expand else [])
+
+    flows.main(options + ['--output-format', 'sparse',
+                          path, str(tmp_path / 'flows')],
+               standalone_mode = False)
+    flows.main(options + ['--output-format', 'parquet',
+                          path, str(tmp_path / 'flows.parquet')],
+               standalone_mode = False)
+
+    sparse = SparseFlows.read(str(tmp_path / 'flows'))
+
+    # Zero flows aren't stored, only implied
+    assert (sparse.flow > 0).all()
+    assert sparse.expanded == expand
+
+    pd.testing.assert_frame_equal(
+        sorted_flows(sparse.to_frame()),
+        sorted_flows(read_frame(str(tmp_path / 'flows.parquet'))),
+        check_dtype = False)
@@ -0,0 +1,150 @@
+import networkx as nx
+import pytest
+
+pytest.importorskip('anprx')
+
+from shapely.geometry import LineString
+
+from cli.graphs import BBox
+from cli.graphs import GraphStore
+from cli.graphs import graph_from_extract
+from cli.graphs import matches_osm_filter
+from cli.graphs import offline_osm
+from cli.graphs import osm_filter_conditions
+from cli.graphs import read_graph
+from cli.graphs import write_graph
+
+
+@pytest.fixture
+def graph():
+    G = nx.MultiDiGraph(name = 'test', crs = {'init' : 'epsg:4326'},
+                        bbox = (1.5, 2.5))
+    G.graph['transform'] = complex(1, 2)
+
+    G.add_node(1, x = 0.0, y = 0.0, osmid = 1, is_camera = True)
+    G.add_node(2, x = 1.0, y = 0.0, osmid = 2, ref = None)
+    G.add_node('c_3', x = 1.0, y = 1.0, is_camera = True)
+
+    G.add_edge(1, 2, length = 1.0, lanes = 2, osmid = [10, 11],
+               geometry = LineString([(0, 0), (0.5, 0.1), (1, 0)]))
+    G.add_edge(1, 2, length = 2.5, name = None)
+    G.add_edge(2, 'c_3', length = 1.0, lanes = '2;3', oneway = True,
+               ref = ('A1', 'A2'), speeds = {30 : 'urban', (1, 2) : [1.5]},
+               tags = {'highway' : ('primary', None)})
+
+    return G
+
+
+def same_graph(G, H):
+    assert type(G) == type(H)
+    assert G.graph == H.graph
+    assert list(G.nodes(data = True)) == list(H.nodes(data = True))
+
+    for (u, v, k, d), (x, y, l, e) in zip(sorted(G.edges(keys = True,
+                                                         data = True),
+                                                 key = str),
+                                          sorted(H.edges(keys = True,
+                                                         data = True),
+                                                 key = str)):
+        assert (u, v, k) == (x, y, l)
+        assert d.keys() == e.keys()
+        for key, value in d.items():
+            assert value == e[key], key
+            assert type(value) == type(e[key]), key
+
+
+def test_round_trip(tmp_path, graph):
+    path = str(tmp_path / 'network.graph')
+
+    write_graph(graph, path)
+    same_graph(graph, read_graph(path))
+
+
+def test_read_store(tmp_path, graph):
+    path = str(tmp_path / 'network.graph')
+    write_graph(graph, path)
+
+    store = read_graph(path, networkx = False)
+
+    assert isinstance(store, GraphStore)
+    assert store.nodes['node'].tolist() == [1, 2, 'c_3']
+    same_graph(graph, store.to_networkx())
+
+
+def test_osm_filter():
+    conditions = osm_filter_conditions(
+        '["highway"]["area"!~"yes"]["highway"~"primary|trunk"]'
+        '["access"!="private"]')
+
+    assert conditions == [('highway', None, ''), ('area', '!~', 'yes'),
+                          ('highway', '~', 'primary|trunk'),
+                          ('access', '!=', 'private')]
+
+    assert matches_osm_filter({'highway' : 'primary'}, conditions)
+    assert matches_osm_filter({'highway' : ['residential', 'trunk']},
+                              conditions)
+    assert not matches_osm_filter({'highway' : 'residential'}, conditions)
+    assert not matches_osm_filter({'highway' : 'primary', 'area' : 'yes'},
+                                  conditions)
+    assert not matches_osm_filter({'highway' : 'primary',
+                                   'access' : 'private'}, conditions)
+    assert not matches_osm_filter({}, conditions)
+
+
+osm_xml = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="test">
+  <node id="1" lat="54.970" lon="-1.620" version="1"/>
+  <node id="2" lat="54.971" lon="-1.619" version="1"/>
+  <node id="3" lat="54.972" lon="-1.618" version="1"/>
+  <node id="4" lat="54.973" lon="-1.617" version="1"/>
+  <node id="5" lat="55.500" lon="-1.000" version="1"/>
+  <way id="10" version="1">
+    <nd ref="1"/><nd ref="2"/><nd ref="3"/>
+    <tag k="highway" v="primary"/>
+  </way>
+  <way id="11" version="1">
+    <nd ref="3"/><nd ref="4"/>
+    <tag k="highway" v="footway"/>
+  </way>
+  <way id="12" version="1">
+    <nd ref="3"/><nd ref="5"/>
+    <tag k="highway" v="primary"/>
+  </way>
+</osm>
+"""
+
+
+@pytest.fixture
+def extract(tmp_path):
+    path = tmp_path / 'extract.osm'
+    path.write_text(osm_xml)
+    return str(path)
+
+
+def test_graph_from_extract(extract):
+    pytest.importorskip('osmnx')
+
+    bbox = BBox(north = 54.98, south = 54.96, east = -1.61, west = -1.63)
+
+    G = graph_from_extract(extract, bbox,
+                           custom_filter = '["highway"~"primary"]',
+                           simplify = False)
+
+    assert set(G.nodes) == {1, 2, 3}
+    assert all(highway == 'primary'
+               for _, _, highway in G.edges(data = 'highway'))
+
+
+def test_offline_osm(extract):
+    ox = pytest.importorskip('osmnx')
+
+    original = ox.graph_from_bbox
+
+    with offline_osm(extract):
+        G = ox.graph_from_bbox(54.98, 54.96, -1.61, -1.63,
+                               custom_filter = '["highway"~"primary"]',
+                               simplify = False)
+
+    assert set(G.nodes) == {1, 2, 3}
+    assert ox.graph_from_bbox is original
+
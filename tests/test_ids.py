@@ -0,0 +1,48 @@
+import pandas as pd
+import pytest
+
+from cli.files import read_frame
+from cli.files import write_frame
+from cli.files import file_schema
+from cli.ids   import encode_ids
+from cli.ids   import decode_ids
+
+
+@pytest.fixture
+def anpr():
+    return pd.DataFrame({
+        'vehicle'   : ['AB12CDE', 'XY34ZZZ', 'AB12CDE', None],
+        'camera'    : ['CAM01', 'CAM02', 'CAM03', 'CAM01'],
+        'timestamp' : pd.to_datetime(['2019-01-01 00:00:00',
+                                      '2019-01-01 00:01:00',
+                                      '2019-01-01 00:02:00',
+                                      '2019-01-01 00:03:00'])
+    })
+
+
+@pytest.mark.parametrize('format', ['pkl', 'parquet', 'feather'])
+def test_round_trip(tmp_path, anpr, format):
+    path = str(tmp_path / ('anpr.' + format))
+
+    write_frame(encode_ids(anpr), path)
+    df = read_frame(path)
+
+    assert df['camera'].dtype == 'int32'
+    pd.testing.assert_frame_equal(decode_ids(df), anpr, check_dtype = False)
+
+
+@pytest.mark.parametrize('format', ['parquet', 'feather'])
+def test_schema_metadata(tmp_path, anpr, format):
+    path = str(tmp_path / ('anpr.' + format))
+
+    write_frame(encode_ids(anpr), path)
+
+    assert b'PANDAS_ATTRS' in file_schema(path, format).metadata
+
+
+def test_lost_dictionaries(anpr):
+    encoded = encode_ids(anpr)
+    del encoded.attrs['dictionaries']
+
+    with pytest.raises(ValueError):
+        decode_ids(encoded)
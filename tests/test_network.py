@@ -0,0 +1,122 @@
+import itertools
+import networkx as nx
+import numpy    as np
+import pandas   as pd
+import pytest
+
+pytest.importorskip('anprx')
+pytest.importorskip('geopandas')
+
+from shapely.geometry import LineString
+
+from cli.graphs          import GraphStore
+from cli.wrangle.network import store_camera_pairs
+
+
+@pytest.fixture
+def graph():
+    G = nx.MultiDiGraph(crs = 'epsg:32630')
+
+    for node, x in enumerate(range(6)):
+        G.add_node(node, x = float(x), y = 0.0,
+                   is_camera = node in {0, 2, 5})
+
+    G.add_edge(0, 1, length = 1.0,
+               geometry = LineString([(0, 0), (0.5, 1), (1, 0)]))
+    G.add_edge(1, 2, length = 1.0)
+    G.add_edge(1, 3, length = 4.0)
+    G.add_edge(1, 3, length = 3.0)
+    G.add_edge(2, 3, length = 1.0)
+    G.add_edge(3, 5, length = 1.0)
+    G.add_edge(5, 0, length = 10.0)
+    G.add_node(6, x = 6.0, y = 0.0, is_camera = True)
+
+    return G
+
+
+@pytest.fixture
+def merged_graph(graph):
+    """graph with its camera nodes labelled as anprx labels them."""
+    return nx.relabel_nodes(graph, {
+        node : 'c_{}'.format(node)
+        for node, is_camera in graph.nodes(data = 'is_camera') if is_camera})
+
+
+def reference_pairs(G):
+    """Camera pairs of G, computed pair by pair with networkx."""
+    cameras = [n for n, is_camera in G.nodes(data = 'is_camera') if is_camera]
+    pairs = {}
+
+    for origin, destination in itertools.permutations(cameras, 2):
+        try:
+            distance, route = nx.single_source_dijkstra(
+                G, origin, destination, weight = 'length')
+        except nx.NetworkXNoPath:
+            pairs[(origin, destination)] = (np.nan, False)
+            continue
+
+        valid = not any(G.nodes[n]['is_camera'] for n in route[1:-1])
+        pairs[(origin, destination)] = (distance, valid)
+
+    return pairs
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_store_camera_pairs(graph, workers):
+    pairs = store_camera_pairs(GraphStore.from_networkx(graph),
+                               workers = workers, batch_size = 2)
+
+    computed = {(o, d) : (distance, valid)
+                for o, d, distance, valid in pairs[['origin', 'destination',
+                                                    'distance', 'valid']]\
+                                                  .itertuples(index = False)}
+
+    reference = reference_pairs(graph)
+
+    assert computed.keys() == reference.keys()
+    for pair, (distance, valid) in reference.items():
+        assert computed[pair][1] == valid, pair
+        np.testing.assert_equal(computed[pair][0], distance)
+
+
+def test_route_geometry(graph):
+    pairs = store_camera_pairs(GraphStore.from_networkx(graph))
+    pairs = pairs.set_index(['origin', 'destination'])
+
+    assert list(pairs.loc[(0, 2), 'geometry'].coords) == \
+           [(0, 0), (0.5, 1), (1, 0), (2, 0)]
+    assert pairs.loc[(0, 6), 'geometry'] is None
+
+
+def test_camera_ids(merged_graph):
+    pairs = store_camera_pairs(GraphStore.from_networkx(merged_graph))
+
+    assert set(pairs['origin']) == {'0', '2', '5', '6'}
+    assert set(pairs['destination']) == {'0', '2', '5', '6'}
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize('workers', [1, 2])
+def test_camera_pairs_match_anprx(merged_graph, workers):
+    from anprx.cameras import camera_pairs_from_graph
+
+    expected = camera_pairs_from_graph(merged_graph.copy())
+    pairs = store_camera_pairs(GraphStore.from_networkx(merged_graph),
+                               workers = workers, batch_size = 2)
+
+    assert list(pairs.columns) == list(expected.columns)
+
+    def sort(df):
+        return df.sort_values(['origin', 'destination'])\
+                 .reset_index(drop = True)
+
+    pairs, expected = sort(pairs), sort(expected)
+
+    pd.testing.assert_frame_equal(
+        pd.DataFrame(pairs.drop(columns = 'geometry')),
+        pd.DataFrame(expected.drop(columns = 'geometry')),
+        check_dtype = False)
+
+    for line, expected_line in zip(pairs.geometry, expected.geometry):
+        assert (line is None and expected_line is None) or \
+               line.equals(expected_line)
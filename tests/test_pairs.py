@@ -0,0 +1,69 @@
+import numpy  as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('geopandas')
+
+from cli.pairs import MISSING
+from cli.pairs import PairIndex
+
+
+@pytest.fixture
+def pairs():
+    return pd.DataFrame({
+        'origin'      : [1, 1, 2, 3, 4],
+        'destination' : [2, 3, 3, 1, 1],
+        'distance'    : [10.0, 25.0, np.nan, 30.0, 5.0],
+        'valid'       : [True, True, False, True, False]
+    })
+
+
+def as_sorted(df):
+    return df.sort_values(['origin', 'destination']).reset_index(drop = True)
+
+
+def test_lookup(pairs):
+    index = PairIndex.from_pairs(pairs)
+
+    distance, valid = index.lookup(['1', '2', '2', '9'], ['2', '3', '1', '1'])
+
+    np.testing.assert_array_equal(distance, [10.0, np.nan, np.nan, np.nan])
+    np.testing.assert_array_equal(valid, [1, 0, MISSING, MISSING])
+
+
+@pytest.mark.parametrize('mmap', [False, True])
+def test_round_trip(tmp_path, pairs, mmap):
+    path = str(tmp_path / 'pairs.pairs')
+
+    PairIndex.from_pairs(pairs).write(path)
+    df = PairIndex.read(path, mmap = mmap).to_frame()
+
+    expected = pairs.astype({'origin' : str, 'destination' : str})
+
+    pd.testing.assert_frame_equal(as_sorted(df), as_sorted(expected))
+
+
+def test_pairs_between_cameras(pairs):
+    index = PairIndex.from_pairs(pairs)
+
+    df = index.to_frame(cameras = ['1', '3', '9'])
+    expected = index.to_frame()
+    expected = expected[expected['origin'].isin(['1', '3']) &
+                        expected['destination'].isin(['1', '3'])]
+
+    pd.testing.assert_frame_equal(as_sorted(df), as_sorted(expected))
+
+
+def test_float_ids(pairs):
+    # Ids of columns with missing values are read as floats
+    index = PairIndex.from_pairs(pairs.astype({'origin' : float}))
+
+    assert index.cameras.tolist() == ['1', '2', '3', '4']
+
+    distance, valid = index.lookup(np.array([1.0, 3.0, np.nan]), [2, 1, 1])
+
+    np.testing.assert_array_equal(distance, [10.0, 30.0, np.nan])
+    np.testing.assert_array_equal(valid, [1, 1, MISSING])
+
+    df = index.to_frame(cameras = [1.0, 2.0])
+    assert df[['origin', 'destination']].values.tolist() == [['1', '2']]
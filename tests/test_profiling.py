@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import pstats
+import pandas as pd
+import pytest
+
+from click.testing import CliRunner
+
+from cli           import profiling
+from cli.anpr      import cli
+
+
+@pytest.fixture(autouse = True)
+def no_profiler(monkeypatch):
+    monkeypatch.setattr(profiling, '_profiler', None)
+
+
+def test_phases(tmp_path):
+    profiler = profiling.enable(cprofile = True)
+
+    for _ in range(3):
+        with profiling.phase('read'):
+            pass
+    with profiling.phase('write'):
+        sum(range(1000))
+
+    path = profiler.write(str(tmp_path))
+
+    with open(path) as f:
+        summary = json.load(f)
+
+    assert set(summary['phases']) == {'read', 'write'}
+    assert summary['phases']['read']['calls'] == 3
+    assert summary['phases']['write']['calls'] == 1
+    assert summary['phases']['read']['peak_rss_mb'] > 0
+    assert summary['wall_time'] >= summary['phases']['write']['wall_time']
+
+    stats = os.path.splitext(path)[0] + '.pstats'
+    assert pstats.Stats(stats).total_calls > 0
+
+
+def test_phase_without_profiler():
+    with profiling.phase('read'):
+        pass
+
+    assert profiling._profiler is None
+
+
+def test_peak_rss_without_resource(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'resource', None)
+    monkeypatch.setitem(sys.modules, 'psutil', None)
+
+    assert profiling.peak_rss_mb() is None
+    assert profiling.peak_rss_mb(children = True) is None
+
+
+def test_profile_option(tmp_path):
+    pd.DataFrame({'vehicle' : ['a', 'b'], 'trip' : [1, 2]})\
+      .to_pickle(str(tmp_path / 'trips.pkl'))
+
+    result = CliRunner().invoke(cli, [
+        '--profile', '--app_folder', str(tmp_path / 'app'),
+        'convert', 'pkl', '--to', 'parquet', str(tmp_path / 'trips.pkl')])
+
+    assert result.exit_code == 0, result.output
+
+    profiles = os.listdir(str(tmp_path / 'app' / 'profiles'))
+    assert len(profiles) == 1
+
+    with open(str(tmp_path / 'app' / 'profiles' / profiles[0])) as f:
+        summary = json.load(f)
+
+    assert summary['command'] is not None
+    assert {'read', 'write'} <= set(summary['phases'])
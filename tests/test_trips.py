@@ -0,0 +1,271 @@
+import os
+import numpy  as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('anprx')
+pytest.importorskip('geopandas')
+
+import cli.compute.trips as T
+
+from cli.compute.trips import carry_over
+from cli.compute.trips import continue_trips
+from cli.compute.trips import expire_state
+from cli.compute.trips import identify_batch
+from cli.compute.trips import parallel_trip_identification
+from cli.compute.trips import trip_gap
+from cli.compute.trips import update_state
+from cli.compute.trips import trips as compute_trips
+from cli.files         import read_frame
+from cli.pairs         import PairIndex
+
+
+@pytest.fixture
+def anpr():
+    rng = np.random.default_rng(0)
+    n = 1000
+
+    return pd.DataFrame({
+        'vehicle'   : rng.choice(['v{:02d}'.format(i) for i in range(40)], n),
+        'camera'    : rng.choice(['1', '2', '3', '4'], n),
+        'timestamp' : pd.Timestamp('2019-01-01') +
+                      pd.to_timedelta(np.sort(rng.integers(0, 2 * 86400, n)),
+                                      's')
+    })
+
+
+@pytest.fixture
+def camera_pairs():
+    cameras = ['1', '2', '3', '4']
+
+    return pd.DataFrame({
+        'origin'      : np.repeat(cameras, len(cameras)),
+        'destination' : np.tile(cameras, len(cameras)),
+        'distance'    : np.arange(len(cameras) ** 2, dtype = float) * 100,
+        'valid'       : True
+    })
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize('workers', [2, 3, 64])
+def test_workers(anpr, camera_pairs, workers):
+    single = parallel_trip_identification(anpr, camera_pairs, workers = 1)
+    multi = parallel_trip_identification(anpr, camera_pairs,
+                                         workers = workers)
+
+    pd.testing.assert_frame_equal(multi, single)
+
+
+def test_state_from_trips():
+    t = pd.Timestamp('2019-01-01')
+    anpr = pd.DataFrame({
+        'vehicle'   : ['v1', 'v1', 'v1', 'v2'],
+        'camera'    : ['1', '2', '3', '1'],
+        'timestamp' : [t, t + pd.Timedelta('5min'),
+                       t + pd.Timedelta('6min'), t],
+        'confidence': [0.9, 0.8, 0.7, 0.6]
+    })
+    # The last observation of v1 was discarded by anprx
+    trips = pd.DataFrame({
+        'vehicle'       : ['v1', 'v1', 'v2'],
+        'origin'        : [np.nan, '1', np.nan],
+        'destination'   : ['1', '2', '1'],
+        't_origin'      : [pd.NaT, t, pd.NaT],
+        't_destination' : [t, t + pd.Timedelta('5min'), t],
+        'trip'          : [1, 1, 1],
+        'trip_step'     : [1, 2, 1]
+    })
+    previous = pd.DataFrame({
+        'vehicle'    : ['v1', 'v3'],
+        'camera'     : ['4', '4'],
+        'timestamp'  : [t, t],
+        'confidence' : [1.0, 1.0],
+        'trip'       : [7, 3],
+        'trip_step'  : [1, 2]
+    })
+
+    state = update_state(previous, anpr, trips).set_index('vehicle')
+
+    assert state.loc['v1', 'camera'] == '2'
+    assert state.loc['v1', 'confidence'] == 0.8
+    assert state.loc['v1', ['trip', 'trip_step']].tolist() == [1, 2]
+    assert state.loc['v3', 'trip'] == 3
+
+
+@pytest.mark.integration
+def test_expired_vehicles_start_new_trips(anpr, camera_pairs):
+    state = update_state(None, anpr, parallel_trip_identification(
+        anpr, camera_pairs, workers = 1))
+    last_trip = state.set_index('vehicle')['trip']
+
+    expired = expire_state(state, pd.Timedelta('1h'))
+    is_closed = expired['timestamp'].isna()
+
+    assert is_closed.any() and not is_closed.all()
+    assert expired['camera'].isna().equals(is_closed)
+    assert expired['trip'].equals(state['trip'])
+
+    later = anpr.assign(timestamp = anpr['timestamp'] + pd.Timedelta('3D'))
+    trips = parallel_trip_identification(carry_over(later, expired),
+                                         camera_pairs, workers = 1)
+    trips = continue_trips(trips, expired)
+
+    closed = expired.loc[is_closed, 'vehicle']
+    first_trip = trips[trips['vehicle'].isin(closed)]\
+        .groupby('vehicle')['trip'].min()
+
+    assert (first_trip == last_trip[first_trip.index] + 1).all()
+    assert not trips.duplicated(['vehicle', 'trip', 'trip_step']).any()
+
+
+def test_trip_gap(camera_pairs):
+    # 1500 m at 3 km/h
+    assert trip_gap(camera_pairs, 3.0) == pd.Timedelta('30min')
+    assert trip_gap(camera_pairs.assign(valid = False), 3.0) is None
+
+
+kwargs = dict(
+    speed_threshold = 3.0,
+    duplicate_threshold = 300.0,
+    maximum_av_speed = 120.0
+)
+
+keys = ['vehicle', 'trip', 'trip_step']
+
+
+def identify_batches(anpr, camera_pairs, bounds, max_trip_gap):
+    """Trip steps written by each batch between bounds, and the last state."""
+    state = None
+    batches = []
+
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        batch = anpr[(anpr['timestamp'] >= start) &
+                     (anpr['timestamp'] < end)].reset_index(drop = True)
+        trips, state = identify_batch(batch, camera_pairs, state, True,
+                                      max_trip_gap, 1, kwargs)
+        batches.append(trips)
+
+    return batches, state
+
+
+@pytest.mark.integration
+def test_two_batches_like_one(anpr, camera_pairs):
+    t = pd.Timestamp('2019-01-01')
+    batches, state = identify_batches(
+        anpr, camera_pairs, [t, t + pd.Timedelta('1D'), t + pd.Timedelta('2D')],
+        pd.Timedelta('10D'))
+
+    whole, _ = identify_batch(anpr, camera_pairs, None, False, None, 1,
+                              kwargs)
+
+    # Trips that are still open have their last step held back
+    is_open = whole.set_index(keys).index.isin(
+        state[state['timestamp'].notna()].set_index(keys).index) & \
+        whole['destination'].isna()
+
+    batched = pd.concat(batches, ignore_index = True)
+
+    assert not batched.duplicated(keys).any()
+    pd.testing.assert_frame_equal(
+        batched.sort_values(keys).reset_index(drop = True),
+        whole[~is_open].sort_values(keys).reset_index(drop = True),
+        check_dtype = False)
+
+
+@pytest.mark.integration
+def test_closed_trips_end_in_later_batch(anpr, camera_pairs):
+    t = pd.Timestamp('2019-01-01')
+    bounds = [t + pd.Timedelta(hours = h) for h in range(0, 49, 8)]
+
+    batches, state = identify_batches(anpr, camera_pairs, bounds,
+                                      pd.Timedelta('2h'))
+    batched = pd.concat(batches, ignore_index = True)
+
+    assert not batched.duplicated(keys).any()
+
+    # Every trip is written in full, ending with a step without destination,
+    # unless it's still open
+    last = batched.sort_values(keys).drop_duplicates(['vehicle', 'trip'],
+                                                     keep = 'last')
+    still_open = state[state['timestamp'].notna()]\
+        .set_index(['vehicle', 'trip']).index
+
+    assert last['destination'].isna().values.tolist() == \
+           (~last.set_index(['vehicle', 'trip']).index.isin(still_open))\
+               .tolist()
+
+    nsteps = batched.groupby(['vehicle', 'trip'])['trip_step']
+    assert (nsteps.max() == nsteps.count()).all()
+
+
+@pytest.fixture
+def batches(tmp_path, anpr, camera_pairs):
+    """Two days of observations, and an index of the camera pairs."""
+    PairIndex.from_pairs(camera_pairs).write(str(tmp_path / 'camera.pairs'))
+
+    day = anpr['timestamp'] < pd.Timestamp('2019-01-02')
+    for i, rows in enumerate([day, ~day]):
+        anpr[rows].reset_index(drop = True)\
+            .to_parquet(tmp_path / 'anpr_{}.parquet'.format(i))
+
+    return tmp_path
+
+
+def run_trips(folder, name, options, batch = 0):
+    output = str(folder / '{}_{}.parquet'.format(name, batch))
+    compute_trips.main(options + [str(folder / 'anpr_{}.parquet'.format(batch)),
+                                  str(folder / 'camera.pairs'), output],
+                       standalone_mode = False)
+    return output
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize('workers', ['1', '2'])
+@pytest.mark.parametrize('with_state', [False, True])
+def test_buckets_like_in_memory(batches, workers, with_state):
+    results = {}
+
+    for name, options in [('memory', []),
+                          ('buckets', ['--buckets', '5',
+                                       '--chunk-size', '100',
+                                       '--workers', workers])]:
+        if with_state:
+            options = options + ['--state',
+                                 str(batches / (name + '.state.parquet')),
+                                 '--max-trip-gap', '3h']
+
+        results[name] = pd.concat(
+            [read_frame(run_trips(batches, name, options, batch))
+             for batch in ([0, 1] if with_state else [0])],
+            ignore_index = True)
+
+    # Trips are grouped by bucket rather than sorted by vehicle
+    pd.testing.assert_frame_equal(
+        results['buckets'].sort_values(keys).reset_index(drop = True),
+        results['memory'].sort_values(keys).reset_index(drop = True))
+
+    if with_state:
+        states = [read_frame(str(batches / (name + '.state.parquet')))\
+                      .sort_values('vehicle').reset_index(drop = True)
+                  for name in ['memory', 'buckets']]
+        pd.testing.assert_frame_equal(*states)
+
+
+@pytest.mark.integration
+def test_buckets_abort_on_error(batches, monkeypatch):
+    calls = []
+
+    def trip_identification(anpr, camera_pairs, **kwargs):
+        calls.append(len(anpr))
+        if len(calls) == 2:
+            raise RuntimeError('bucket failed')
+        return identify(anpr, camera_pairs, **kwargs)
+
+    identify = T.trip_identification
+    monkeypatch.setattr(T, 'trip_identification', trip_identification)
+
+    with pytest.raises(RuntimeError):
+        run_trips(batches, 'buckets', ['--buckets', '3'])
+
+    assert len(calls) == 2
+    assert not os.path.exists(str(batches / 'buckets_0.parquet'))
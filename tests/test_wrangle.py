@@ -0,0 +1,244 @@
+import os
+import hashlib
+import click
+import numpy  as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('anprx')
+pytest.importorskip('geopandas')
+
+from anprx.cameras    import wrangle_raw_anpr
+
+from cli.files        import read_frame
+from cli.ids          import decode_digests
+from cli.wrangle.data import anonymise_plates
+from cli.wrangle.data import parse_timestamps
+from cli.wrangle.data import raw_anpr
+
+from datetime import datetime
+
+
+@pytest.fixture
+def raw():
+    rng = np.random.default_rng(0)
+    n = 200
+
+    return pd.DataFrame({
+        'vehicle'    : rng.choice(['AB12CDE', 'XY34ZZZ', 'QQ11QQQ',
+                                   'LM65NOP'], n),
+        'camera'     : rng.choice(['1', '2', '3'], n),
+        'timestamp'  : pd.Timestamp('2019-01-01') +
+                       pd.to_timedelta(np.sort(rng.integers(0, 86400, n)),
+                                       's'),
+        'confidence' : rng.uniform(0.5, 1, n)
+    })
+
+
+def test_anonymise_plates_like_hashlib():
+    plates = pd.Series(['AB12CDE', None, 'XY34ZZZ', 'AB12CDE'])
+
+    digests = anonymise_plates(plates, digest_size = 10, digest_salt = b's')
+
+    assert digests.tolist()[::2] == [
+        hashlib.blake2b(plate.encode(), digest_size = 10, salt = b's')\
+            .hexdigest()
+        for plate in ['AB12CDE', 'XY34ZZZ']]
+    assert digests[3] == digests[0]
+    assert pd.isna(digests[1])
+
+
+def test_anonymise_plates_as_int64():
+    plates = pd.Series(['AB12CDE', None, 'XY34ZZZ'])
+
+    hex_digests = anonymise_plates(plates, 8, b's')
+    int_digests = anonymise_plates(plates, 8, b's', as_int64 = True)
+
+    assert decode_digests(int_digests, 8).equals(hex_digests)
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize('digest_size', [8, 10])
+def test_anonymise_plates_like_anprx(raw, digest_size):
+    kwargs = dict(
+        cameras = None,
+        filter_low_confidence = True,
+        confidence_threshold = 0.7
+    )
+    salt = b'salt'
+
+    expected = wrangle_raw_anpr(raw.copy(), anonymise = True,
+                                digest_size = digest_size,
+                                digest_salt = salt, **kwargs)
+
+    wrangled = wrangle_raw_anpr(raw.copy(), anonymise = False, **kwargs)
+    vehicles = anonymise_plates(wrangled['vehicle'],
+                                digest_size = digest_size,
+                                digest_salt = salt)
+
+    assert vehicles.tolist() == expected['vehicle'].tolist()
+
+
+def test_salt_given_twice(tmp_path):
+    with pytest.raises(click.BadParameter):
+        raw_anpr.main(['--digest-salt', 'salt',
+                       '--salt-file', str(tmp_path / 'salt'),
+                       str(tmp_path / 'raw.csv'),
+                       str(tmp_path / 'wrangled.pkl')],
+                      standalone_mode = False)
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize('options', [
+    [],
+    ['--encode-ids', '--digest-size', '8'],
+    ['--encode-ids', '--no-anonymise'],
+    ['--dataset', '--encode-ids', '--digest-size', '8']
+])
+@pytest.mark.parametrize('chunksize', ['1', '7', '1000'])
+def test_chunks_like_whole_file(tmp_path, raw, options, chunksize):
+    # Unsorted, so that chunks overlap in time
+    raw = raw.sample(frac = 1, random_state = 0)
+    raw['timestamp'] = raw['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+    raw.to_csv(tmp_path / 'raw.csv', index = False)
+
+    def wrangled(name, *chunk_options):
+        output = str(tmp_path / name)
+        raw_anpr.main(['--digest-salt', 'salt'] + options +
+                      list(chunk_options) +
+                      [str(tmp_path / 'raw.csv'), output],
+                      standalone_mode = False)
+        return read_frame(output)
+
+    whole = wrangled('whole.parquet')
+    chunked = wrangled('chunked.parquet', '--chunksize', chunksize)
+
+    assert len(whole) > 0
+    pd.testing.assert_frame_equal(chunked, whole)
+    assert chunked.attrs == whole.attrs
+    assert not [path for path in tmp_path.iterdir()
+                if path.name.startswith('.')]
+
+
+@pytest.mark.integration
+def test_chunks_without_rows(tmp_path, raw):
+    raw['timestamp'] = raw['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+    raw['confidence'] = 0.1
+    raw.to_csv(tmp_path / 'raw.csv', index = False)
+
+    for name, options in [('whole.parquet', []),
+                          ('chunked.parquet', ['--chunksize', '10'])]:
+        raw_anpr.main(['--digest-salt', 'salt'] + options +
+                      [str(tmp_path / 'raw.csv'), str(tmp_path / name)],
+                      standalone_mode = False)
+
+    whole = read_frame(str(tmp_path / 'whole.parquet'))
+    chunked = read_frame(str(tmp_path / 'chunked.parquet'))
+
+    assert len(chunked) == 0
+    assert list(chunked.columns) == list(whole.columns)
+
+
+def to_csv(raw, path):
+    raw = raw.assign(
+        timestamp = raw['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S.%f'))
+    raw.to_csv(path, index = False)
+
+
+@pytest.mark.parametrize('date_format', ['%Y-%m-%d %H:%M:%S.%f',
+                                         '%d/%m/%Y %H:%M'])
+def test_parse_timestamps(raw, date_format):
+    timestamps = raw['timestamp'].dt.strftime(date_format)
+
+    parsed = parse_timestamps(timestamps, date_format)
+
+    assert parsed.tolist() == [datetime.strptime(t, date_format)
+                               for t in timestamps]
+
+
+def test_parse_timestamps_fallback(raw, monkeypatch):
+    timestamps = raw['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+    expected = parse_timestamps(timestamps, '%Y-%m-%d %H:%M:%S.%f')
+
+    to_datetime = pd.to_datetime
+
+    def vectorised_fails(arg, **kwargs):
+        if 'format' in kwargs:
+            raise ValueError("unsupported format")
+        return to_datetime(arg, **kwargs)
+
+    monkeypatch.setattr(pd, 'to_datetime', vectorised_fails)
+
+    pd.testing.assert_series_equal(
+        parse_timestamps(timestamps, '%Y-%m-%d %H:%M:%S.%f'), expected,
+        check_dtype = False)
+
+
+@pytest.mark.integration
+def test_output_formats(tmp_path, raw):
+    to_csv(raw, tmp_path / 'raw.csv')
+
+    frames = {}
+    for format in ['pkl', 'parquet', 'feather']:
+        output = str(tmp_path / 'wrangled.{}'.format(format))
+        raw_anpr.main(['--digest-salt', 'salt', str(tmp_path / 'raw.csv'),
+                       output],
+                      standalone_mode = False)
+        frames[format] = read_frame(output)
+
+    assert len(frames['pkl']) > 0
+    for format in ['parquet', 'feather']:
+        pd.testing.assert_frame_equal(frames[format], frames['pkl'],
+                                      check_dtype = False)
+
+
+@pytest.mark.integration
+@pytest.mark.parametrize('workers', ['1', '2'])
+def test_glob_like_each_file(tmp_path, raw, workers):
+    days = raw['timestamp'].dt.hour // 8
+    for day, df in raw.groupby(days):
+        to_csv(df, tmp_path / 'NPDATA_{}.csv'.format(day))
+
+    salt_file = str(tmp_path / 'salt')
+    raw_anpr.main(['--salt-file', salt_file, '--workers', workers,
+                   str(tmp_path / 'NPDATA_*.csv'), str(tmp_path / 'out')],
+                  standalone_mode = False)
+
+    assert sorted(os.listdir(str(tmp_path / 'out'))) == \
+           ['wrangled_NPDATA_{}.pkl'.format(day) for day in range(3)]
+
+    for day in range(3):
+        expected = str(tmp_path / 'expected_{}.pkl'.format(day))
+        raw_anpr.main(['--salt-file', salt_file,
+                       str(tmp_path / 'NPDATA_{}.csv'.format(day)), expected],
+                      standalone_mode = False)
+
+        pd.testing.assert_frame_equal(
+            read_frame(str(tmp_path / 'out' /
+                           'wrangled_NPDATA_{}.pkl'.format(day))),
+            read_frame(expected))
+
+
+@pytest.mark.integration
+def test_salt_file(tmp_path, raw):
+    to_csv(raw, tmp_path / 'raw.csv')
+    salt_file = tmp_path / 'salt'
+
+    def wrangled(name, *options):
+        output = str(tmp_path / name)
+        raw_anpr.main(list(options) + [str(tmp_path / 'raw.csv'), output],
+                      standalone_mode = False)
+        return read_frame(output)
+
+    wrangled('plates.pkl', '--no-anonymise', '--salt-file', str(salt_file))
+    assert not salt_file.exists()
+
+    first = wrangled('first.pkl', '--salt-file', str(salt_file))
+    salt = salt_file.read_text()
+    second = wrangled('second.pkl', '--salt-file', str(salt_file))
+
+    assert salt_file.read_text() == salt
+    pd.testing.assert_frame_equal(first, second)
+    assert first['vehicle'].tolist() == anonymise_plates(
+        wrangled('plates.pkl', '--no-anonymise')['vehicle'],
+        digest_salt = bytes.fromhex(salt)).tolist()